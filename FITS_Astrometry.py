@@ -0,0 +1,187 @@
+from astropy.io import fits
+import numpy as np
+import concurrent.futures
+import argparse
+import time
+import os
+import sys
+
+from lblparser import lbl_parse
+from manifest import Manifest
+from FITS_Calibration import imageHDU
+from FITS_Sextraction import catalogPath, processedImages
+from PS1_Comparison import referenceCache, parseConeQuery
+from secatalog import catalog_types, readCatalog
+from instruments import instruments, instrumentOf, framePath
+from astrometry import (headerSolution, nominalSolution, solutionCone, fitSolution, writeSolution,
+                        updateIndex, wcsIndexPath)
+import neat_catalog
+import metrics
+
+# Catalog columns the fit needs
+wcs_columns = ['XWIN_IMAGE', 'YWIN_IMAGE', 'MAG_AUTO', 'FLAGS']
+
+# SExtractor flags of sources left out of the fit: blended, saturated, truncated, overflows
+bad_flags = 2 | 4 | 8 | 64 | 128
+
+default_tolerance = 2.0   # arcsec
+default_max_offset = 0.05  # degrees
+
+
+def frameCatalog(sample, light_id):
+    """The extracted catalog of a processed frame, whichever type it was written as, or None."""
+    for catalog_type in catalog_types:
+        path = catalogPath(sample, light_id, catalog_type)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def frameLabel(sample, light_id, path, conn=None):
+    source = neat_catalog.frameOfProduct(conn, path) if conn is not None else None
+    if source is not None:
+        return source['label']
+    return framePath(sample, 'lights', instrumentOf(sample)) + '/' + light_id[:-5] + '.lbl'
+
+
+def initialSolution(image, label):
+    """Starting solution of a frame: the WCS in its header, else the nominal pointing and pixel
+       scale of its label.
+    """
+    with fits.open(image, memmap=True) as hdul:
+        header = imageHDU(hdul).header
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        solution = headerSolution(header, shape)
+    if solution is not None:
+        return solution
+    lbl = lbl_parse(label)
+    return nominalSolution(float(lbl['RIGHT_ASCENSION'].partition('<')[0]),
+                           float(lbl['DECLINATION'].partition('<')[0]),
+                           float(lbl['HORIZONTAL_PIXEL_FOV'].partition('<')[0]), shape)
+
+
+def searchCone(initial, max_offset):
+    ra, dec, radius = solutionCone(initial)
+    return ra, dec, radius + max_offset
+
+
+def solveFrame(image, catalog, initial, cache, offline=False, max_offset=default_max_offset,
+               tolerance=default_tolerance):
+    """Fit one frame's WCS against the cached PS1 stars and write it into the frame's header.
+       Returns the solution, or None if the fit failed.
+    """
+    with metrics.timed('catalog_read'):
+        sources = readCatalog(catalog, wcs_columns)
+    if 'FLAGS' in sources.colnames:
+        sources = sources[(np.asarray(sources['FLAGS']) & bad_flags) == 0]
+    with metrics.timed('ps1_cone'):
+        ps1 = parseConeQuery(cache.cone(*searchCone(initial, max_offset), offline=offline))
+    if len(ps1) == 0:
+        return None
+    with metrics.timed('wcs_fit'):
+        solution = fitSolution(sources['XWIN_IMAGE'], sources['YWIN_IMAGE'], sources['MAG_AUTO'],
+                               ps1['raMean'], ps1['decMean'], ps1['rMeanApMag'], initial,
+                               max_offset=max_offset, tolerance=tolerance)
+    if solution is None:
+        return None
+    with fits.open(image, mode='update', memmap=True) as hdul:
+        writeSolution(imageHDU(hdul).header, solution)
+    return solution
+
+
+def solveAll(images, cache, offline=False, workers=None, conn=None, max_offset=default_max_offset,
+             tolerance=default_tolerance):
+    """Solve the WCS of the given processed images (sample, light_id, path) on a bounded pool,
+       skipping those the manifest shows as solved and unchanged. Solutions go into each frame's
+       header and its night's index. Returns status counts.
+    """
+    manifest = Manifest()
+    counts = {'done': 0, 'failed': 0, 'current': 0, 'no catalog': 0}
+    jobs = []
+    for sample, light_id, path in images:
+        if manifest.isCurrent('wcs', path):
+            counts['current'] += 1
+            continue
+        catalog = frameCatalog(sample, light_id)
+        if catalog is None:
+            counts['no catalog'] += 1
+            continue
+        initial = initialSolution(path, frameLabel(sample, light_id, path, conn))
+        jobs.append((sample, light_id, path, catalog, initial))
+
+    # Fetch every reference tile the frames need in one concurrent round
+    if jobs and not offline:
+        print("Fetched " + str(cache.prefetch([searchCone(j[4], max_offset) for j in jobs])) +
+              " new PS1 tiles.")
+
+    solutions = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = dict()
+        for sample, light_id, path, catalog, initial in jobs:
+            extracted = manifest.isCurrent('extract', path)
+            future = pool.submit(solveFrame, path, catalog, initial, cache, offline, max_offset,
+                                 tolerance)
+            futures[future] = (sample, light_id, path, extracted, time.time())
+        for future in concurrent.futures.as_completed(futures):
+            sample, light_id, path, extracted, start = futures[future]
+            try:
+                solution = future.result()
+                message = 'too few reference stars matched'
+            except Exception as e:
+                solution = None
+                message = '%s: %s' % (type(e).__name__, e)
+            if solution is None:
+                counts['failed'] += 1
+                metrics.count('wcs_failed')
+                manifest.record('wcs', path, 'failed', message=message)
+                print("No WCS for " + path + ": " + message)
+                continue
+            # The header changed, not the pixels the catalog was extracted from
+            if extracted:
+                manifest.refresh('extract', path)
+            solutions.setdefault(sample, dict())[light_id[:-5]] = solution
+            counts['done'] += 1
+            metrics.count('wcs_solved')
+            manifest.record('wcs', path, 'done', output=wcsIndexPath(sample),
+                            nmatch=solution['nmatch'], rms=solution['rms'],
+                            seconds=time.time() - start)
+            print("WCS of " + path + ": " + str(solution['nmatch']) + " stars, rms " +
+                  ('%.2f' % solution['rms']) + " arcsec.")
+
+    for sample, frames in solutions.items():
+        updateIndex(sample, frames)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fit the WCS of every extracted NEAT frame against PS1.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of frames solved concurrently")
+    parser.add_argument('--tolerance', type=float, default=default_tolerance,
+                        help="final star matching radius (arcsec)")
+    parser.add_argument('--max-offset', type=float, default=default_max_offset,
+                        help="largest pointing error searched for (degrees)")
+    parser.add_argument('--offline', action='store_true',
+                        help="use only PS1 tiles already in the cache")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to read processed images from, if it exists")
+    parser.add_argument('--volume', action='append', choices=sorted(instruments), dest='volumes',
+                        help="only solve nights of this volume, may be repeated (default: all)")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+
+    conn = neat_catalog.connect(args.catalog) if os.path.exists(args.catalog) else None
+    images = processedImages(conn, args.volumes)
+    counts = solveAll(images, referenceCache(), args.offline, args.workers, conn, args.max_offset,
+                      args.tolerance)
+    print("Finished. " + str(counts['done']) + " frames solved, " + str(counts['failed']) +
+          " failed, " + str(counts['current']) + " already up to date, " + str(counts['no catalog']) +
+          " not extracted yet.")
+    metrics.report(args)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+from astropy.io import fits
+from astropy.nddata import CCDData
+from manifest import fileSignature
+import ccdproc
+import collections
+import numpy as np
+import os
+
+processed_volume = 'preprocessed'
+calibration_cache = processed_volume + '/_calib'
+
+dark_target = 'DARK'
+flat_target = 'FLAT FIELD'
+
+# Rows of a frame calibrated at a time by calibrateChunked
+block_rows = 256
+# Normalised flat values outside this range mark dead or hot pixels
+bad_flat_range = (0.3, 3.0)
+# Header keywords that describe how raw integer pixels are stored, dropped from float32 outputs
+scaling_keywords = ('BZERO', 'BSCALE', 'BLANK')
+
+
+def calibrationDir(sample):
+    """Location of the cached master frames for a night."""
+    return calibration_cache + '/' + sample
+
+
+def masterDarkPath(sample, exposure):
+    return calibrationDir(sample) + '/dark_' + ('%g' % exposure) + 's.fits'
+
+
+def masterFlatPath(sample):
+    return calibrationDir(sample) + '/flat.fits'
+
+
+def normFlatPath(sample):
+    return calibrationDir(sample) + '/flat_norm.fits'
+
+
+def weightMapPath(sample):
+    """Per-night weight map (1 good, 0 bad pixel) for SExtractor's MAP_WEIGHT."""
+    return calibrationDir(sample) + '/weight.fits'
+
+
+def flatWeightPath(sample, flat):
+    """Weight map of a single flat of a night, for lights calibrated against it directly."""
+    return calibrationDir(sample) + '/weight_' + os.path.splitext(os.path.basename(flat))[0] + '.fits'
+
+
+def frameWeightPath(sample, header):
+    """Weight map matching the flat a processed frame was divided by, from its FLATFILE keyword."""
+    flat = header.get('FLATFILE')
+    if flat is None or flat == os.path.basename(normFlatPath(sample)):
+        return weightMapPath(sample)
+    return flatWeightPath(sample, flat)
+
+
+def _isStale(paths, out_path):
+    """A master is stale when missing or stacked from a different set of input frames."""
+    if not os.path.exists(out_path):
+        return True
+    return fits.getheader(out_path).get('CALINPUT') != fileSignature(paths)
+
+
+def _combine(paths, out_path, normalize=False):
+    """Median-combine a list of FITS frames and write the result to out_path as float32.
+       With normalize, for flats, each frame is first scaled by its own median so lamp or sky
+       level changes between flats do not bias the stack, and the median of the stack is stored
+       as FLATNORM.
+    """
+    scale = (lambda data: 1 / np.nanmedian(data)) if normalize else None
+    master = ccdproc.combine(paths, method='median', scale=scale, unit='adu')
+    master.data = master.data.astype(np.float32)
+    if normalize:
+        master.meta['FLATNORM'] = float(np.nanmedian(master.data))
+        master.meta['FLATSCAL'] = True
+    master.meta['NCOMBINE'] = len(paths)
+    master.meta['CALINPUT'] = fileSignature(paths)
+    tmp_path = out_path + '.tmp'
+    master.write(tmp_path, overwrite=True, format='fits')
+    os.replace(tmp_path, out_path)
+
+
+def buildMasterFrames(sample, FITSFiles, calib_index, dark_target=dark_target, flat_target=flat_target):
+    """Stack the darks of a night per exposure duration and all of its flats into master frames,
+       recognising them by the instrument's dark and flat TARGET_NAME.
+       Cached masters are only restacked when their input frames changed.
+
+       Returns a dictionary mapping exposure duration to master dark path, and the master flat path.
+    """
+    os.makedirs(calibrationDir(sample), exist_ok=True)
+
+    darks_by_exposure = dict()
+    for idx, lbl in enumerate(calib_index['darks']['labels']):
+        if lbl is not None and lbl['TARGET_NAME'] == dark_target:
+            exposure = float(lbl['EXPOSURE_DURATION'])
+            darks_by_exposure.setdefault(exposure, []).append(FITSFiles['darks'][idx])
+
+    dark_paths = dict()
+    for exposure, paths in darks_by_exposure.items():
+        out_path = masterDarkPath(sample, exposure)
+        if _isStale(paths, out_path):
+            print("Stacking " + str(len(paths)) + " darks of " + ('%g' % exposure) + "s for " + sample + "...")
+            _combine(paths, out_path)
+        dark_paths[exposure] = out_path
+
+    flats = [FITSFiles['flats'][idx] for idx, lbl in enumerate(calib_index['flats']['labels'])
+             if lbl is not None and lbl['TARGET_NAME'] == flat_target]
+    flat_path = masterFlatPath(sample)
+    if not flats:
+        flat_path = None
+    elif _isStale(flats, flat_path) or not fits.getheader(flat_path).get('FLATSCAL'):
+        print("Stacking " + str(len(flats)) + " flats for " + sample + "...")
+        _combine(flats, flat_path, normalize=True)
+
+    return dark_paths, flat_path
+
+
+def badFlatPixels(norm_flat):
+    """Pixels of a normalised flat that cannot be divided by: non-finite, dead or hot."""
+    low, high = bad_flat_range
+    with np.errstate(invalid='ignore'):
+        return ~np.isfinite(norm_flat) | (norm_flat < low) | (norm_flat > high)
+
+
+def normalizeFlat(flat, norm=None):
+    """Return a flat as float32 divided by its median (or norm), with bad pixels set to 1 so
+       dividing by it never produces inf or NaN.
+    """
+    flat = np.array(flat, dtype=np.float32)
+    flat /= np.float32(np.nanmedian(flat) if norm is None else norm)
+    flat[badFlatPixels(flat)] = 1.0
+    return flat
+
+
+def _writeProduct(data, out_path, inputs, **keywords):
+    header = fits.Header()
+    header['CALINPUT'] = fileSignature(inputs)
+    header.update(keywords)
+    tmp_path = out_path + '.tmp'
+    fits.PrimaryHDU(data, header).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+
+
+def buildFlatProducts(sample, flat_path):
+    """Derive the normalised flat and the bad-pixel weight map of a night from its master flat.
+       Both are cached next to the masters and only rebuilt when the master flat changes.
+
+       Returns the normalised flat path and the weight map path.
+    """
+    norm_path, weight_path = normFlatPath(sample), weightMapPath(sample)
+    if _isStale([flat_path], norm_path) or _isStale([flat_path], weight_path):
+        with fits.open(flat_path, memmap=True) as hdul:
+            flat = np.array(hdul[0].data, dtype=np.float32)
+        flat /= np.float32(flatNorm(flat_path))
+        bad = badFlatPixels(flat)
+        flat[bad] = 1.0
+        print("Masking " + str(int(bad.sum())) + " bad flat pixels for " + sample + "...")
+        _writeProduct(flat, norm_path, [flat_path], FLATNORM=1.0, NBADPIX=int(bad.sum()))
+        _writeProduct((~bad).astype(np.uint8), weight_path, [flat_path], NBADPIX=int(bad.sum()))
+    return norm_path, weight_path
+
+
+def buildFlatWeights(sample, flat_paths):
+    """Derive a bad-pixel weight map from each single flat of a night, for nearest-frame
+       calibration. Cached like the master products. Returns the weight map paths.
+    """
+    os.makedirs(calibrationDir(sample), exist_ok=True)
+    weight_paths = []
+    for flat_path in flat_paths:
+        weight_path = flatWeightPath(sample, flat_path)
+        if _isStale([flat_path], weight_path):
+            flat = fits.getdata(flat_path, memmap=False).astype(np.float32)
+            bad = badFlatPixels(flat / np.float32(flatNorm(flat_path)))
+            _writeProduct((~bad).astype(np.uint8), weight_path, [flat_path], NBADPIX=int(bad.sum()))
+        weight_paths.append(weight_path)
+    return weight_paths
+
+
+def nightSignature(FITSFiles):
+    """Signature of every calibration frame of a night, used to invalidate calibrated lights."""
+    return fileSignature(FITSFiles['darks'] + FITSFiles['flats'])
+
+
+# Nights whose master frames a process keeps memory-mapped at once
+open_master_nights = 2
+# Open masters by night directory, least recently used first
+_open_masters = collections.OrderedDict()
+
+
+def loadMaster(path):
+    """Memory-map a cached master frame, keeping it open for reuse by later lights. Only the
+       masters of the last open_master_nights nights stay open; older nights' are closed.
+    """
+    night = os.path.dirname(path)
+    masters = _open_masters.pop(night, dict())
+    _open_masters[night] = masters
+    while len(_open_masters) > open_master_nights:
+        _, old = _open_masters.popitem(last=False)
+        for hdul in old.values():
+            hdul.close()
+    if path not in masters:
+        masters[path] = fits.open(path, memmap=True)
+    return masters[path][0].data
+
+
+def releaseMasters():
+    """Close every memory-mapped master frame."""
+    for masters in _open_masters.values():
+        for hdul in masters.values():
+            hdul.close()
+    _open_masters.clear()
+
+
+# Weight map masks a process keeps in memory (a full-frame boolean array each)
+weight_mask_cache = 4
+# (mtime, mask) by weight map path, least recently used first
+_weight_masks = collections.OrderedDict()
+
+
+def weightMask(path):
+    """Bad pixels (zero weight) of a weight map, read once per process and again only if the map
+       is rebuilt. Only the weight_mask_cache most recently used masks are kept.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _weight_masks.pop(path, None)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, fits.getdata(path) == 0)
+    _weight_masks[path] = cached
+    while len(_weight_masks) > weight_mask_cache:
+        _weight_masks.popitem(last=False)
+    return cached[1]
+
+
+_flat_norms = dict()
+
+
+def flatNorm(path):
+    """Median level of a flat, from its FLATNORM keyword or computed once per process."""
+    if path not in _flat_norms:
+        norm = fits.getheader(path).get('FLATNORM')
+        if norm is None:
+            # Raw integer flats carry BZERO, which memory-mapped data cannot be scaled by
+            norm = float(np.nanmedian(fits.getdata(path, memmap=False)))
+        _flat_norms[path] = norm
+    return _flat_norms[path]
+
+
+def _rawImage(hdul):
+    """The memory-mapped stored pixels of a primary image and the BSCALE/BZERO that turn them
+       into physical values. The HDU list must be opened with do_not_scale_image_data.
+    """
+    header = hdul[0].header
+    return hdul[0].data, header.get('BSCALE', 1.0), header.get('BZERO', 0.0)
+
+
+def _readBlock(image, start, stop):
+    data, bscale, bzero = image
+    block = np.array(data[start:stop], dtype=np.float32)
+    if bscale != 1.0:
+        block *= bscale
+    if bzero != 0.0:
+        block += bzero
+    return block
+
+
+def _outputHeader(header):
+    header = header.copy()
+    for keyword in scaling_keywords:
+        header.remove(keyword, ignore_missing=True)
+    header['BITPIX'] = -32
+    return header
+
+
+def _createImage(path, header, shape):
+    """Write a float32 primary header and a zero-filled data unit of the given shape, returning
+       the data unit memory-mapped for writing.
+    """
+    header['NAXIS'] = 2
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    header.tofile(path, overwrite=True)
+    offset = os.path.getsize(path)
+    nbytes = shape[0] * shape[1] * 4
+    with open(path, 'r+b') as f:
+        # Data units are padded to a whole number of 2880-byte FITS blocks
+        f.seek(offset + -(-nbytes // 2880) * 2880 - 1)
+        f.write(b'\0')
+    return np.memmap(path, dtype='>f4', mode='r+', offset=offset, shape=shape)
+
+
+def calibrateChunked(light_path, dark_path, flat_path, out_path, meta=None, compress=False):
+    """Compute (light - dark) / (flat / FLATNORM) in float32, block_rows rows at a time, dividing
+       bad flat pixels by 1 instead.
+
+       Light, dark and flat are memory-mapped, so only a few row blocks are resident at once and
+       no full-frame float64 temporaries are made. The result is written as a float32 image, or
+       with compress as a RICE tile-compressed image in the first extension (which then has to be
+       held in memory while compressing). RICE compression of float data is lossy: pixel values
+       are quantised to a fraction of the background noise (about 0.5 ADU at most for NEAT sky
+       levels), which does not change extraction or photometry but is not bit-exact.
+       meta: extra header keywords for the output.
+
+       Returns the output header.
+    """
+    with fits.open(light_path, memmap=True, do_not_scale_image_data=True) as light_hdul, \
+            fits.open(dark_path, memmap=True, do_not_scale_image_data=True) as dark_hdul, \
+            fits.open(flat_path, memmap=True, do_not_scale_image_data=True) as flat_hdul:
+        light, dark, flat = _rawImage(light_hdul), _rawImage(dark_hdul), _rawImage(flat_hdul)
+        shape = light[0].shape
+        header = _outputHeader(light_hdul[0].header)
+        header.update(meta or {})
+        norm = np.float32(flatNorm(flat_path))
+
+        tmp_path = out_path + '.tmp'
+        out = np.empty(shape, dtype=np.float32) if compress else _createImage(tmp_path, header, shape)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, shape[0], block_rows):
+                stop = min(start + block_rows, shape[0])
+                block = _readBlock(light, start, stop)
+                block -= _readBlock(dark, start, stop)
+                flat_block = _readBlock(flat, start, stop)
+                flat_block /= norm
+                flat_block[badFlatPixels(flat_block)] = 1.0
+                block /= flat_block
+                out[start:stop] = block
+
+    if compress:
+        fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(out, header)]).writeto(tmp_path, overwrite=True)
+    else:
+        out.flush()
+        del out
+    os.replace(tmp_path, out_path)
+    return header
+
+
+def imageHDU(hdul):
+    """The HDU holding the image of a processed frame: the primary one, or the first extension
+       of a tile-compressed frame.
+    """
+    if hdul[0].data is None and len(hdul) > 1:
+        return hdul[1]
+    return hdul[0]
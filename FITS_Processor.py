@@ -2,13 +2,27 @@ from astropy.io import fits
 from astropy import units as u
 from astropy.wcs import WCS
 from astropy.nddata import CCDData
-from lblparser import lbl_parse
+from lblparser import label_index
+from FITS_Calibration import buildMasterFrames, buildFlatProducts, loadMaster, nightSignature, \
+    calibrateChunked, imageHDU, normalizeFlat, buildFlatWeights, frameWeightPath, weightMask
+from manifest import Manifest
+from FITS_Sextraction import catalogPath
+import neat_catalog
+import metrics
+from secatalog import default_catalog_type
+from instruments import instruments, framePath, isCompliantLight, findNights, interleave, \
+    default_instrument
 from datetime import datetime
 import ccdproc
 import numpy as np
 import matplotlib.pyplot as plt
+import argparse
+import bisect
+import concurrent.futures
+import threading
 import glob
 import os
+import sys
 
 flats_folder_format = 'flats'
 darks_folder_format = 'darks'
@@ -25,123 +39,488 @@ sextractor_output = 'sexout'
 processed_volume = 'preprocessed'
 
 
-def formFITSPaths(sample):
+def formFITSPaths(sample, instrument=default_instrument):
     """Use NEAT data conventions for mapping wget output locally to locations of files."""
     paths = dict()
-    paths['darks'] = tricam_data_volume + \
-        '/' + sample + '/' + darks_folder_format
-    paths['flats'] = tricam_data_volume + \
-        '/' + sample + '/' + flats_folder_format
-    paths['lights'] = tricam_data_volume + \
-        '/' + sample + '/' + lights_folder_format
+    paths['darks'] = framePath(sample, 'darks', instrument)
+    paths['flats'] = framePath(sample, 'flats', instrument)
+    paths['lights'] = framePath(sample, 'lights', instrument)
     return paths
 
 
-def findFITSFiles(sample):
+def findFITSFiles(sample, instrument=default_instrument):
     """Use paths to find all .fit samples and index samples accordingly."""
-    paths = formFITSPaths(sample)
+    paths = formFITSPaths(sample, instrument)
     files = dict()
-    files['darks'] = glob.glob(paths['darks'] + '/*.fit')
-    files['flats'] = glob.glob(paths['flats'] + '/*.fit')
-    files['lights'] = glob.glob(paths['lights'] + '/*.fit')
-    files['darks_lbl'] = glob.glob(paths['darks'] + '/*.lbl')
-    files['flats_lbl'] = glob.glob(paths['flats'] + '/*.lbl')
-    files['lights_lbl'] = glob.glob(paths['lights'] + '/*.lbl')
+    files['darks'] = sorted(glob.glob(paths['darks'] + '/*.fit'))
+    files['flats'] = sorted(glob.glob(paths['flats'] + '/*.fit'))
+    files['lights'] = sorted(glob.glob(paths['lights'] + '/*.fit'))
+    files['darks_lbl'] = sorted(glob.glob(paths['darks'] + '/*.lbl'))
+    files['flats_lbl'] = sorted(glob.glob(paths['flats'] + '/*.lbl'))
+    files['lights_lbl'] = sorted(glob.glob(paths['lights'] + '/*.lbl'))
     return files
 
 
-def odf_mapper(FITSFiles, light_idx):
+def _timeOfDay(timestamp):
+    """Split a label timestamp into its date and seconds since midnight."""
+    day, _, clock = timestamp.partition('T')
+    t = datetime.strptime(clock, FMT)
+    return day, t.hour * 3600 + t.minute * 60 + t.second
+
+
+def _exposure(lbl):
+    return float(lbl['EXPOSURE_DURATION'])
+
+
+def buildCalibrationIndex(FITSFiles):
+    """Index the labels of a night's darks, flats and lights once (lblparser.label_index), and
+       its darks and flats by STOP_TIME.
+
+       Returns a dictionary with, for each of 'darks', 'flats' and 'lights', the label index rows
+       in file order (None for a label that cannot be read), and for darks and flats a per-date
+       list of (seconds, exposure, file index) sorted by time.
+    """
+    index = dict()
+    for kind in ('darks', 'flats', 'lights'):
+        label_paths = [path[:-3] + "lbl" for path in FITSFiles[kind]]
+        rows = label_index(label_paths)
+        labels = [rows.get(path) for path in label_paths]
+        index[kind] = {'labels': labels}
+        if kind == 'lights':
+            continue
+        by_date = dict()
+        for idx, lbl in enumerate(labels):
+            if lbl is None:
+                continue
+            day, seconds = _timeOfDay(lbl["STOP_TIME"])
+            by_date.setdefault(day, []).append((seconds, _exposure(lbl), idx))
+        for day in by_date:
+            by_date[day].sort()
+        index[kind].update(by_date=by_date,
+                           seconds={day: [e[0] for e in by_date[day]] for day in by_date})
+    return index
+
+
+def _lightLabel(FITSFiles, light_idx, calib_index):
+    lbl = calib_index['lights']['labels'][light_idx]
+    if lbl is None:
+        raise IOError("cannot read label of " + FITSFiles['lights'][light_idx])
+    return lbl
+
+
+def _nearestFrame(kind_index, day, seconds):
+    """Bisect for the frame closest in time on the same date.
+       Ties resolve to the lowest file index, as in a linear scan.
+    """
+    if day not in kind_index['by_date']:
+        return 0, 99999999
+    entries = kind_index['by_date'][day]
+    times = kind_index['seconds'][day]
+    pos = bisect.bisect_left(times, seconds)
+    deltas = []
+    if pos > 0:
+        deltas.append(seconds - times[pos - 1])
+    if pos < len(times):
+        deltas.append(times[pos] - seconds)
+    delta = min(deltas)
+    lo = bisect.bisect_left(times, seconds - delta)
+    hi = bisect.bisect_right(times, seconds + delta)
+    candidates = [e[2] for e in entries[lo:hi]
+                  if abs(e[0] - seconds) == delta]
+    return min(candidates), float(delta)
+
+
+_calibration_indexes = dict()
+
+
+def calibrationIndexFor(sample, FITSFiles):
+    """Return the calibration index of a night, building it on first use."""
+    if sample not in _calibration_indexes:
+        _calibration_indexes[sample] = buildCalibrationIndex(FITSFiles)
+    return _calibration_indexes[sample]
+
+
+def odf_mapper(FITSFiles, light_idx, calib_index=None, instrument=default_instrument):
     """Transforms light index into closest dark and flat indexes"""
-    lab = lbl_parse(FITSFiles['lights'][light_idx][:-3]+"lbl")
-    ttd = lab["START_TIME"].partition('T')
-
-    best_didx = 0
-    best_fidx = 0
-    min_t_d_delta = 99999999
-    min_t_f_delta = 99999999
-    
-    for didx in range(len(FITSFiles['darks'])):
-        dta = lbl_parse(FITSFiles['darks'][didx][:-3]+"lbl")
-        ttd_dta = dta["STOP_TIME"].partition('T')
-        if ttd_dta[0] == ttd[0]:
-            tdelta = abs((datetime.strptime(ttd_dta[2], FMT) - datetime.strptime(ttd[2], FMT)).total_seconds())
-            if tdelta < min_t_d_delta:
-                min_t_d_delta = tdelta
-                best_didx = didx
-    
-    for fidx in range(len(FITSFiles['flats'])):
-        fta = lbl_parse(FITSFiles['flats'][fidx][:-3]+"lbl")
-        ttf_fta = fta["STOP_TIME"].partition('T')
-        if (ttf_fta[0] == ttd[0]):
-            tdelta = abs((datetime.strptime(ttf_fta[2], FMT) - datetime.strptime(ttd[2], FMT)).total_seconds())
-            if tdelta < min_t_f_delta:
-                min_t_f_delta = tdelta
-                best_fidx = fidx
-    
-    light_lbl = lbl_parse(FITSFiles['lights'][light_idx][:-3]+"lbl")
-    dark_lbl = lbl_parse(FITSFiles['darks'][best_didx][:-3]+"lbl")
-    flat_lbl = lbl_parse(FITSFiles['flats'][best_fidx][:-3]+"lbl")
-
-    if (flat_lbl['TARGET_NAME'] == '"FLAT FIELD"' and
-            dark_lbl['TARGET_NAME'] == '"DARK"' and
-            float(flat_lbl['EXPOSURE_DURATION'].partition('<')[0]) == float(dark_lbl['EXPOSURE_DURATION'].partition('<')[0]) and
-            light_lbl['TARGET_NAME'] == '"ASTEROID"' and
-            light_lbl['FILTER_NAME'] == '"NONE"' and
-            float(light_lbl['EXPOSURE_DURATION'].partition('<')[0]) == float(dark_lbl['EXPOSURE_DURATION'].partition('<')[0])):
+    if calib_index is None:
+        calib_index = buildCalibrationIndex(FITSFiles)
+
+    light_lbl = _lightLabel(FITSFiles, light_idx, calib_index)
+    day, seconds = _timeOfDay(light_lbl["START_TIME"])
+
+    best_didx, min_t_d_delta = _nearestFrame(calib_index['darks'], day, seconds)
+    best_fidx, min_t_f_delta = _nearestFrame(calib_index['flats'], day, seconds)
+
+    dark_lbl = calib_index['darks']['labels'][best_didx]
+    flat_lbl = calib_index['flats']['labels'][best_fidx]
+
+    conventions = instruments[instrument]
+    if (dark_lbl is not None and flat_lbl is not None and
+            flat_lbl['TARGET_NAME'] == conventions['flat_target'] and
+            dark_lbl['TARGET_NAME'] == conventions['dark_target'] and
+            _exposure(flat_lbl) == _exposure(dark_lbl) and
+            isCompliantLight(light_lbl, instrument) and
+            _exposure(light_lbl) == _exposure(dark_lbl)):
         return (best_didx,best_fidx,min_t_d_delta,min_t_f_delta)
     else:
         return (-1, -1, 0, 0)
 
-def preprocessSampleData(light_idx, FITSFiles, longid):
+def nearestFrameCalibration(light_idx, FITSFiles, calib_index=None, instrument=default_instrument,
+                            load=True):
+    """Pick the single dark and flat closest in time to a light and read them.
+       Returns the dark and flat arrays (None unless load) followed by their paths.
+    """
+    dark_idx, flat_idx, _, _ = odf_mapper(FITSFiles, light_idx, calib_index, instrument)
+
+    if dark_idx < 0 and flat_idx < 0:
+        return None, None, None, None
+
+    dark_path, flat_path = FITSFiles['darks'][dark_idx], FITSFiles['flats'][flat_idx]
+    if not load:
+        return None, None, dark_path, flat_path
+    dark = CCDData.read(dark_path, unit='adu')
+    flat = CCDData.read(flat_path, unit='adu')
+    return dark.data, normalizeFlat(flat.data), dark_path, flat_path
+
+
+_night_masters = dict()
+
+
+def nightMasters(sample, FITSFiles, calib_index, instrument=default_instrument):
+    """Return the master darks, normalised master flat and weight map of a night, building or
+       validating them once per process.
+    """
+    if sample not in _night_masters:
+        conventions = instruments[instrument]
+        with metrics.timed('master_frames'):
+            dark_paths, flat_path = buildMasterFrames(sample, FITSFiles, calib_index,
+                                                      conventions['dark_target'],
+                                                      conventions['flat_target'])
+            norm_flat_path, weight_path = None, None
+            if flat_path is not None:
+                norm_flat_path, weight_path = buildFlatProducts(sample, flat_path)
+        _night_masters[sample] = dark_paths, norm_flat_path, weight_path
+    return _night_masters[sample]
+
+
+def masterFrameCalibration(light_idx, FITSFiles, sample, calib_index, instrument=default_instrument,
+                           load=True):
+    """Look up the cached master dark matching a light's exposure and the night's normalised master
+       flat. Returns their memory-mapped arrays (None unless load) followed by their paths.
+    """
+    dark_paths, flat_path, _ = nightMasters(sample, FITSFiles, calib_index, instrument)
+
+    light_lbl = _lightLabel(FITSFiles, light_idx, calib_index)
+    exposure = _exposure(light_lbl)
+    if (not isCompliantLight(light_lbl, instrument) or
+            exposure not in dark_paths or
+            flat_path is None):
+        return None, None, None, None
+
+    if not load:
+        return None, None, dark_paths[exposure], flat_path
+    return loadMaster(dark_paths[exposure]), loadMaster(flat_path), dark_paths[exposure], flat_path
+
+@metrics.timed('calibrate')
+def preprocessSampleData(light_idx, FITSFiles, longid, sample, calib_index=None, use_masters=True,
+                         instrument=default_instrument, chunked=False, compress=False, write=True):
     """Use provided correction methods to subtract out dark images and use flats to correct for vignetting.
        Write the processed file to the temporary preprocessed directory.
+
+       With use_masters, the night's stacked master dark and normalised master flat are used;
+       otherwise the single dark and flat closest in time to the light, the flat normalised in
+       memory. Bad flat pixels are divided by 1 rather than producing inf or NaN. The instrument selects the label conventions.
+
+       With chunked, the frames are memory-mapped and calibrated in float32 row blocks against the
+       normalised flat, and the output is float32 (tile-compressed with compress); the returned
+       CCDData then memory-maps the written file. Without write, the calibrated frame is only
+       returned, not written (the chunked mode always writes it).
     """
-    dark_idx, flat_idx, ttd, ttf = odf_mapper(FITSFiles, light_idx)
-    print(ttd, ttf)
+    if calib_index is None:
+        calib_index = calibrationIndexFor(sample, FITSFiles)
 
-    if dark_idx < 0 and flat_idx < 0:
+    if use_masters:
+        dark, flat, dark_path, flat_path = masterFrameCalibration(light_idx, FITSFiles, sample,
+                                                                  calib_index, instrument,
+                                                                  load=not chunked)
+    else:
+        dark, flat, dark_path, flat_path = nearestFrameCalibration(light_idx, FITSFiles,
+                                                                   calib_index, instrument,
+                                                                   load=not chunked)
+
+    if dark_path is None or flat_path is None:
         print("NON-COMPLIANT")
         return;
 
-    lights_lbl = lbl_parse(FITSFiles['lights_lbl'][light_idx])
+    out_path = processedPath(sample, longid)
+    if chunked or write:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if chunked:
+        print("Writing to file " + os.path.basename(out_path))
+        meta = {'DARKFILE': os.path.basename(dark_path), 'FLATFILE': os.path.basename(flat_path)}
+        calibrateChunked(FITSFiles['lights'][light_idx], dark_path, flat_path, out_path, meta, compress)
+        # Closing the file leaves the returned data memory-mapped until it is dropped
+        with fits.open(out_path, memmap=True) as hdul:
+            hdu = imageHDU(hdul)
+            return CCDData(hdu.data, meta=hdu.header, wcs=WCS(hdu.header), unit='adu')
 
     light = CCDData.read(FITSFiles['lights'][light_idx], unit='adu')
-    dark = CCDData.read(FITSFiles['darks'][dark_idx], unit='adu')
-    flat = CCDData.read(FITSFiles['flats'][flat_idx], unit='adu')
-    
-    corr = flat.data
-    corr1 = light.data - dark.data
+
+    corr = flat
+    corr1 = light.data - dark
     light.data = corr1/corr
+    light.meta['DARKFILE'] = os.path.basename(dark_path)
+    light.meta['FLATFILE'] = os.path.basename(flat_path)
     flat_corrected = light
 
-    path_plan = processed_volume + "/" + sample + "/"
-    try:
-        print("Attempting to build path...")
-        os.makedirs(path_plan)
-        print("Built!")
-        print("Writing to file " + str(longid.split('.')[0]) + ".fits")
-        flat_corrected.write(path_plan + str(longid.split('.')[0]) + '.fits')
-    except Exception as e:
-        print("Directory already exists. Writing to file " + str(longid.split('.')[0]) + ".fits")
-        flat_corrected.write(path_plan + str(longid.split('.')[0]) + '.fits')
+    if write:
+        print("Writing to file " + os.path.basename(out_path))
+        flat_corrected.write(out_path, overwrite=True)
     return flat_corrected
 
 
-def process(sample, idx, longid):
-    preprocessSampleData(idx, findFITSFiles(sample), longid)
+_night_files = dict()
+_catalog = {'path': None}
+# SQLite connections cannot be shared between threads, so each driver thread opens its own
+_catalog_conn = threading.local()
+
+
+def useCatalog(path):
+    """Read frame lists from the metadata catalog at path instead of globbing (None to glob).
+       Also used as the worker pool initializer.
+    """
+    _catalog['path'] = path
+
+
+def catalogConnection():
+    if _catalog['path'] is None:
+        return None
+    if getattr(_catalog_conn, 'path', None) != _catalog['path']:
+        _catalog_conn.conn = neat_catalog.connect(_catalog['path'])
+        _catalog_conn.path = _catalog['path']
+    return _catalog_conn.conn
+
+
+def nightFiles(sample, instrument=default_instrument):
+    """Return the FITS file lists of a night, looking them up only once per process."""
+    if sample not in _night_files:
+        conn = catalogConnection()
+        if conn is None:
+            _night_files[sample] = findFITSFiles(sample, instrument)
+        else:
+            _night_files[sample] = neat_catalog.fitsFiles(conn, sample, instrument)
+    return _night_files[sample]
+
+
+def processedPath(sample, longid):
+    return processed_volume + "/" + sample + "/" + str(longid.split('.')[0]) + '.fits'
+
+
+def process(sample, idx, longid, use_masters=True, instrument=default_instrument, chunked=False,
+            compress=False, write=True):
+    FITSFiles = nightFiles(sample, instrument)
+    return preprocessSampleData(idx, FITSFiles, longid, sample,
+                                calibrationIndexFor(sample, FITSFiles), use_masters, instrument,
+                                chunked, compress, write)
+
+
+def prepareNight(sample, use_masters=True, instrument=default_instrument):
+    """Build the shared calibration data of a night: its calibration index, and either its master
+       frames, normalised flat and bad-pixel weight map, or with nearest-frame calibration a weight
+       map per flat, so extraction masks the bad pixels of the flat each light was divided by.
+       Returns its lights as (idx, path) tasks and the signature of its calibration frames.
+    """
+    FITSFiles = nightFiles(sample, instrument)
+    calib_index = calibrationIndexFor(sample, FITSFiles)
+    if use_masters:
+        nightMasters(sample, FITSFiles, calib_index, instrument)
+    else:
+        buildFlatWeights(sample, FITSFiles['flats'])
+    return list(enumerate(FITSFiles['lights'])), nightSignature(FITSFiles)
+
+
+def frameWeightMap(sample, header):
+    """The bad-pixel weight map of the flat a frame was calibrated with, if one has been built."""
+    path = frameWeightPath(sample, header)
+    return path if os.path.exists(path) else None
+
+
+def extractInMemory(ccd, catalog, weight=None):
+    """Extract sources straight from a calibrated frame with the sep backend, skipping the
+       round trip through a processed FITS file and the sex binary. Pixels with zero weight in
+       the weight map are masked.
+    """
+    import sep_backend
+    with metrics.timed('extract_sep'):
+        mask = weightMask(weight) if weight is not None else None
+        table = sep_backend.extract(ccd.data, ccd.wcs, mask)
+        os.makedirs(os.path.dirname(catalog), exist_ok=True)
+        sep_backend.writeCatalog(table, catalog)
+    metrics.count('sources', len(table))
 
-sample = ''
-palomar = next(os.walk('tricam/data'))[1]
 
-for s in palomar:
-    sample = s
-    y = [x for x in next(
-            os.walk('tricam/data/' + s + '/obsdata'))[2] if x.endswith("fit")]
-    for i in range(len(y)):
+def processTask(sample, idx, light_path, use_masters=True, extract=False,
+                instrument=default_instrument, chunked=False, compress=False, keep_processed=False):
+    """Worker entry point. Returns (sample, light_path, status, message, fields) with status one of
+       'done', 'skipped' or 'failed' and fields the manifest details of the output.
+       With extract, the calibrated frame is source-extracted in-process and only written to disk
+       with keep_processed (or in the chunked mode); fields then has no output.
+    """
+    longid = os.path.basename(light_path)
+    write = not extract or keep_processed or chunked
+    try:
+        result = process(sample, idx, longid, use_masters, instrument, chunked, compress, write)
+    except Exception as e:
+        return sample, light_path, 'failed', '%s: %s' % (type(e).__name__, e), {}
+    if result is None:
+        return sample, light_path, 'skipped', 'non-compliant', {}
+    fields = {'output': processedPath(sample, longid) if write else None,
+              'dark': result.meta['DARKFILE'],
+              'flat': result.meta['FLATFILE']}
+    if extract:
+        catalog = catalogPath(sample, os.path.basename(processedPath(sample, longid)))
         try:
-            print("Processing sample " + s + " #" + str(i) + "...")
-            process(s, i, y[i])
-            print("Done.")
+            extractInMemory(result, catalog, frameWeightMap(sample, result.meta))
         except Exception as e:
-            print("Error processing. Either the file already exists, or the primary HDU is corrupted/unused.")
-            pass
+            return sample, light_path, 'failed', 'extraction %s: %s' % (type(e).__name__, e), fields
+        fields['catalog'] = catalog
+    return sample, light_path, 'done', '', fields
+
+
+def processVolume(nights, workers=None, use_masters=True, extract=False, catalog=None,
+                  chunked=False, compress=False, keep_processed=False, pool=None):
+    """Calibrate every light of the given (instrument, night) pairs over one process pool.
+
+       Nights of every volume share the pool, each calibrated with its instrument's conventions.
+       Each night is first prepared (calibration index and master frames) as a single task, then
+       its lights are fanned out, so the workers of a night share its cached calibration data.
+       Lights the manifest shows as already handled with the same inputs and calibration frames
+       are not reprocessed. With a metadata catalog, frame lists come from it and calibration
+       assignments and products are registered in it. chunked and compress select the low-memory
+       float32 calibration of preprocessSampleData. With extract, calibrated frames are extracted in
+       memory and only written with keep_processed. Worker metrics are merged into this process.
+       pool: a process pool started with useCatalog(catalog) as initializer to submit to, e.g.
+       shared by the calls for successive nights; by default one of workers processes is
+       started for this call. Returns a dictionary of status counts.
+    """
+    if pool is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=useCatalog,
+                                                    initargs=(catalog,)) as pool:
+            return processVolume(nights, workers, use_masters, extract, catalog, chunked, compress,
+                                 keep_processed, pool)
+    useCatalog(catalog)
+    conn = catalogConnection()
+    # None for the original float64 output, so existing manifest entries stay current
+    output_format = 'compressed' if compress else 'float32' if chunked else None
+    # Lights extracted without writing their calibrated frame; None keeps older entries current
+    in_memory = True if extract and not keep_processed and not chunked else None
+    # Master flats are now stacked from median-scaled flats; None keeps nearest-frame entries
+    scaled_flats = True if use_masters else None
+    manifest = Manifest()
+    counts = {'done': 0, 'skipped': 0, 'failed': 0, 'current': 0}
+    signatures = dict()
+    pending = {pool.submit(metrics.collect, prepareNight, s, use_masters, instrument):
+               ('prepare', instrument, s) for instrument, s in nights}
+    while pending:
+        finished, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            task = pending.pop(future)
+            if task[0] == 'prepare':
+                _, instrument, s = task
+                try:
+                    (lights, signatures[s]), worker_metrics = future.result()
+                except Exception as e:
+                    print("Error preparing calibration for " + s + ": " + str(e))
+                    counts['failed'] += 1
+                    continue
+                metrics.merge(worker_metrics)
+                todo = [(idx, path) for idx, path in lights
+                        if not manifest.isCurrent('calibrate', path, calib=signatures[s],
+                                                  masters=use_masters, output_format=output_format,
+                                                  flat_normalized=True, in_memory=in_memory,
+                                                  scaled_flats=scaled_flats)]
+                counts['current'] += len(lights) - len(todo)
+                print("Processing " + str(len(todo)) + " of " + str(len(lights)) +
+                      " lights of " + instrument + " sample " + s + "...")
+                for idx, path in todo:
+                    pending[pool.submit(metrics.collect, processTask, s, idx, path, use_masters,
+                                        extract, instrument, chunked, compress,
+                                        keep_processed)] = \
+                        ('light', instrument, s)
+                continue
+            (sample, light_path, status, message, fields), worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            metrics.count('frames_' + status)
+            counts[status] += 1
+            catalog_file = fields.pop('catalog', None)
+            manifest.record('calibrate', light_path, status, calib=signatures[sample],
+                            masters=use_masters, output_format=output_format,
+                            flat_normalized=True, in_memory=in_memory, scaled_flats=scaled_flats,
+                            message=message, **fields)
+            if catalog_file is not None:
+                # Keyed by the light itself when its calibrated frame was not written
+                manifest.record('extract', fields['output'] or light_path, 'done',
+                                output=catalog_file, backend='sep',
+                                catalog_type=default_catalog_type)
+            if conn is not None and status == 'done':
+                neat_catalog.setCalibration(conn, light_path, fields['dark'], fields['flat'])
+                if fields['output'] is not None:
+                    neat_catalog.addProduct(conn, light_path, 'calibrate', fields['output'])
+                if catalog_file is not None:
+                    neat_catalog.addProduct(conn, light_path, 'extract', catalog_file)
+            if status == 'done':
+                print("Done " + light_path + ".")
+            elif status == 'failed':
+                print("Error processing " + light_path + ": " + message)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dark-subtract and flat-correct NEAT lights.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument('--nearest', action='store_true',
+                        help="calibrate with the nearest single dark and flat instead of master frames")
+    parser.add_argument('--extract', action='store_true',
+                        help="extract sources in-process with sep right after calibration, "
+                             "without writing the calibrated frames")
+    parser.add_argument('--keep-processed', action='store_true',
+                        help="with --extract, also write the calibrated frames")
+    parser.add_argument('--chunked', action='store_true',
+                        help="calibrate memory-mapped frames in float32 row blocks, writing float32")
+    parser.add_argument('--compress', action='store_true',
+                        help="like --chunked, writing RICE tile-compressed frames (lossy: "
+                             "pixel values are quantised, to a fraction of the noise)")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to read frames from, if it exists")
+    parser.add_argument('--volume', action='append', choices=sorted(instruments), dest='volumes',
+                        help="volume to process, may be repeated (default: all of them)")
+    parser.add_argument('nights', nargs='*',
+                        help="nights to process (default: every night of the selected volumes)")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+
+    catalog = args.catalog if os.path.exists(args.catalog) else None
+    volumes = args.volumes or sorted(instruments)
+    if catalog is not None:
+        # Bring the catalog up to date with the nights about to be processed first
+        print("Using metadata catalog " + catalog + ".")
+        conn = neat_catalog.connect(catalog)
+        neat_catalog.scan(conn, [instruments[v]['volume'] for v in volumes], args.nights or None)
+    if catalog is not None and not args.nights:
+        nights = interleave(volumes, lambda v: neat_catalog.nights(conn, v))
+    else:
+        nights = findNights(volumes, args.nights)
+    counts = processVolume(nights, args.workers, not args.nearest, args.extract, catalog,
+                           args.chunked or args.compress, args.compress, args.keep_processed)
+    print("Finished. " + str(counts['done']) + " processed, " + str(counts['skipped']) +
+          " skipped, " + str(counts['failed']) + " failed, " + str(counts['current']) +
+          " already up to date.")
+    metrics.report(args)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
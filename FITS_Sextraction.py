@@ -1,51 +1,243 @@
 from astropy.io import fits
 from astropy import units as u
-from astropy.wcs import WCS
 from astropy.nddata import CCDData
 import ccdproc
 import numpy as np
 import matplotlib.pyplot as plt
+import concurrent.futures
+import subprocess
+import argparse
+import time
 import glob
 import os
+import sys
+
+from manifest import Manifest
+from FITS_Calibration import frameWeightPath, imageHDU
+import neat_catalog
+import metrics
+from secatalog import catalog_types, default_catalog_type, countRows, isBinary
+from instruments import instruments, instrumentOf
 
 sextractor_params = 'sexconf'
 sextractor_output = 'sexout'
 processed_volume = 'preprocessed'
 
-sample = ''
-proc = next(os.walk('preprocessed'))[1]
-
-for s in proc:
-    sample = s
-    y = [x for x in next(os.walk('preprocessed/' + sample))[2]]
-    for light_id in y:
-        file = processed_volume + "/" + sample + "/" + str(light_id)
-        print(
-        "Analyzing processed sample " +
-        sample +
-        ". Light ID is " +
-        light_id +
-        ". Running sextractor on " +
-        file +
-        " using parameters defined in " +
-        sextractor_params +
-        " folder.")
-
-        os.system(
-        "cd " +
-        sextractor_params +
-        " && sex ../" +
-        file +
-        " -PARAMETERS_NAME sex_outcols.txt -STARNNW_NAME default_nnw.txt -c wisesex_params.txt -WEIGHT_GAIN N,N -CATALOG_NAME " +
-        sample + '-' + light_id[:-5] +
-        "-sex-cat.txt -DEBLEND_NTHRESH 32 -DEBLEND_MINCONT 0.0001 -BACK_SIZE 130")
-
-os.system(
-    "cd " +
-    sextractor_params +
-    " && mv *-cat.txt ../" +
-    sextractor_output)
-os.system("cd " + sextractor_params + " && mv *.fits ../" + sextractor_output)
-
-print("Finished. Catalog created at " + sextractor_output + " folder.")
-print("---------------------")
+sextractor_binary = 'sex'
+sextractor_config = 'wisesex_params.txt'
+sextractor_columns = 'sex_outcols.txt'
+sextractor_nnw = 'default_nnw.txt'
+sextractor_filter = 'default.conv'
+sextractor_overrides = ['-WEIGHT_GAIN', 'N,N',
+                        '-DEBLEND_NTHRESH', '32',
+                        '-DEBLEND_MINCONT', '0.0001',
+                        '-BACK_SIZE', '130']
+
+
+def _config(name):
+    return os.path.abspath(os.path.join(sextractor_params, name))
+
+
+def catalogPath(sample, light_id, catalog_type=default_catalog_type):
+    return (sextractor_output + "/" + sample + '-' + light_id[:-5] + "-sex-cat" +
+            catalog_types[catalog_type][1])
+
+
+def checkImagePath(sample, light_id):
+    return sextractor_output + "/" + sample + '-' + light_id[:-5] + "-check.fits"
+
+
+def sextractorCommand(image, catalog, checkimage=None, weight=None, catalog_type=default_catalog_type):
+    """Build the sex command line for one image, with every path absolute so it can run
+       from any working directory. weight: optional MAP_WEIGHT image (0 marks bad pixels).
+       catalog_type: 'fits' for a FITS_1.0 binary table, 'ascii' for an ASCII_HEAD text catalog.
+    """
+    cmd = [sextractor_binary, os.path.abspath(image),
+           '-c', _config(sextractor_config),
+           '-PARAMETERS_NAME', _config(sextractor_columns),
+           '-STARNNW_NAME', _config(sextractor_nnw),
+           '-FILTER_NAME', _config(sextractor_filter),
+           '-CATALOG_NAME', os.path.abspath(catalog),
+           '-CATALOG_TYPE', catalog_types[catalog_type][0]]
+    if checkimage is None:
+        cmd += ['-CHECKIMAGE_TYPE', 'NONE']
+    else:
+        cmd += ['-CHECKIMAGE_NAME', os.path.abspath(checkimage)]
+    if weight is not None:
+        cmd += ['-WEIGHT_TYPE', 'MAP_WEIGHT', '-WEIGHT_IMAGE', os.path.abspath(weight)]
+    return cmd + sextractor_overrides
+
+
+def runSextractor(image, catalog, checkimage=None, weight=None):
+    """Run SExtractor on one image, writing its catalog (and optional check image) straight into
+       the output folder. The catalog only appears under its final name if sex succeeded.
+
+       Returns (return code, elapsed seconds, stderr). A sex binary that is missing or cannot be
+       run is reported as return code 127, as a shell would, with the error as stderr.
+    """
+    tmp_catalog = catalog + '.part'
+    start = time.time()
+    catalog_type = 'fits' if isBinary(catalog) else 'ascii'
+    try:
+        result = subprocess.run(sextractorCommand(image, tmp_catalog, checkimage, weight, catalog_type),
+                                cwd=os.path.dirname(os.path.abspath(catalog)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+    except OSError as e:
+        return 127, time.time() - start, '%s: %s' % (type(e).__name__, e)
+    elapsed = time.time() - start
+    if result.returncode == 0 and os.path.exists(tmp_catalog):
+        os.replace(tmp_catalog, catalog)
+    elif os.path.exists(tmp_catalog):
+        os.remove(tmp_catalog)
+    return result.returncode, elapsed, result.stderr
+
+
+def findProcessedImages(volumes=None, samples=None):
+    """List (sample, light_id, path) for every processed image awaiting extraction, optionally
+       only for nights of the given volumes or the given nights.
+    """
+    images = []
+    if not os.path.isdir(processed_volume):
+        return images
+    for sample in sorted(next(os.walk(processed_volume))[1]):
+        if sample.startswith('_') or (samples is not None and sample not in samples):
+            continue
+        if volumes and instrumentOf(sample, volumes) is None:
+            continue
+        for light_id in sorted(next(os.walk(processed_volume + '/' + sample))[2]):
+            if light_id.endswith('.fits'):
+                images.append((sample, light_id, processed_volume + "/" + sample + "/" + light_id))
+    return images
+
+
+def catalogImages(conn, volumes=None):
+    """List (sample, light_id, path) for every processed image registered in the metadata catalog,
+       optionally only for nights of the given volumes.
+    """
+    return [(row['night'], os.path.basename(row['product']), row['product'])
+            for row in neat_catalog.products(conn, 'calibrate')
+            if not volumes or row['volume'] in volumes]
+
+
+def processedImages(conn=None, volumes=None):
+    """List (sample, light_id, path) for every processed image: those registered in the metadata
+       catalog conn, if given, plus any on disk it does not know of (e.g. calibrated before it
+       was built).
+    """
+    images = catalogImages(conn, volumes) if conn is not None else []
+    known = set(path for _, _, path in images)
+    return images + [image for image in findProcessedImages(volumes) if image[2] not in known]
+
+
+def runSep(image, catalog, checkimage=None, weight=None):
+    # sep is only required when this backend is selected
+    import sep_backend
+    return sep_backend.runSep(image, catalog, checkimage, weight)
+
+
+# Extraction backends: the runner and the executor type suited to it. sex jobs are external
+# processes, so threads suffice; sep runs in-process and needs worker processes to scale.
+backends = {'sex': (runSextractor, concurrent.futures.ThreadPoolExecutor),
+            'sep': (runSep, concurrent.futures.ProcessPoolExecutor)}
+
+
+def extractAll(images, workers=None, check_images=False, backend='sex', conn=None,
+               catalog_type=default_catalog_type):
+    """Run source extraction over the given images on a bounded pool, skipping those whose
+       catalog the manifest shows as current. The bad-pixel weight map of the flat each image
+       was calibrated with, when built, is passed to the extractor. Catalogs are registered in the metadata catalog
+       conn, if given. catalog_type selects binary FITS or ASCII catalogs.
+       Returns status counts and per-image timings.
+    """
+    # Catalogs written before the binary format existed were ASCII and carry no type
+    type_field = None if catalog_type == 'ascii' else catalog_type
+    os.makedirs(sextractor_output, exist_ok=True)
+    manifest = Manifest()
+    counts = {'done': 0, 'failed': 0, 'current': 0}
+    timings = []
+    runner, executor = backends[backend]
+    with executor(max_workers=workers or os.cpu_count()) as pool:
+        futures = dict()
+        for sample, light_id, path in images:
+            if manifest.isCurrent('extract', path, catalog_type=type_field):
+                counts['current'] += 1
+                continue
+            catalog = catalogPath(sample, light_id, catalog_type)
+            checkimage = checkImagePath(sample, light_id) if check_images else None
+            try:
+                with fits.open(path, memmap=True) as hdul:
+                    weight = frameWeightPath(sample, imageHDU(hdul).header)
+            except Exception as e:
+                counts['failed'] += 1
+                metrics.count('frames_failed')
+                message = 'reading header %s: %s' % (type(e).__name__, e)
+                manifest.record('extract', path, 'failed', message=message)
+                print("Error extracting " + path + ": " + message)
+                continue
+            weight = weight if os.path.exists(weight) else None
+            futures[pool.submit(runner, path, catalog, checkimage, weight)] = (path, catalog)
+        print("Extracting sources from " + str(len(futures)) + " images...")
+        for future in concurrent.futures.as_completed(futures):
+            path, catalog = futures[future]
+            try:
+                returncode, elapsed, stderr = future.result()
+            except Exception as e:
+                # e.g. a sep worker process that died
+                returncode, elapsed, stderr = 1, 0.0, '%s: %s' % (type(e).__name__, e)
+            timings.append(elapsed)
+            metrics.observe('extract_' + backend, elapsed)
+            if returncode == 0 and os.path.exists(catalog):
+                counts['done'] += 1
+                metrics.count('frames_extracted')
+                metrics.count('sources', countRows(catalog))
+                manifest.record('extract', path, 'done', output=catalog, seconds=elapsed,
+                                backend=backend, catalog_type=type_field)
+                source = neat_catalog.frameOfProduct(conn, path) if conn is not None else None
+                if source is not None:
+                    neat_catalog.addProduct(conn, source['path'], 'extract', catalog)
+                print("Catalog " + catalog + " created in " + ('%.1f' % elapsed) + "s.")
+            else:
+                counts['failed'] += 1
+                metrics.count('frames_failed')
+                message = backend + ' exit status ' + str(returncode) + ': ' + stderr.strip()[-500:]
+                manifest.record('extract', path, 'failed', seconds=elapsed, message=message)
+                print("Error extracting " + path + ": " + message)
+    return counts, timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run SExtractor over every processed NEAT image.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of concurrent extraction jobs")
+    parser.add_argument('--backend', choices=sorted(backends), default='sex',
+                        help="extract with the sex binary or in-process with sep")
+    parser.add_argument('--check-images', action='store_true',
+                        help="also write a per-image check image next to each catalog")
+    parser.add_argument('--catalog-type', choices=sorted(catalog_types), default=default_catalog_type,
+                        help="write binary FITS (default) or ASCII text catalogs")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to read processed images from, if it exists")
+    parser.add_argument('--volume', action='append', choices=sorted(instruments), dest='volumes',
+                        help="only extract nights of this volume, may be repeated (default: all)")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+
+    conn = neat_catalog.connect(args.catalog) if os.path.exists(args.catalog) else None
+    images = processedImages(conn, args.volumes)
+    counts, timings = extractAll(images, args.workers, args.check_images, args.backend, conn,
+                                 args.catalog_type)
+    print("Finished. Catalogs created at " + sextractor_output + " folder: " + str(counts['done']) +
+          " extracted, " + str(counts['failed']) + " failed, " + str(counts['current']) +
+          " already up to date.")
+    if timings:
+        print("Per-image time: mean " + ('%.2f' % np.mean(timings)) + "s, max " +
+              ('%.2f' % np.max(timings)) + "s, total " + ('%.1f' % np.sum(timings)) + "s.")
+    metrics.report(args)
+    print("---------------------")
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
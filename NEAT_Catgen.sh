@@ -1,5 +1,6 @@
 #!/bin/bash
 
-python FITS_Processor.py
-python FITS_Sextraction.py
-
+# Calibrate and extract the nights already downloaded, streamed one night at a time, offline as
+# before. Run NEAT_Pipeline.py directly to also download nights, fit PS1 zero points and delete
+# intermediates.
+exec python NEAT_Pipeline.py --no-download --no-zeropoint --keep-intermediates "$@"
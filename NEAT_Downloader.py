@@ -1,10 +1,19 @@
+from astropy.io import fits
 from bs4 import BeautifulSoup
-import urllib.request as urllib2
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib.parse
+import concurrent.futures
+import argparse
+import hashlib
+import json
+import time
 import requests
-import subprocess
+import metrics
 import threading
 import re
 import os
+import sys
 
 NEAT_vol_1 = 'https://sbnarchive.psi.edu/pds3/neat/geodss/data/'
 NEAT_vol_1_folder = "geodss"
@@ -13,15 +22,133 @@ NEAT_vol_2_folder = "tricam"
 NEAT_vol_3 = 'https://sbnarchive.psi.edu/pds3/neat/tricam2/data/'
 NEAT_vol_3_folder = "tricam2"
 
+NEAT_volumes = {NEAT_vol_1_folder: NEAT_vol_1,
+                NEAT_vol_2_folder: NEAT_vol_2,
+                NEAT_vol_3_folder: NEAT_vol_3}
 
-def pullVolumeData(url, ext=''):
-    page = requests.get(url).text
+# Leading URL path components dropped when mirroring locally, as wget --cut-dirs=2 did
+cut_dirs = 2
+chunk_size = 1 << 20
+default_workers = 8
+
+# On-disk cache of directory listings, keyed by URL
+listing_cache = '.listing_cache'
+# Listings served without ETag/Last-Modified are trusted for this long (seconds)
+listing_max_age = 24 * 3600
+
+fpack_ext = '.fz'
+default_unpack_workers = 4
+
+
+def makeSession(workers=default_workers):
+    """A keep-alive session whose connection pool is sized for the download workers,
+       retrying transient server errors with backoff.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _cachePath(url, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+
+def _parseListing(url, page):
+    """Split the links of an HTML directory index into subdirectory and file URLs,
+       ignoring sort links and anything outside the directory (e.g. the parent link).
+    """
+    dirs = []
+    files = []
     soup = BeautifulSoup(page, 'html.parser')
-    links = [
-        url +
-        '/' +
-        node.get('href') for node in soup.find_all('a') if node.get('href').endswith(ext)]
-    return links[5:-2]
+    for node in soup.find_all('a'):
+        href = node.get('href')
+        if not href or '?' in href or href.startswith('#'):
+            continue
+        link = urllib.parse.urljoin(url, href)
+        if not link.startswith(url) or link == url:
+            continue
+        if link.endswith('/'):
+            dirs.append(link)
+        else:
+            files.append(link)
+    return dirs, files
+
+
+@metrics.timed('list_directory')
+def listDirectory(url, session=None, cache_dir=listing_cache, max_age=listing_max_age):
+    """List a directory of the archive, revalidating a cached listing with ETag/Last-Modified
+       so unchanged directories cost a 304 instead of a full page.
+
+       Returns (subdirectory URLs, file URLs).
+    """
+    url = url.replace(" ", "%20")
+    if not url.endswith('/'):
+        url += '/'
+    session = session or requests
+    cache_file = _cachePath(url, cache_dir)
+    cached = None
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        if not headers and time.time() - cached['fetched'] < max_age:
+            metrics.count('listings_cached')
+            return cached['dirs'], cached['files']
+
+    r = session.get(url, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        metrics.count('listings_cached')
+        return cached['dirs'], cached['files']
+    r.raise_for_status()
+    metrics.count('listings_fetched')
+    metrics.count('listing_bytes', len(r.content))
+
+    dirs, files = _parseListing(url, r.content)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + '.tmp.' + str(threading.get_ident())
+    with open(tmp_file, 'w') as f:
+        json.dump({'url': url,
+                   'etag': r.headers.get('ETag'),
+                   'last_modified': r.headers.get('Last-Modified'),
+                   'fetched': time.time(),
+                   'dirs': dirs,
+                   'files': files}, f)
+    os.replace(tmp_file, cache_file)
+    return dirs, files
+
+
+@metrics.timed('crawl')
+def crawl(url, session=None, workers=default_workers, cache_dir=listing_cache):
+    """Recursively list every file below url, fetching sibling directories concurrently
+       on at most `workers` connections. Returns the sorted file URLs.
+    """
+    files = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(listDirectory, url, session, cache_dir)}
+        while pending:
+            finished, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                subdirs, subfiles = future.result()
+                files.extend(subfiles)
+                for d in subdirs:
+                    pending.add(pool.submit(listDirectory, d, session, cache_dir))
+    return sorted(files)
+
+
+def pullVolumeData(url, ext='', session=None, cache_dir=listing_cache):
+    """List the records (night directories) of a volume, in index order."""
+    dirs, _ = listDirectory(url, session, cache_dir)
+    return [d for d in dirs if d.rstrip('/').endswith(ext)]
 
 
 def getRecordsFromVolumeData(data, _idx):
@@ -34,49 +161,239 @@ def getRecordsFromVolumeData(data, _idx):
         return x
 
 
-def read_url(url, rL):
-    url = url.replace(" ", "%20")
-    req = urllib2.Request(url)
-    a = urllib2.urlopen(req).read()
-    soup = BeautifulSoup(a, 'html.parser')
-    x = (soup.find_all('a'))
-    for i in x:
-        file_name = i.extract().get_text()
-        url_new = url + file_name
-        url_new = url_new.replace(" ", "%20")
-        if(file_name[-1] == '/' and file_name[0] != '.'):
-            read_url(url_new, rL)
-        rL.append(url_new)
+def read_url(url, rL, session=None):
+    """Append the URL of every file below url to rL."""
+    rL.extend(crawl(url, session))
 
 
 def getRecordID(record):
     return record.split('/')[-2]
 
 
-def fetchRecord(record, verbose=False):
-    file_idx = 0
-    recordData = []
-    read_url(record, recordData)
-    print("Fetching record " + getRecordID(record) + "...")
-    # print("wget -r -nH -nc --cut-dirs=2 --no-parent --reject=\"index.html*\" " + str(record))
-    os.system(
-        "wget -r -nH -nc --cut-dirs=2 --no-parent --reject=\"index.html*\" " +
-        str(record))
-    if(verbose):
-        print("Completed fetching record " + getRecordID(record) + "\r")
-    else:
-        print("Completed fetching record " + getRecordID(record))
-    print("Unpacking...")
-    subprocess.call("sh f.sh", shell=True)
+def isDataFile(url):
+    """Filter crawled file URLs down to the files wget would have kept."""
+    name = url.rstrip('/').split('/')[-1]
+    return (not url.endswith('/') and
+            '.' in name and
+            '?' not in name and
+            not name.startswith('index.html'))
+
+
+def localPath(url):
+    """Map a remote file URL to its mirrored location, dropping the host and leading directories."""
+    parts = [p for p in urllib.parse.unquote(urllib.parse.urlparse(url).path).split('/') if p]
+    return os.path.join(*parts[cut_dirs:])
+
+
+@metrics.timed('download')
+def _removeIfExists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _validator(response):
+    """The strong ETag or Last-Modified date of a response, usable as an If-Range condition."""
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _remoteSize(response):
+    """Total size of the remote file from a 416 or 206 Content-Range, or None if not given."""
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def downloadFile(session, url, dest=None):
+    """Download a single file, resuming a partial download with an HTTP Range request.
+       A complete local copy is only replaced when the server reports a different size; it is
+       left alone when the size cannot be checked. A partial download is resumed with If-Range
+       against the ETag or Last-Modified date it was started with, so the server sends the whole
+       file again if it changed since.
+
+       Returns (status, bytes transferred) with status one of 'done', 'skipped' or 'failed'.
+    """
+    if dest is None:
+        dest = localPath(url)
+    part = dest + '.part'
+    part_validator = part + '.validator'
+
+    if os.path.exists(dest):
+        head = session.head(url, allow_redirects=True)
+        remote_size = head.headers.get('Content-Length')
+        if not head.ok or remote_size is None or int(remote_size) == os.path.getsize(dest):
+            return 'skipped', 0
+        # Size mismatch: the server copy changed, so start over rather than resume
+        os.remove(dest)
+
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = dict()
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+        if os.path.exists(part_validator):
+            with open(part_validator) as f:
+                headers['If-Range'] = f.read()
+
+    transferred = 0
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 416:
+            # Nothing left past our offset: complete only if it is as long as the server copy
+            remote_size = _remoteSize(r)
+            if remote_size is None:
+                head = session.head(url, allow_redirects=True)
+                remote_size = head.headers.get('Content-Length') if head.ok else None
+            if remote_size is not None and int(remote_size) == offset:
+                os.replace(part, dest)
+                _removeIfExists(part_validator)
+                return 'done', 0
+            os.remove(part)
+            _removeIfExists(part_validator)
+            return downloadFile(session, url, dest)
+        r.raise_for_status()
+        mode = 'ab' if r.status_code == 206 else 'wb'
+        if mode == 'wb':
+            validator = _validator(r)
+            if validator is not None:
+                with open(part_validator, 'w') as f:
+                    f.write(validator)
+            else:
+                _removeIfExists(part_validator)
+        with open(part, mode) as f:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                transferred += len(chunk)
+    os.replace(part, dest)
+    _removeIfExists(part_validator)
+    return 'done', transferred
+
+
+def _downloadTask(session, url):
+    try:
+        return url, downloadFile(session, url)
+    except Exception as e:
+        return url, ('failed', str(e))
+
+
+@metrics.timed('funpack')
+def unpackFile(path):
+    """Decompress a tile-compressed (fpack) FITS file in-process, writing it next to the input
+       without the .fz extension as funpack did. Up-to-date outputs are left alone.
+
+       Returns the uncompressed path, or None if nothing needed unpacking.
+    """
+    out_path = path[:-len(fpack_ext)]
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return None
+
+    # fpack marks a compressed primary image with ZSIMPLE, which only the stored binary table
+    # header shows
+    with fits.open(path, disable_image_compression=True) as raw:
+        compressed_primary = len(raw) > 1 and bool(raw[1].header.get('ZSIMPLE', False))
+
+    hdus = fits.HDUList()
+    with fits.open(path) as hdul:
+        for idx, hdu in enumerate(hdul):
+            if isinstance(hdu, fits.CompImageHDU):
+                header = hdu.header.copy()
+                if idx == 1 and compressed_primary and hdus[0].data is None:
+                    # fpack moved the primary image into the first extension: move it back
+                    for key in ('XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME'):
+                        header.remove(key, ignore_missing=True)
+                    hdus[0] = fits.PrimaryHDU(data=hdu.data, header=header)
+                else:
+                    hdus.append(fits.ImageHDU(data=hdu.data, header=header))
+            else:
+                hdus.append(hdu.copy())
+        tmp_path = out_path + '.tmp'
+        hdus.writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+    metrics.count('frames_unpacked')
+    return out_path
+
+
+def _unpackTask(path):
+    try:
+        unpackFile(path)
+        return path, None
+    except Exception as e:
+        return path, str(e)
+
+
+def fetchRecord(record, pool, session):
+    """Queue every data file of a record on the download pool; returns the submitted futures."""
+    files = [x for x in crawl(record, session) if isDataFile(x)]
+    print("Fetching record " + getRecordID(record) + " (" + str(len(files)) + " files)...")
+    return [pool.submit(_downloadTask, session, url) for url in files]
+
+
+def fetchRecords(data, workers=default_workers, verbose=False,
+                 unpack=True, unpack_workers=default_unpack_workers):
+    """Download a list of records over a bounded pool of workers sharing one session.
+       With unpack, every .fz file is decompressed on a separate bounded pool as soon as it
+       lands, so downloading and unpacking overlap.
+       Returns a dictionary of status counts and bytes transferred.
+    """
+    session = makeSession(workers)
+    counts = {'done': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'unpack_failed': 0}
+    unpacks = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=unpack_workers) as unpack_pool:
+        futures = []
+        for record in data:
+            futures.extend(fetchRecord(record, pool, session))
+        for future in concurrent.futures.as_completed(futures):
+            url, (status, info) = future.result()
+            counts[status] += 1
+            metrics.count('files_' + status)
+            if status == 'failed':
+                print("Error fetching " + url + ": " + info)
+                continue
+            counts['bytes'] += info
+            metrics.count('download_bytes', info)
+            if verbose:
+                print(status.capitalize() + " " + url)
+            if unpack and url.endswith(fpack_ext):
+                unpacks.append(unpack_pool.submit(_unpackTask, localPath(url)))
+        for future in concurrent.futures.as_completed(unpacks):
+            path, error = future.result()
+            if error is not None:
+                counts['unpack_failed'] += 1
+                print("Error unpacking " + path + ": " + error)
     print("Done!")
+    return counts
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mirror NEAT records from the PDS Small Bodies Node.")
+    parser.add_argument('--volume', choices=sorted(NEAT_volumes), default=NEAT_vol_2_folder,
+                        help="NEAT volume to pull records from")
+    parser.add_argument('--workers', type=int, default=default_workers,
+                        help="number of concurrent downloads")
+    parser.add_argument('--unpack-workers', type=int, default=default_unpack_workers,
+                        help="number of concurrent .fz decompressions")
+    parser.add_argument('--no-unpack', action='store_true',
+                        help="leave downloaded .fz files compressed")
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('records', nargs='*', type=int, default=[10],
+                        help="indexes of the records to fetch within the volume")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
 
-def fetchRecords(data):
-    for record in data:
-        t = threading.Thread(target=fetchRecord, args=(record, False))
-        t.start()
+    volume_data = pullVolumeData(NEAT_volumes[args.volume], session=makeSession(args.workers))
+    records = getRecordsFromVolumeData(volume_data, args.records)
+    counts = fetchRecords(records, args.workers, args.verbose,
+                          not args.no_unpack, args.unpack_workers)
+    print(str(counts['done']) + " downloaded, " + str(counts['skipped']) + " already present, " +
+          str(counts['failed']) + " failed (" + str(counts['bytes']) + " bytes), " +
+          str(counts['unpack_failed']) + " failed to unpack.")
+    metrics.report(args)
+    return 1 if counts['failed'] or counts['unpack_failed'] else 0
 
 
-NEAT_vol_2_data = pullVolumeData(NEAT_vol_2)
-palomar = getRecordsFromVolumeData(NEAT_vol_2_data, 10)
-fetchRecords(palomar)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,427 @@
+from zeropoint import writeZeropoints, loadZeropoints, zeropoint_table
+from instruments import instruments, nightPath, findNights, checkUniqueNights
+from PS1_Comparison import referenceCache, frameZeropoints, catalogLabels
+import NEAT_Downloader
+import FITS_Processor
+import FITS_Sextraction
+import FITS_Astrometry
+import neat_catalog
+import linker
+import metrics
+import concurrent.futures
+import threading
+import argparse
+import shutil
+import queue
+import glob
+import json
+import time
+import os
+import sys
+
+processed_volume = 'preprocessed'
+pipeline_log = processed_volume + '/pipeline.jsonl'
+
+stage_order = ['download', 'calibrate', 'extract', 'wcs', 'zeropoint', 'link']
+
+# Nights each stage works on at once. Every stage also runs its frames in parallel inside a
+# night (download_workers, workers, ...), so one night at a time keeps most machines busy.
+default_slots = {'download': 2, 'calibrate': 1, 'extract': 1, 'wcs': 1, 'zeropoint': 1, 'link': 1}
+# Nights waiting between two stages
+default_queue_size = 1
+
+
+def _removeFiles(paths):
+    freed = 0
+    for path in paths:
+        try:
+            freed += os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+    return freed
+
+
+def _removeTree(path):
+    freed = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                freed += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    shutil.rmtree(path, ignore_errors=True)
+    return freed
+
+
+class PipelineLog(object):
+    """JSON-lines record of each night's last pipeline run, so finished nights are not fetched
+       and processed again after their intermediates were deleted.
+    """
+
+    def __init__(self, path=pipeline_log):
+        self.path = path
+        self.lock = threading.Lock()
+        self.nights = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.nights[entry['night']] = entry
+
+    def isDone(self, night, stages=None):
+        """True if the night's last run finished and covered every given stage but download."""
+        entry = self.nights.get(night)
+        if entry is None or entry['status'] != 'done':
+            return False
+        return all(s in entry['stages'] for s in stages or [] if s != 'download')
+
+    def record(self, job):
+        entry = {'night': job['night'], 'instrument': job['instrument'], 'status': job['status'],
+                 'stages': job['stages'], 'counts': job['counts'], 'freed': job['freed'],
+                 'message': job['message'], 'time': time.time()}
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.nights[job['night']] = entry
+
+
+class NightPipeline(object):
+    """Stream nights through download and unpack, calibration, extraction, optionally a WCS
+       fit, zero points against PS1 and optionally moving-object linking.
+
+       Each stage is a few threads taking nights from a bounded queue, so early nights are
+       calibrated while later ones are still downloading, and a slow stage holds back the ones
+       before it instead of letting downloads pile up on disk. Once the stages that read them
+       are done, a night's downloaded raw frames and then its processed frames are deleted; its
+       labels, catalogs, WCS index, zero points and tracklets are kept. Every night is
+       calibrated on one process pool, started with the first night and kept until run returns.
+
+       stages: names from stage_order to run, in that order
+       slots: stage -> nights worked on at once
+       queue_size: nights waiting between two stages
+       keep: keep raw and processed frames instead of deleting them once consumed
+       The other options are passed on to the stage functions of the pipeline scripts.
+    """
+
+    def __init__(self, stages, slots=None, queue_size=default_queue_size, keep=False,
+                 download_workers=NEAT_Downloader.default_workers,
+                 unpack_workers=NEAT_Downloader.default_unpack_workers, workers=None,
+                 use_masters=True, chunked=False, compress=False, backend='sex', catalog=None,
+                 catalog_type=FITS_Sextraction.default_catalog_type, color_term=False, sigma=3.0,
+                 zeropoints=zeropoint_table, log=None):
+        self.stages = stages
+        self.slots = dict(default_slots, **(slots or {}))
+        self.queue_size = queue_size
+        self.keep = keep
+        self.download_workers = download_workers
+        self.unpack_workers = unpack_workers
+        self.workers = workers or os.cpu_count()
+        self.use_masters = use_masters
+        self.chunked = chunked
+        self.compress = compress
+        self.backend = backend
+        self.catalog = catalog
+        self.catalog_type = catalog_type
+        self.color_term = color_term
+        self.sigma = sigma
+        self.zeropoints = zeropoints
+        self.log = log or PipelineLog()
+        self._cache = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._zeropoint_rows = None
+
+    def connection(self):
+        # Opened per call: stages run on different threads
+        return neat_catalog.connect(self.catalog) if self.catalog is not None else None
+
+    def referenceCache(self):
+        with self._lock:
+            if self._cache is None:
+                self._cache = referenceCache()
+            return self._cache
+
+    def calibrationPool(self):
+        """The worker processes every night is calibrated on, started with the first night."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=FITS_Processor.useCatalog,
+                    initargs=(self.catalog,))
+            return self._pool
+
+    def _dropPool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def stageDownload(self, job):
+        counts = NEAT_Downloader.fetchRecords([job['record']], self.download_workers,
+                                              unpack=True, unpack_workers=self.unpack_workers)
+        if counts['failed'] or counts['unpack_failed']:
+            raise RuntimeError(str(counts['failed']) + " downloads and " +
+                               str(counts['unpack_failed']) + " unpacks failed")
+        if not self.keep:
+            # The unpacked frames replace the fpack files
+            packed = glob.glob(nightPath(job['night'], job['instrument']) + '/*/*' +
+                               NEAT_Downloader.fpack_ext)
+            job['freed'] += _removeFiles([p for p in packed
+                                          if os.path.exists(p[:-len(NEAT_Downloader.fpack_ext)])])
+        return {'files': counts['done'] + counts['skipped'], 'bytes': counts['bytes']}
+
+    def stageCalibrate(self, job):
+        conn = self.connection()
+        if conn is not None:
+            neat_catalog.scan(conn, [instruments[job['instrument']]['volume']], [job['night']])
+        pool = self.calibrationPool()
+        try:
+            counts = FITS_Processor.processVolume([(job['instrument'], job['night'])], self.workers,
+                                                  self.use_masters, False, self.catalog,
+                                                  self.chunked, self.compress, pool=pool)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died: later nights get a fresh pool
+            self._dropPool(pool)
+            raise
+        if counts['failed']:
+            job['partial'] = True
+        elif not self.keep and 'download' in self.stages:
+            # Only frames this run downloaded. Labels stay: later stages read frame times and
+            # pointings from them
+            job['freed'] += _removeFiles(glob.glob(nightPath(job['night'], job['instrument']) +
+                                                   '/*/*.fit'))
+        return counts
+
+    def stageExtract(self, job):
+        images = FITS_Sextraction.findProcessedImages(samples=[job['night']])
+        counts, _ = FITS_Sextraction.extractAll(images, self.workers, False, self.backend,
+                                                self.connection(), self.catalog_type)
+        if counts['failed']:
+            job['partial'] = True
+        return counts
+
+    def stageWcs(self, job):
+        images = FITS_Sextraction.findProcessedImages(samples=[job['night']])
+        counts = FITS_Astrometry.solveAll(images, self.referenceCache(), workers=self.workers,
+                                          conn=self.connection())
+        return counts
+
+    def stageZeropoint(self, job):
+        labels = catalogLabels(self.catalog or neat_catalog.catalog_path, job['night'])
+        rows, failed = frameZeropoints(labels, self.referenceCache(), self.color_term, self.sigma)
+        if failed:
+            job['partial'] = True
+        with self._lock:
+            if self._zeropoint_rows is None:
+                self._zeropoint_rows = []
+                if os.path.exists(self.zeropoints):
+                    self._zeropoint_rows = [{k: row[k] for k in row.colnames}
+                                            for row in loadZeropoints(self.zeropoints)]
+            self._zeropoint_rows = [r for r in self._zeropoint_rows
+                                    if str(r['night']) != job['night']] + rows
+            writeZeropoints(self._zeropoint_rows, self.zeropoints)
+        return {'frames': len(rows), 'failed': len(failed)}
+
+    def stageLink(self, job):
+        tracklets = linker.linkNight(job['night'], self.catalog or neat_catalog.catalog_path,
+                                     self.referenceCache())
+        return {'tracklets': 0 if tracklets is None else len(tracklets)}
+
+    def finish(self, job):
+        """Delete what is left of a finished night's intermediates and log the night."""
+        if job['message'] is None and not job['partial'] and not self.keep:
+            job['freed'] += _removeTree(processed_volume + '/' + job['night'])
+            job['freed'] += _removeTree(processed_volume + '/_calib/' + job['night'])
+        job['status'] = 'failed' if job['message'] is not None else \
+            'partial' if job['partial'] else 'done'
+        metrics.count('nights_' + job['status'])
+        metrics.count('freed_bytes', job['freed'])
+        self.log.record(job)
+        print("Night " + job['night'] + " " + job['status'] +
+              (": " + job['message'] if job['message'] else "") + " (" +
+              ', '.join('%s %.0fs' % (s, t) for s, t in job['stages'].items()) + ", " +
+              ('%.1f' % (job['freed'] / 1e9)) + " GB of intermediates freed).")
+
+    def _worker(self, stage, inbox, outbox, remaining):
+        function = getattr(self, 'stage' + stage.capitalize())
+        try:
+            while True:
+                job = inbox.get()
+                if job is None:
+                    break
+                try:
+                    if job['message'] is None:
+                        start = time.time()
+                        try:
+                            with metrics.timed('pipeline_' + stage):
+                                job['counts'][stage] = function(job)
+                        except Exception as e:
+                            job['message'] = '%s: %s: %s' % (stage, type(e).__name__, e)
+                        job['stages'][stage] = time.time() - start
+                    if outbox is None:
+                        self.finish(job)
+                    else:
+                        outbox.put(job)
+                except Exception as e:
+                    # e.g. finish() failing to log the night: the night fails, the worker goes on
+                    job['status'] = 'failed'
+                    job['message'] = job['message'] or '%s: %s: %s' % (stage, type(e).__name__, e)
+                    print("Night " + job['night'] + " failed: " + job['message'])
+        finally:
+            # The next stage's workers wait for one end marker each, whatever happened here
+            with self._lock:
+                remaining[stage] -= 1
+                last = remaining[stage] == 0
+            if last and outbox is not None:
+                for _ in range(self.slots[self.stages[self.stages.index(stage) + 1]]):
+                    outbox.put(None)
+
+    def run(self, jobs):
+        """Push the jobs (dictionaries with instrument, night and, to download it, record)
+           through the stages and return them once every night is finished.
+        """
+        jobs = [dict(job, counts={}, stages={}, message=None, partial=False, freed=0, status=None)
+                for job in jobs]
+        # The first queue is fed up front; the queues between stages are bounded
+        inboxes = [queue.Queue()] + [queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]]
+        remaining = {stage: self.slots[stage] for stage in self.stages}
+        threads = []
+        for i, stage in enumerate(self.stages):
+            outbox = inboxes[i + 1] if i + 1 < len(self.stages) else None
+            for _ in range(self.slots[stage]):
+                thread = threading.Thread(target=self._worker, name=stage,
+                                          args=(stage, inboxes[i], outbox, remaining))
+                thread.start()
+                threads.append(thread)
+        for job in jobs:
+            inboxes[0].put(job)
+        for _ in range(self.slots[self.stages[0]]):
+            inboxes[0].put(None)
+        for thread in threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return jobs
+
+
+def remoteNights(volumes, records=None, nights=None):
+    """(instrument, night, record URL) jobs from the archive listings of the given volumes:
+       the records at the given indexes of each volume, or the named nights.
+    """
+    jobs = []
+    for instrument in volumes:
+        listing = NEAT_Downloader.pullVolumeData(NEAT_Downloader.NEAT_volumes[instrument])
+        if nights:
+            selected = [r for r in listing if NEAT_Downloader.getRecordID(r) in nights]
+        else:
+            selected = NEAT_Downloader.getRecordsFromVolumeData(listing, records or [])
+        jobs.extend({'instrument': instrument, 'night': NEAT_Downloader.getRecordID(r),
+                     'record': r} for r in selected)
+    checkUniqueNights([(job['instrument'], job['night']) for job in jobs])
+    return jobs
+
+
+def _parseSlots(values):
+    slots = dict()
+    for value in values:
+        stage, _, n = value.partition('=')
+        if stage not in stage_order or not n.isdigit() or int(n) < 1:
+            raise argparse.ArgumentTypeError("expected STAGE=N with STAGE one of " +
+                                             ', '.join(stage_order) + ", got " + value)
+        slots[stage] = int(n)
+    return slots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download, calibrate, extract and calibrate photometry of NEAT nights as one "
+                    "streaming pipeline.")
+    parser.add_argument('nights', nargs='*',
+                        help="nights to run (default: the --record indexes of each volume, or "
+                             "with --no-download every downloaded night)")
+    parser.add_argument('--volume', action='append', choices=sorted(instruments), dest='volumes',
+                        help="volume to take nights from, may be repeated (default: tricam)")
+    parser.add_argument('--record', type=int, action='append', dest='records',
+                        help="index of a record to fetch within each volume, may be repeated")
+    parser.add_argument('--no-download', action='store_true',
+                        help="run the nights already on disk instead of fetching them")
+    parser.add_argument('--wcs', action='store_true', help="also fit each frame's WCS against PS1")
+    parser.add_argument('--link', action='store_true', help="also link moving sources per night")
+    parser.add_argument('--no-zeropoint', action='store_true',
+                        help="skip the PS1 zero point stage, e.g. to run without network access")
+    parser.add_argument('--slots', action='append', default=[], metavar='STAGE=N',
+                        help="nights a stage works on at once, may be repeated (defaults: " +
+                             ', '.join('%s=%d' % kv for kv in sorted(default_slots.items())) + ")")
+    parser.add_argument('--queue-size', type=int, default=default_queue_size,
+                        help="nights allowed to wait between two stages")
+    parser.add_argument('--keep-intermediates', action='store_true',
+                        help="keep raw and processed frames instead of deleting them once consumed")
+    parser.add_argument('--force', action='store_true', help="rerun nights the log shows as done")
+    parser.add_argument('--download-workers', type=int, default=NEAT_Downloader.default_workers,
+                        help="concurrent downloads per night")
+    parser.add_argument('--unpack-workers', type=int, default=NEAT_Downloader.default_unpack_workers,
+                        help="concurrent .fz decompressions per night")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="calibration processes and extraction jobs per night")
+    parser.add_argument('--nearest', action='store_true',
+                        help="calibrate with the nearest single dark and flat instead of master frames")
+    parser.add_argument('--chunked', action='store_true',
+                        help="calibrate memory-mapped frames in float32 row blocks")
+    parser.add_argument('--compress', action='store_true',
+                        help="like --chunked, writing RICE tile-compressed frames (lossy: "
+                             "pixel values are quantised, to a fraction of the noise)")
+    parser.add_argument('--backend', choices=sorted(FITS_Sextraction.backends), default='sex',
+                        help="extract with the sex binary or in-process with sep")
+    parser.add_argument('--catalog-type', choices=sorted(FITS_Sextraction.catalog_types),
+                        default=FITS_Sextraction.default_catalog_type,
+                        help="write binary FITS (default) or ASCII text catalogs")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to register frames and products in, if it exists")
+    parser.add_argument('--color-term', action='store_true', help="also fit a g-r colour term")
+    parser.add_argument('--sigma', type=float, default=3.0,
+                        help="zero point outlier clipping threshold in robust standard deviations")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+    try:
+        slots = _parseSlots(args.slots)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    volumes = args.volumes or [NEAT_Downloader.NEAT_vol_2_folder]
+    if args.no_download:
+        jobs = [{'instrument': i, 'night': s} for i, s in findNights(volumes, args.nights)]
+    else:
+        jobs = remoteNights(volumes, args.records or [10], args.nights)
+    stages = [s for s in stage_order
+              if not (s == 'download' and args.no_download or s == 'wcs' and not args.wcs or
+                      s == 'zeropoint' and args.no_zeropoint or s == 'link' and not args.link)]
+    log = PipelineLog()
+    if not args.force:
+        done = [job['night'] for job in jobs if log.isDone(job['night'], stages)]
+        if done:
+            print("Skipping " + str(len(done)) + " nights already done: " + ', '.join(done) + ".")
+        jobs = [job for job in jobs if not log.isDone(job['night'], stages)]
+
+    pipeline = NightPipeline(stages, slots, args.queue_size, args.keep_intermediates,
+                             args.download_workers, args.unpack_workers, args.workers,
+                             not args.nearest, args.chunked or args.compress, args.compress,
+                             args.backend, args.catalog if os.path.exists(args.catalog) else None,
+                             args.catalog_type, args.color_term, args.sigma, log=log)
+    print("Running " + str(len(jobs)) + " nights through " + ' -> '.join(stages) + ".")
+    jobs = pipeline.run(jobs)
+    statuses = [job['status'] for job in jobs]
+    print("Finished. " + str(statuses.count('done')) + " nights done, " +
+          str(statuses.count('partial')) + " partial, " + str(statuses.count('failed')) + " failed.")
+    metrics.report(args)
+    return 1 if statuses.count('done') != len(statuses) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,16 +8,170 @@ import numpy as np
 import json
 import requests
 import math
-
-from lblparser import lbl_parse
+import time
+import asyncio
+import functools
+import threading
+import concurrent.futures
+import argparse
+
+from lblparser import label_index
 from urllib.parse import quote as urlencode
 from urllib.request import urlretrieve
+from requests.adapters import HTTPAdapter
+
+from scipy.spatial import cKDTree
+from ps1_cache import PS1TileCache, datasetKey, ps1_cache_dir, default_nside
+from zeropoint import solveZeropoint, writeZeropoints, zeropoint_table
+import neat_catalog
+import metrics
+from secatalog import readCatalog, match_columns, position_columns
+from instruments import instrumentOf, framePath
+from astrometry import footprintRadius, labelShape, frameSolution, solutionCone, applySolutions
+
+
+ps1_baseurl = "https://catalogs.mast.stsci.edu/api/v0.1/panstarrs"
+# Largest radius (degrees) the MAST PS1 cone search accepts
+ps1cone_max_radius = 0.5
+
+# Columns and constraints of the PS1 reference query for NEAT frames
+ps1_reference_columns = ['raMean', 'decMean', 'gMeanApMag', 'rMeanApMag', 'rMeanApMagErr',
+                         'gMeanApMagErr']
+ps1_reference_constraints = {'primaryDetection': 1, 'rMeanApMag.min': 15, 'rMeanApMag.max': 22}
+
+
+class PS1Client(object):
+    """Shared state for PS1/MAST queries: a pooled keep-alive session, table metadata memoized
+    per (table, release), retry with exponential backoff on 429 and 5xx responses, and a
+    bounded pool for sending many cone searches at once.
+
+    Parameters
+    ----------
+    max_workers (int): maximum number of concurrent requests
+    retries (int): attempts after the first one for a throttled or failed request
+    backoff (float): (seconds) delay before the first retry, doubled on each attempt
+    timeout (float): (seconds) per-request timeout
+    """
+
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_workers=8, retries=5, backoff=1.0, timeout=120):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._metadata = dict()
+        self._lock = threading.Lock()
+        self._metadata_lock = threading.Lock()
+        self._executor = None
+
+    @metrics.timed('mast_query')
+    def request(self, method, url, **kw):
+        """Send a request, retrying on throttling, server errors and dropped connections.
+        Honours a numeric Retry-After header.
+        """
+        kw.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                r = self.session.request(method, url, **kw)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if r.status_code not in self.retry_status or attempt == self.retries:
+                    metrics.count('mast_bytes', len(r.content))
+                    return r
+                retry_after = r.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+            metrics.count('mast_retries')
+            time.sleep(delay)
+
+    def get(self, url, **kw):
+        return self.request('GET', url, **kw)
+
+    def metadata(self, table="mean", release="dr1", baseurl=ps1_baseurl):
+        """Table metadata, fetched once per (table, release, baseurl)"""
+        key = (table, release, baseurl)
+        # Held across the fetch so concurrent first callers wait for a single request
+        with self._metadata_lock:
+            if key not in self._metadata:
+                self._metadata[key] = _fetchMetadata(self, table, release, baseurl)
+            return self._metadata[key]
+
+    def cone(self, ra, dec, radius, **kw):
+        return ps1cone(ra, dec, radius, client=self, **kw)
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def cone_many(self, cones, return_exceptions=False, **kw):
+        """Run many (ra, dec, radius) cone searches concurrently; results are in cone order.
+        With return_exceptions, a failed cone's exception takes its place instead of being raised,
+        so the other results are not lost.
+        """
+        futures = [self.executor.submit(self.cone, *c, **kw) for c in cones]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    async def cone_many_async(self, cones, return_exceptions=False, **kw):
+        """asyncio version of cone_many, for use inside an event loop"""
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.executor, functools.partial(self.cone, *c, **kw))
+                   for c in cones]
+        return await asyncio.gather(*futures, return_exceptions=return_exceptions)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+
+_default_client = None
 
-import http.client as httplib
+
+def defaultClient():
+    """The process-wide PS1Client used when none is passed explicitly"""
+    global _default_client
+    if _default_client is None:
+        _default_client = PS1Client()
+    return _default_client
+
+
+def ps1cone_many(cones, client=None, **kw):
+    """Do many cone searches of the PS1 catalog concurrently
+
+    Parameters
+    ----------
+    cones: list of (ra, dec, radius) tuples in degrees
+    client (PS1Client): client to use (None means the default client)
+    **kw: other parameters as for ps1cone
+
+    Returns a list of results in the order of cones
+    """
+    client = client or defaultClient()
+    return asyncio.run(client.cone_many_async(cones, **kw))
 
 
 def ps1cone(ra,dec,radius,table="mean",release="dr1",format="csv",columns=None,
-           baseurl="https://catalogs.mast.stsci.edu/api/v0.1/panstarrs", verbose=False,
+           baseurl=ps1_baseurl, verbose=False, client=None,
            **kw):
     """Do a cone search of the PS1 catalog
     
@@ -25,26 +179,32 @@ def ps1cone(ra,dec,radius,table="mean",release="dr1",format="csv",columns=None,
     ----------
     ra (float): (degrees) J2000 Right Ascension
     dec (float): (degrees) J2000 Declination
-    radius (float): (degrees) Search radius (<= 0.5 degrees)
+    radius (float): (degrees) Search radius, clamped to ps1cone_max_radius (0.5 degrees);
+                    use ps1cone_cached for larger cones
     table (string): mean, stack, or detection
     release (string): dr1 or dr2
     format: csv, votable, json
     columns: list of column names to include (None means use defaults)
     baseurl: base URL for the request
     verbose: print info about request
+    client (PS1Client): client to use (None means the default client)
     **kw: other parameters (e.g., 'nDetections.min':2)
     """
     
     data = kw.copy()
     data['ra'] = ra
     data['dec'] = dec
+    if radius > ps1cone_max_radius:
+        if verbose:
+            print("Cone radius " + ('%.3f' % radius) + " deg clamped to " + str(ps1cone_max_radius))
+        radius = ps1cone_max_radius
     data['radius'] = radius
     return ps1search(table=table,release=release,format=format,columns=columns,
-                    baseurl=baseurl, verbose=verbose, **data)
+                    baseurl=baseurl, verbose=verbose, client=client, **data)
 
 
 def ps1search(table="mean",release="dr1",format="csv",columns=None,
-           baseurl="https://catalogs.mast.stsci.edu/api/v0.1/panstarrs", verbose=False,
+           baseurl=ps1_baseurl, verbose=False, client=None,
            **kw):
     """Do a general search of the PS1 catalog (possibly without ra/dec/radius)
     
@@ -56,9 +216,11 @@ def ps1search(table="mean",release="dr1",format="csv",columns=None,
     columns: list of column names to include (None means use defaults)
     baseurl: base URL for the request
     verbose: print info about request
+    client (PS1Client): client to use (None means the default client)
     **kw: other parameters (e.g., 'nDetections.min':2).  Note this is required!
     """
     
+    client = client or defaultClient()
     data = kw.copy()
     if not data:
         raise ValueError("You must specify some parameters for search")
@@ -70,7 +232,7 @@ def ps1search(table="mean",release="dr1",format="csv",columns=None,
         # check that column values are legal
         # create a dictionary to speed this up
         dcols = {}
-        for col in ps1metadata(table,release)['name']:
+        for col in client.metadata(table,release,baseurl)['name']:
             dcols[col.lower()] = 1
         badcols = []
         for col in columns:
@@ -84,7 +246,7 @@ def ps1search(table="mean",release="dr1",format="csv",columns=None,
 
 # either get or post works
 #    r = requests.post(url, data=data)
-    r = requests.get(url, params=data)
+    r = client.get(url, params=data)
 
     if verbose:
         print(r.url)
@@ -95,6 +257,66 @@ def ps1search(table="mean",release="dr1",format="csv",columns=None,
         return r.text
 
 
+def _csvTable(text, columns=None):
+    """Parse a CSV search result, keeping the column layout even when no rows came back."""
+    lines = text.strip().splitlines()
+    if len(lines) > 1:
+        return ascii.read(text, format='csv')
+    names = lines[0].split(',') if lines else list(columns or [])
+    return Table(names=names, dtype=[float] * len(names))
+
+
+def ps1tilecache(table="mean",release="dr1",columns=None,
+           baseurl=ps1_baseurl, verbose=False, client=None,
+           cache_dir=ps1_cache_dir, nside=default_nside, **kw):
+    """Return the PS1TileCache holding the results of one kind of PS1 query
+
+    Parameters are as for ps1cone_cached. Missing tiles are fetched with ps1cone through
+    the client, concurrently when several are needed at once.
+    """
+
+    client = client or defaultClient()
+    if columns:
+        columns = list(columns)
+        for col in ('raMean', 'decMean'):
+            if col not in columns:
+                columns.append(col)
+    query = dict(table=table, release=release, format="csv", columns=columns,
+                 baseurl=baseurl, verbose=verbose)
+    query.update(kw)
+
+    def fetch(tile_ra, tile_dec, tile_radius):
+        return _csvTable(client.cone(tile_ra, tile_dec, tile_radius, **query), columns)
+
+    def fetch_many(cones):
+        return [text if isinstance(text, Exception) else _csvTable(text, columns)
+                for text in client.cone_many(cones, return_exceptions=True, **query)]
+
+    dataset = datasetKey(table=table, release=release, columns=columns, constraints=kw)
+    return PS1TileCache(fetch, dataset, cache_dir, nside, fetch_many)
+
+
+def ps1cone_cached(ra,dec,radius,table="mean",release="dr1",columns=None,
+           baseurl=ps1_baseurl, verbose=False, client=None,
+           cache_dir=ps1_cache_dir, nside=default_nside, offline=False, **kw):
+    """Cone search of the PS1 catalog served from the local HEALPix tile cache
+
+    Only the tiles covering the cone are read; tiles never fetched before are downloaded
+    once with ps1cone and kept, so overlapping pointings cost no further MAST queries.
+    Parameters are as for ps1cone, plus:
+
+    cache_dir: root directory of the tile cache
+    nside: HEALPix resolution of the tiles
+    offline: raise instead of querying MAST when a tile is missing
+
+    Returns an astropy Table (not CSV text)
+    """
+
+    cache = ps1tilecache(table=table, release=release, columns=columns, baseurl=baseurl,
+                         verbose=verbose, client=client, cache_dir=cache_dir, nside=nside, **kw)
+    return cache.cone(ra, dec, radius, offline)
+
+
 def checklegal(table,release):
     """Checks if this combination of table and release is acceptable
     
@@ -113,7 +335,7 @@ def checklegal(table,release):
 
 
 def ps1metadata(table="mean",release="dr1",
-           baseurl="https://catalogs.mast.stsci.edu/api/v0.1/panstarrs"):
+           baseurl=ps1_baseurl, client=None):
     """Return metadata for the specified catalog and table
     
     Parameters
@@ -121,13 +343,19 @@ def ps1metadata(table="mean",release="dr1",
     table (string): mean, stack, or detection
     release (string): dr1 or dr2
     baseurl: base URL for the request
+    client (PS1Client): client to use (None means the default client); the result is
+        memoized by the client
     
     Returns an astropy table with columns name, type, description
     """
     
+    return (client or defaultClient()).metadata(table, release, baseurl)
+
+
+def _fetchMetadata(client, table, release, baseurl):
     checklegal(table,release)
     url = "{baseurl}/{release}/{table}/metadata".format(**locals())
-    r = requests.get(url)
+    r = client.get(url)
     r.raise_for_status()
     v = r.json()
     # convert to astropy table
@@ -136,12 +364,13 @@ def ps1metadata(table="mean",release="dr1",
     return tab
 
 
-def mastQuery(request):
+def mastQuery(request, client=None):
     """Perform a MAST query.
 
     Parameters
     ----------
     request (dictionary): The MAST request json object
+    client (PS1Client): client whose pooled session is used (None means the default client)
 
     Returns head,content where head is the response HTTP headers, and content is the returned data
     """
@@ -160,19 +389,14 @@ def mastQuery(request):
     requestString = json.dumps(request)
     requestString = urlencode(requestString)
     
-    # opening the https connection
-    conn = httplib.HTTPSConnection(server)
-
-    # Making the query
-    conn.request("POST", "/api/v0/invoke", "request="+requestString, headers)
+    # Making the query over the client's pooled connection
+    client = client or defaultClient()
+    resp = client.request("POST", "https://" + server + "/api/v0/invoke",
+                          data="request="+requestString, headers=headers)
 
     # Getting the response
-    resp = conn.getresponse()
-    head = resp.getheaders()
-    content = resp.read().decode('utf-8')
-
-    # Close the https connection
-    conn.close()
+    head = list(resp.headers.items())
+    content = resp.content.decode('utf-8')
 
     return head,content
 
@@ -202,69 +426,238 @@ def resolve(name):
         raise ValueError("Unknown object '{}'".format(name))
     return (objRa, objDec)
 
-def getConeParams(lbl_filepath):
-    lab = lbl_parse(lbl_filepath)
-    world_ra = float(lab['RIGHT_ASCENSION'].partition('<')[0])
-    world_dec = float(lab['DECLINATION'].partition('<')[0])
-    hor_fov_arcsec = float(lab['HORIZONTAL_PIXEL_FOV'].partition('<')[0])
-    radius = 0.15
+def getConeParams(lbl_filepath, index=None):
+    """Cone around a frame's nominal pointing, with the radius of its footprint: the pixel
+       scale (HORIZONTAL_PIXEL_FOV) times the frame size. index is the label_index holding the
+       label, e.g. of a whole night; without it the label's directory is indexed.
+
+       For a full NEAT frame this is about 0.8 degrees, more than the 0.5 degrees MAST serves
+       in one cone: the tile cache (ps1cone_cached, referenceCache) covers it tile by tile,
+       while ps1cone clamps it to ps1cone_max_radius.
+    """
+    if index is None:
+        index = label_index([lbl_filepath])
+    if lbl_filepath not in index:
+        raise IOError("cannot read label " + lbl_filepath)
+    lab = index[lbl_filepath]
+    world_ra = float(lab['RA'])
+    world_dec = float(lab['DEC'])
+    hor_fov_arcsec = float(lab['HOR_PIXEL_FOV'])
+    if not np.isfinite([world_ra, world_dec, hor_fov_arcsec]).all():
+        raise ValueError("no pointing or pixel scale in label " + lbl_filepath)
+    radius = float(footprintRadius(labelShape(lab), hor_fov_arcsec))
     return (world_ra, world_dec, radius)
 
+
+def catalogFrame(catalog):
+    """(night, frame id) of an extracted catalog's file name."""
+    sample_dir = catalog.partition("-")
+    return sample_dir[0], sample_dir[2].partition("-sex-cat")[0]
+
+
+def frameCone(catalog, label, index=None):
+    """Cone of a frame's solved footprint if FITS_Astrometry solved it, else from its label
+       (looked up in index, see getConeParams).
+    """
+    solution = frameSolution(*catalogFrame(catalog))
+    if solution is not None:
+        return solutionCone(solution)
+    return getConeParams(label, index)
+
+
+def readFrameCatalog(path, columns=match_columns):
+    """Read an extracted catalog, with sky positions from the frame's solved WCS if it has one."""
+    table = readCatalog(path, list(columns) + position_columns)
+    night, frame = catalogFrame(os.path.basename(path))
+    applySolutions(table, night, [frame] * len(table))
+    return table
+
 def parseConeQuery(result):
-    if len(result) > 0:
+    """Turn a cone search result (CSV text, or a Table from the tile cache) into a sorted table
+       with missing magnitudes as NaN.
+    """
+    if isinstance(result, Table):
+        res_tab = result
+    elif len(result) > 0:
         res_tab = ascii.read(result)
+    else:
+        return Table()
+    if len(res_tab) > 0:
         res_tab.sort('rMeanApMag')
         for filter in 'gr':
             col = filter+'MeanApMag'
             try:
+                res_tab[col] = np.asarray(res_tab[col], dtype=float)
                 res_tab[col].format = ".4f"
                 res_tab[col][res_tab[col] == -999.0] = np.nan
             except KeyError:
                 print("{} not found".format(col))
     return res_tab
 
-def starMatcher(ps1_catalog, se_catalog, error_pos, error_mag):
-    ps1_ra_dec_list = list(zip(list(ps1_catalog['raMean']), list(ps1_catalog['decMean'])))
-    se_ra_dec_list = list(zip(list(se_catalog['ALPHAWIN_J2000']), list(se_catalog['DELTAWIN_J2000'])))
-    idx = 0
-    near_list = []
-    se_mags = []
-    for coord in se_ra_dec_list:
-        nearest_ps1 = min(ps1_ra_dec_list, key=lambda c: math.hypot(c[0] - coord[0], c[1] - coord[1]));
-        if math.hypot(nearest_ps1[0]-coord[0], nearest_ps1[1]-coord[1]) < error_pos:
-            print("MATCH SE-PS1 DETECT AT: " + str(nearest_ps1))
-            near_list.append(ps1_ra_dec_list[idx])
-            se_mags.append(float(list(se_catalog['MAG_AUTO'])[idx]))
-        idx += 1
-    return near_list, se_mags
-
-search_dict = dict()
-scolumns = """raMean,decMean,gMeanApMag,rMeanApMag,rMeanApMagErr,gMeanApMagErr""".split(',')
-scolumns = [x.strip() for x in scolumns]
-scolumns = [x for x in scolumns if x and not x.startswith('#')]
-
-for catalog in [x for x in next(os.walk('sexout'))[2] if x.endswith("txt")]:
-    sample_dir = catalog.partition("-")
-    search_dict[catalog] = "tricam/data/" + sample_dir[0] + "/obsdata/" + sample_dir[2].partition(".")[0].partition("-")[0] + ".lbl"
-    ra, dec, radius = getConeParams(search_dict[catalog])
-    print("RA: " + str(ra) + ", DEC:" + str(dec))
-    cat_tab = ascii.read("sexout/"+catalog)
-    cat_tab.sort("MAG_AUTO");
-    #top_5p = float(np.percentile(cat_tab["MAG_AUTO"], 5))
-    sconstraints = {'primaryDetection':1,'rMeanApMag.min':15, 'rMeanApMag.max':22}
-    res = ps1cone(ra,dec,radius, table="mean", release="dr2", columns=scolumns, verbose=True, **sconstraints)
-    res_tab = parseConeQuery(res)
-    nl,semg = starMatcher(res_tab, cat_tab, 0.003, 1)
-    valid_errs = []
-    for i in range(len(nl)):
-        speci = list(res_tab['raMean']).index(nl[i][0])
-        rmag = float(res_tab['rMeanApMag'][speci])
-        ourmag = float(semg[i])
-        err = rmag - ourmag
-        if rmag > 16 and abs(err) < 40:
-            valid_errs.append(err)
-    print("ADVISED MAGSHIFT: " + str(np.mean(valid_errs)))
+def _unitVectors(ra, dec):
+    """Cartesian unit vectors for (ra, dec) in degrees."""
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.column_stack((np.cos(dec) * np.cos(ra),
+                            np.cos(dec) * np.sin(ra),
+                            np.sin(dec)))
 
 
+@metrics.timed('match')
+def starMatcher(ps1_catalog, se_catalog, error_pos):
+    """Match every SExtractor source to its nearest PS1 source within error_pos degrees.
 
+       Positions are compared as unit vectors in a KD-tree, so separations are true angular
+       distances (the cos(dec) factor is implicit) and the search is O((N + M) log M).
 
+       Returns (ps1_idx, se_idx, separation) arrays, separation in degrees.
+    """
+    ps1_vec = _unitVectors(ps1_catalog['raMean'], ps1_catalog['decMean'])
+    se_vec = _unitVectors(se_catalog['ALPHAWIN_J2000'], se_catalog['DELTAWIN_J2000'])
+    se_ok = np.flatnonzero(np.isfinite(se_vec).all(axis=1))
+    ps1_ok = np.flatnonzero(np.isfinite(ps1_vec).all(axis=1))
+    if len(se_ok) == 0 or len(ps1_ok) == 0:
+        empty = np.array([], dtype=int)
+        return empty, empty, np.array([], dtype=float)
+
+    # Chord length of an angle of error_pos degrees
+    max_chord = 2 * np.sin(np.radians(error_pos) / 2)
+    tree = cKDTree(ps1_vec[ps1_ok])
+    dist, nearest = tree.query(se_vec[se_ok], k=1, distance_upper_bound=max_chord)
+    found = np.isfinite(dist)
+
+    ps1_idx = ps1_ok[nearest[found]]
+    se_idx = se_ok[found]
+    separation = np.degrees(2 * np.arcsin(dist[found] / 2))
+    return ps1_idx, se_idx, separation
+
+
+def catalogZeropoint(cat_tab, res_tab, error_pos=0.003, bright_limit=16.0, color_term=False,
+                     sigma=3.0):
+    """Match a SExtractor catalog to its PS1 sources and fit the frame's zero point.
+       PS1 stars brighter than bright_limit (r) are left out as likely saturated.
+    """
+    ps1_idx, se_idx, _ = starMatcher(res_tab, cat_tab, error_pos)
+    rmag = np.asarray(res_tab['rMeanApMag'], dtype=float)[ps1_idx]
+    bright = ~(rmag > bright_limit)
+    rmag[bright] = np.nan
+    color = None
+    if color_term:
+        color = (np.asarray(res_tab['gMeanApMag'], dtype=float)[ps1_idx] - rmag)
+    inst_err = np.asarray(cat_tab['MAGERR_AUTO'], dtype=float)[se_idx] if 'MAGERR_AUTO' in cat_tab.colnames else None
+    metrics.count('stars_matched', len(se_idx))
+    with metrics.timed('zeropoint'):
+        return solveZeropoint(rmag,
+                              np.asarray(cat_tab['MAG_AUTO'], dtype=float)[se_idx],
+                              ref_err=np.asarray(res_tab['rMeanApMagErr'], dtype=float)[ps1_idx],
+                              inst_err=inst_err,
+                              color=color, sigma=sigma)
+
+
+def referenceCache(verbose=False):
+    """The tile cache of the PS1 DR2 mean-object query used as the photometric and astrometric
+    reference for NEAT frames.
+    """
+    return ps1tilecache(table="mean", release="dr2", columns=ps1_reference_columns, verbose=verbose,
+                        **ps1_reference_constraints)
+
+
+def catalogLabels(catalog_path=neat_catalog.catalog_path, night=None):
+    """Map the file name of every extracted catalog in sexout/ (of one night, if given) to the
+    label of its frame, from the metadata catalog if it exists, else from the file names.
+    """
+    search_dict = dict()
+    if os.path.exists(catalog_path):
+        conn = neat_catalog.connect(catalog_path)
+        for row in neat_catalog.products(conn, 'extract', night):
+            search_dict[os.path.basename(row['product'])] = row['label']
+        return search_dict
+    if not os.path.isdir('sexout'):
+        return search_dict
+    for catalog in [x for x in next(os.walk('sexout'))[2]
+                    if "-sex-cat." in x and not x.endswith(".part")]:
+        sample_dir = catalog.partition("-")
+        if night is not None and sample_dir[0] != night:
+            continue
+        instrument = instrumentOf(sample_dir[0])
+        if instrument is None:
+            print("No data volume holds night " + sample_dir[0] + ", skipping " + catalog + ".")
+            continue
+        search_dict[catalog] = framePath(sample_dir[0], 'lights', instrument) + "/" + sample_dir[2].partition(".")[0].partition("-")[0] + ".lbl"
+    return search_dict
+
+
+def frameZeropoints(search_dict, cache, color_term=False, sigma=3.0):
+    """Zero point of every catalog of search_dict (catalog file name -> label) against the PS1
+       tiles of cache. A frame whose label, catalog or PS1 tiles cannot be read is left out and
+       reported rather than ending the run.
+
+       Returns the rows for writeZeropoints, and a dictionary mapping each failed catalog to its
+       error message.
+    """
+    failed = dict()
+
+    def fail(catalog, e):
+        failed[catalog] = '%s: %s' % (type(e).__name__, e)
+        metrics.count('frames_failed')
+        print("Error fitting zero point of " + catalog + ": " + failed[catalog])
+
+    cones = dict()
+    index = label_index(search_dict.values())
+    for catalog, label in search_dict.items():
+        try:
+            cones[catalog] = frameCone(catalog, label, index)
+        except Exception as e:
+            fail(catalog, e)
+
+    # Fetch every reference tile the catalogs need in one concurrent round. Tiles that fail are
+    # tried again per frame below
+    try:
+        print("Fetched " + str(cache.prefetch(cones.values())) + " new PS1 tiles.")
+    except IOError as e:
+        print("Some PS1 tiles could not be fetched: " + str(e))
+
+    rows = []
+    for catalog, (ra, dec, radius) in sorted(cones.items()):
+        try:
+            with metrics.timed('catalog_read'):
+                cat_tab = readFrameCatalog("sexout/"+catalog)
+            with metrics.timed('ps1_cone'):
+                res_tab = parseConeQuery(cache.cone(ra, dec, radius))
+            zp = catalogZeropoint(cat_tab, res_tab, color_term=color_term, sigma=sigma)
+        except Exception as e:
+            fail(catalog, e)
+            continue
+        night, frame = catalogFrame(catalog)
+        zp.update(night=night, frame=frame, catalog=catalog)
+        rows.append(zp)
+        print(catalog + ": ZP " + ('%.3f' % zp['zp']) + " +/- " + ('%.3f' % zp['zp_err']) +
+              " from " + str(zp['nstars']) + " stars (" + str(zp['nclipped']) + " clipped).")
+    return rows, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit per-frame photometric zero points against PS1.")
+    parser.add_argument('--color-term', action='store_true',
+                        help="also fit a g-r colour term")
+    parser.add_argument('--sigma', type=float, default=3.0,
+                        help="outlier clipping threshold in robust standard deviations")
+    parser.add_argument('--output', default=zeropoint_table,
+                        help="zero point table to write")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to look up frame labels in, if it exists")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+
+    cache = referenceCache(verbose=True)
+    rows, failed = frameZeropoints(catalogLabels(args.catalog), cache, args.color_term, args.sigma)
+
+    writeZeropoints(rows, args.output)
+    print("Zero points for " + str(len(rows)) + " frames written to " + args.output + " (" +
+          str(len(failed)) + " failed).")
+    metrics.report(args)
+
+
+if __name__ == '__main__':
+    main()
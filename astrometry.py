@@ -0,0 +1,299 @@
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+import numpy as np
+import os
+
+processed_volume = 'preprocessed'
+
+# Frame size assumed when a label does not give LINES and LINE_SAMPLES
+default_frame_shape = (4096, 4096)
+
+# Fraction added to a footprint's radius to allow for pointing errors
+cone_margin = 0.05
+
+# Columns of the per-night index of solutions
+index_columns = ['FRAME', 'NAXIS1', 'NAXIS2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+                 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'NMATCH', 'RMS']
+
+# Header keywords of other WCS conventions, removed when a solution is written
+stale_keywords = ['CDELT1', 'CDELT2', 'CROTA1', 'CROTA2', 'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2',
+                  'A_ORDER', 'B_ORDER', 'AP_ORDER', 'BP_ORDER']
+
+
+def wcsIndexPath(sample):
+    """Sidecar index of a night's solutions. Kept under _wcs so it is not taken for a frame."""
+    return processed_volume + '/_wcs/' + sample + '.fits'
+
+
+def labelShape(lbl):
+    """(rows, columns) of a frame from its label, or default_frame_shape."""
+    try:
+        return int(float(lbl['LINES'])), int(float(lbl['LINE_SAMPLES']))
+    except (KeyError, ValueError):
+        return default_frame_shape
+
+
+def footprintRadius(shape, pixel_scale):
+    """Radius (degrees) of the cone holding a frame of shape pixels of pixel_scale arcsec."""
+    return 0.5 * np.hypot(shape[0], shape[1]) * pixel_scale / 3600.0 * (1 + cone_margin)
+
+
+def skyToTangent(ra, dec, ra0, dec0):
+    """Gnomonic projection of sky positions (degrees) about (ra0, dec0), in degrees."""
+    ra, dec, ra0, dec0 = [np.radians(np.asarray(v, dtype=float)) for v in (ra, dec, ra0, dec0)]
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return np.degrees(xi), np.degrees(eta)
+
+
+def tangentToSky(xi, eta, ra0, dec0):
+    """Inverse of skyToTangent."""
+    xi, eta, ra0, dec0 = [np.radians(np.asarray(v, dtype=float)) for v in (xi, eta, ra0, dec0)]
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+
+def pixelsToSky(x, y, crval, crpix, cd):
+    """Sky positions of 1-based FITS pixel positions under TAN solutions, in one vectorized pass.
+
+       crval, crpix: (2,) for a single solution or (N, 2) with one row per position, so the
+       detections of many frames convert together; cd: (2, 2) or (N, 2, 2).
+    """
+    crval, crpix, cd = np.asarray(crval), np.asarray(crpix), np.asarray(cd)
+    dx = np.asarray(x, dtype=float) - crpix[..., 0]
+    dy = np.asarray(y, dtype=float) - crpix[..., 1]
+    xi = cd[..., 0, 0] * dx + cd[..., 0, 1] * dy
+    eta = cd[..., 1, 0] * dx + cd[..., 1, 1] * dy
+    return tangentToSky(xi, eta, crval[..., 0], crval[..., 1])
+
+
+def headerSolution(header, shape=None):
+    """The TAN solution (dictionary of crval, crpix, cd) of a FITS header, or None if it has no
+       celestial WCS.
+    """
+    wcs = WCS(header).celestial
+    if not wcs.has_celestial:
+        return None
+    shape = shape or (header['NAXIS2'], header['NAXIS1'])
+    return {'crval': np.array(wcs.wcs.crval, dtype=float), 'crpix': np.array(wcs.wcs.crpix, dtype=float),
+            'cd': np.array(wcs.pixel_scale_matrix, dtype=float), 'shape': shape}
+
+
+def nominalSolution(ra, dec, pixel_scale, shape):
+    """North-up, east-left TAN solution centred on a label's nominal pointing."""
+    scale = pixel_scale / 3600.0
+    return {'crval': np.array([ra, dec], dtype=float),
+            'crpix': np.array([shape[1] / 2.0 + 0.5, shape[0] / 2.0 + 0.5]),
+            'cd': np.array([[-scale, 0.0], [0.0, scale]]), 'shape': shape}
+
+
+def solutionCone(solution):
+    """(ra, dec, radius) of the cone holding a solved frame, from its real footprint."""
+    rows, cols = solution['shape']
+    ra, dec = pixelsToSky(cols / 2.0 + 0.5, rows / 2.0 + 0.5, solution['crval'], solution['crpix'],
+                          solution['cd'])
+    scale = np.sqrt(abs(np.linalg.det(solution['cd']))) * 3600.0
+    return float(ra), float(dec), float(footprintRadius(solution['shape'], scale))
+
+
+def _offsetVote(src, ref, max_offset, bin_size):
+    """Most common shift (tangent-plane degrees) from sources to reference stars within
+       max_offset, found as the peak of a 2D histogram of all pair differences.
+    """
+    pairs = cKDTree(ref).query_ball_point(src, max_offset)
+    lengths = np.array([len(p) for p in pairs])
+    if lengths.sum() == 0:
+        return None
+    shifts = ref[np.concatenate([p for p in pairs if p]).astype(int)] - np.repeat(src, lengths, axis=0)
+    edges = np.arange(-max_offset, max_offset + bin_size, bin_size)
+    hist, _, _ = np.histogram2d(shifts[:, 0], shifts[:, 1], bins=[edges, edges])
+    i, j = np.unravel_index(np.argmax(hist), hist.shape)
+    near = ((np.abs(shifts[:, 0] - (edges[i] + bin_size / 2)) <= bin_size) &
+            (np.abs(shifts[:, 1] - (edges[j] + bin_size / 2)) <= bin_size))
+    return np.median(shifts[near], axis=0)
+
+
+def fitSolution(x, y, mag, ref_ra, ref_dec, ref_mag, initial, max_offset=0.05, tolerance=2.0,
+                n_bright=300, min_matches=8, iterations=15, sigma=3.0):
+    """Fit a frame's TAN solution (CRVAL and a full CD matrix) to reference stars.
+
+       x, y, mag: 1-based pixel positions and instrumental magnitudes of the frame's sources
+       ref_ra, ref_dec, ref_mag: reference (PS1) stars around the frame
+       initial: starting solution, from the image header or the label's nominal pointing
+       max_offset: (degrees) largest pointing error searched for
+       tolerance: (arcsec) final matching radius
+
+       The pointing offset is found first by a vote over the brightest n_bright sources and
+       stars, then sources are matched to their nearest star and the affine map from pixels to
+       the tangent plane refitted by least squares, clipping outliers beyond sigma times the
+       rms, with the matching radius shrinking towards tolerance until the matches settle.
+
+       Returns the solution with nmatch and rms (arcsec) added, or None if fewer than
+       min_matches stars could be matched.
+    """
+    x, y, mag = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(mag, dtype=float)
+    ref_ra, ref_dec = np.asarray(ref_ra, dtype=float), np.asarray(ref_dec, dtype=float)
+    ok = np.isfinite(x) & np.isfinite(y)
+    x, y, mag = x[ok], y[ok], mag[ok]
+    ref_ok = np.isfinite(ref_ra) & np.isfinite(ref_dec)
+    ref_ra, ref_dec = ref_ra[ref_ok], ref_dec[ref_ok]
+    ref_mag = np.asarray(ref_mag, dtype=float)[ref_ok]
+    if len(x) < min_matches or len(ref_ra) < min_matches:
+        return None
+
+    crval = np.array(initial['crval'], dtype=float)
+    crpix = np.array(initial['crpix'], dtype=float)
+    cd = np.array(initial['cd'], dtype=float)
+    pix = np.column_stack([x - crpix[0], y - crpix[1]])
+
+    ref = np.column_stack(skyToTangent(ref_ra, ref_dec, crval[0], crval[1]))
+    src = pix.dot(cd.T)
+    bright_src = np.argsort(np.where(np.isfinite(mag), mag, np.inf))[:n_bright]
+    bright_ref = np.argsort(np.where(np.isfinite(ref_mag), ref_mag, np.inf))[:n_bright]
+    scale = np.sqrt(abs(np.linalg.det(cd)))
+    shift = _offsetVote(src[bright_src], ref[bright_ref], max_offset, max(4 * scale, tolerance / 3600.0))
+    if shift is None:
+        return None
+
+    offset = shift
+    radius = max(6 * scale, 3 * tolerance / 3600.0)
+    previous = None
+    for iteration in range(iterations):
+        tree = cKDTree(ref)
+        dist, nearest = tree.query(src + offset, distance_upper_bound=radius)
+        matched = np.flatnonzero(np.isfinite(dist))
+        if len(matched) < min_matches:
+            return None
+        pairs = (matched, nearest[matched])
+        if previous is not None and np.array_equal(pairs[0], previous[0]) and \
+                np.array_equal(pairs[1], previous[1]):
+            break
+        previous = pairs
+        design = np.column_stack([pix[matched], np.ones(len(matched))])
+        target = ref[nearest[matched]]
+        coef, _, _, _ = np.linalg.lstsq(design, target, rcond=None)
+        residual = np.sqrt(((design.dot(coef) - target) ** 2).sum(axis=1))
+        rms = np.sqrt(np.mean(residual ** 2))
+        keep = residual <= max(sigma * rms, 1e-9)
+        if keep.sum() >= min_matches and not keep.all():
+            coef, _, _, _ = np.linalg.lstsq(design[keep], target[keep], rcond=None)
+            residual = np.sqrt(((design[keep].dot(coef) - target[keep]) ** 2).sum(axis=1))
+            rms = np.sqrt(np.mean(residual ** 2))
+
+        # Move the tangent point to the fitted position of CRPIX and project the stars again
+        cd = coef[:2].T
+        crval = np.array(tangentToSky(coef[2, 0], coef[2, 1], crval[0], crval[1]))
+        ref = np.column_stack(skyToTangent(ref_ra, ref_dec, crval[0], crval[1]))
+        src = pix.dot(cd.T)
+        offset = np.zeros(2)
+        # Only ever shrink the radius, so a poor fit cannot pull in more false matches
+        radius = max(min(radius, sigma * rms), tolerance / 3600.0)
+
+    return {'crval': crval, 'crpix': crpix, 'cd': cd, 'shape': initial['shape'],
+            'nmatch': int(keep.sum()), 'rms': float(rms * 3600.0)}
+
+
+def writeSolution(header, solution):
+    """Store a solution in a FITS header as a TAN WCS with a CD matrix."""
+    for key in stale_keywords:
+        header.remove(key, ignore_missing=True, remove_all=True)
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    for i in range(2):
+        header['CRVAL%d' % (i + 1)] = float(solution['crval'][i])
+        header['CRPIX%d' % (i + 1)] = float(solution['crpix'][i])
+        for j in range(2):
+            header['CD%d_%d' % (i + 1, j + 1)] = float(solution['cd'][i][j])
+    header['RADESYS'] = 'ICRS'
+    header['WCSNMAT'] = (solution['nmatch'], 'reference stars in the WCS fit')
+    header['WCSRMS'] = (round(solution['rms'], 4), '[arcsec] rms residual of the WCS fit')
+
+
+def _indexRow(frame, solution):
+    cd = solution['cd']
+    return [frame, solution['shape'][1], solution['shape'][0], solution['crval'][0],
+            solution['crval'][1], solution['crpix'][0], solution['crpix'][1], cd[0][0], cd[0][1],
+            cd[1][0], cd[1][1], solution['nmatch'], solution['rms']]
+
+
+_indexes = dict()
+
+
+def loadIndex(sample):
+    """The night's index of solutions as a Table (empty if none), cached until the file changes."""
+    path = wcsIndexPath(sample)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return Table(names=index_columns, dtype=[object] + [int] * 2 + [float] * 8 + [int, float])
+    cached = _indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        table = Table.read(path, hdu=1)
+        table['FRAME'] = [str(f) for f in table['FRAME']]
+        cached = _indexes[path] = (mtime, table)
+    return cached[1]
+
+
+def updateIndex(sample, solutions):
+    """Add or replace the solutions of some frames (frame id -> solution) in the night's index."""
+    table = loadIndex(sample)
+    rows = [_indexRow(f, s) for f, s in sorted(solutions.items())]
+    rows += [list(r) for r in table if r['FRAME'] not in solutions]
+    out = Table(rows=sorted(rows, key=lambda r: r[0]), names=index_columns) if rows else table
+    out['FRAME'] = np.array([str(f) for f in out['FRAME']])
+    path = wcsIndexPath(sample)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.part'
+    fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(out)]).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, path)
+
+
+def indexSolution(row):
+    return {'crval': np.array([row['CRVAL1'], row['CRVAL2']]),
+            'crpix': np.array([row['CRPIX1'], row['CRPIX2']]),
+            'cd': np.array([[row['CD1_1'], row['CD1_2']], [row['CD2_1'], row['CD2_2']]]),
+            'shape': (int(row['NAXIS2']), int(row['NAXIS1'])),
+            'nmatch': int(row['NMATCH']), 'rms': float(row['RMS'])}
+
+
+def frameSolution(sample, frame):
+    """A frame's solution from the night's index, or None if it was never solved."""
+    table = loadIndex(sample)
+    rows = np.flatnonzero(np.asarray(table['FRAME'], dtype=str) == frame)
+    return indexSolution(table[rows[0]]) if len(rows) else None
+
+
+def applySolutions(table, sample, frames):
+    """Recompute ALPHAWIN_J2000 and DELTAWIN_J2000 from XWIN_IMAGE and YWIN_IMAGE for every row
+       whose frame (frames: frame id per row) has a solution in the night's index, in one
+       vectorized pass over all frames. Rows of unsolved frames keep their positions.
+       Returns the number of rows updated.
+    """
+    index = loadIndex(sample)
+    if len(index) == 0 or 'XWIN_IMAGE' not in table.colnames:
+        return 0
+    lookup = {str(f): i for i, f in enumerate(index['FRAME'])}
+    ids, inverse = np.unique(np.asarray(frames, dtype=str), return_inverse=True)
+    row_solution = np.array([lookup.get(f, -1) for f in ids], dtype=int)[inverse]
+    solved = np.flatnonzero(row_solution >= 0)
+    if len(solved) == 0:
+        return 0
+    s = row_solution[solved]
+    crval = np.column_stack([index['CRVAL1'], index['CRVAL2']])[s]
+    crpix = np.column_stack([index['CRPIX1'], index['CRPIX2']])[s]
+    cd = np.stack([np.column_stack([index['CD1_1'], index['CD1_2']]),
+                   np.column_stack([index['CD2_1'], index['CD2_2']])], axis=1)[s]
+    ra, dec = pixelsToSky(np.asarray(table['XWIN_IMAGE'])[solved],
+                          np.asarray(table['YWIN_IMAGE'])[solved], crval, crpix, cd)
+    for name, values in (('ALPHAWIN_J2000', ra), ('DELTAWIN_J2000', dec)):
+        column = np.array(table[name], dtype=float)
+        column[solved] = values
+        table[name] = column
+    return len(solved)
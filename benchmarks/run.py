@@ -0,0 +1,323 @@
+"""Offline benchmarks of the pipeline hot paths on synthetic NEAT data.
+
+Run from the repository root:
+
+    python -m benchmarks.run                  # full sizes
+    python -m benchmarks.run --quick          # small sizes, for a smoke run
+    python -m benchmarks.run --compare benchmarks/results/<commit>.json
+
+Results are written to benchmarks/results/<commit>.json so runs can be compared between commits.
+"""
+import contextlib
+import subprocess
+import platform
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+import numpy as np
+
+from benchmarks import synthetic
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.join(repo_root, 'benchmarks', 'results')
+
+# Scaling sizes per benchmark: (full, quick)
+sizes = {
+    'lbl_parse': ([100, 1000, 5000], [50, 200]),
+    'odf_mapper': ([10, 50, 200], [5, 20]),
+    'preprocess': ([5, 20], [2, 4]),
+    'extract': ([100, 1000, 5000], [100, 500]),
+    'star_matcher': ([1000, 10000, 100000], [1000, 10000]),
+    'catalog_read': ([1000, 10000, 50000], [1000, 5000]),
+    'linker': ([10000, 100000, 1000000], [10000, 50000]),
+    'wcs_fit': ([500, 5000, 20000], [500, 2000]),
+}
+
+
+def timeit(function, repeat=3):
+    """Best and median wall time of repeat calls of function()."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+
+def _resetCaches():
+    import lblparser
+    import FITS_Processor
+    import FITS_Calibration
+    lblparser._parse_file.cache_clear()
+    for cache in (FITS_Processor._night_files, FITS_Processor._calibration_indexes,
+                  FITS_Processor._night_masters, FITS_Calibration._flat_norms):
+        cache.clear()
+    FITS_Calibration.releaseMasters()
+
+
+def benchLabels(work, n, shape):
+    """Cold parse of n labels."""
+    import lblparser
+    sample = 'plbl%d' % n
+    synthetic.makeNight(work, sample, n_lights=n, n_darks=0, n_flats=0, shape=(8, 8), n_stars=0)
+    labels = sorted(os.path.join('tricam/data', sample, 'obsdata', f)
+                    for f in os.listdir(os.path.join(work, 'tricam/data', sample, 'obsdata'))
+                    if f.endswith('.lbl'))
+
+    def run():
+        lblparser._parse_file.cache_clear()
+        for path in labels:
+            lblparser.lbl_parse(path)
+    result = timeit(run)
+    result['per_item'] = result['best'] / n
+    return result
+
+
+def benchOdfMapper(work, n, shape):
+    """Calibration index build plus nearest dark/flat lookup for every light of a night with n
+       lights (and n / 2 darks and flats).
+    """
+    import FITS_Processor
+    sample = 'podf%d' % n
+    synthetic.makeNight(work, sample, n_lights=n, n_darks=max(n // 2, 1), n_flats=max(n // 2, 1),
+                        shape=(8, 8), n_stars=0)
+    FITSFiles = FITS_Processor.findFITSFiles(sample)
+
+    def run():
+        _resetCaches()
+        index = FITS_Processor.buildCalibrationIndex(FITSFiles)
+        for idx in range(len(FITSFiles['lights'])):
+            FITS_Processor.odf_mapper(FITSFiles, idx, index)
+    result = timeit(run)
+    result['per_item'] = result['best'] / n
+    return result
+
+
+def benchPreprocess(work, n, shape):
+    """Calibrate a night of n lights in each calibration mode, masters built on the first call."""
+    import FITS_Processor
+    sample = 'ppre%d' % n
+    synthetic.makeNight(work, sample, n_lights=n, n_darks=3, n_flats=3, shape=shape, n_stars=200)
+    FITSFiles = FITS_Processor.findFITSFiles(sample)
+    modes = {'masters': dict(use_masters=True),
+             'nearest': dict(use_masters=False),
+             'chunked': dict(use_masters=True, chunked=True),
+             'compressed': dict(use_masters=True, chunked=True, compress=True)}
+    result = {}
+    for mode, options in modes.items():
+        _resetCaches()
+        index = FITS_Processor.calibrationIndexFor(sample, FITSFiles)
+        start = time.perf_counter()
+        FITS_Processor.nightMasters(sample, FITSFiles, index)
+        masters = time.perf_counter() - start
+
+        def run():
+            for idx, path in enumerate(FITSFiles['lights']):
+                FITS_Processor.preprocessSampleData(idx, FITSFiles, os.path.basename(path), sample,
+                                                    index, **options)
+        result[mode] = timeit(run, repeat=2)
+        result[mode]['per_item'] = result[mode]['best'] / n
+        result[mode]['masters'] = masters
+        result[mode]['output_bytes'] = sum(
+            os.path.getsize(FITS_Processor.processedPath(sample, os.path.basename(p)))
+            for p in FITSFiles['lights'])
+    return result
+
+
+def benchExtract(work, n, shape):
+    """In-process sep extraction of one frame holding n stars."""
+    try:
+        import sep_backend
+    except ImportError as e:
+        return {'skipped': str(e)}
+    x, y, mag, flux = synthetic.starField(n, shape, seed=n)
+    rng = np.random.RandomState(n)
+    image = synthetic.addStars(rng.normal(synthetic.sky_level, 30.0, shape), x, y, flux)
+    found = []
+
+    def run():
+        found.append(len(sep_backend.extract(image)))
+    result = timeit(run)
+    result['sources'] = found[-1]
+    return result
+
+
+def benchStarMatcher(work, n, shape):
+    """Match a 2000-source frame catalog against n PS1 sources in a 0.25 degree cone."""
+    from PS1_Comparison import starMatcher
+    ps1 = synthetic.fakePS1(150.0, 20.0, 0.25, n, seed=n)
+    se = synthetic.fakeSECatalog(ps1, 2000, seed=n)
+    matched = []
+
+    def run():
+        matched.append(len(starMatcher(ps1, se, 0.003)[0]))
+    result = timeit(run)
+    result['matched'] = matched[-1]
+    return result
+
+
+def benchCatalogRead(work, n, shape):
+    """Load the matching columns of an n-source catalog, binary FITS against ASCII text."""
+    import secatalog
+    from astropy.table import Table
+    rng = np.random.RandomState(n)
+    table = Table()
+    for name in ['NUMBER', 'FLAGS'] + secatalog.match_columns + ['XWIN_IMAGE', 'YWIN_IMAGE',
+                                                                'FLUX_AUTO', 'FLUXERR_AUTO']:
+        table[name] = rng.uniform(size=n)
+    result = {}
+    for catalog_type, (_, suffix) in secatalog.catalog_types.items():
+        path = os.path.join(work, 'catalog%d%s' % (n, suffix))
+        secatalog.writeCatalog(table, path)
+        result[catalog_type] = timeit(lambda: secatalog.readCatalog(path, secatalog.match_columns))
+    return result
+
+
+def benchLinker(work, n, shape):
+    """Static-source removal and tracklet search over a 4-frame night of n detections per
+       frame, 100 of them injected movers.
+    """
+    import linker
+    detections, movers = synthetic.fakeNightDetections(n_static=n, n_movers=100, seed=n)
+    found = []
+
+    def run():
+        transients = detections[~linker.staticSources(detections)]
+        tracklets, members = linker.linkDetections(transients, n_frames=4)
+        # Movers follow the n static sources in every synthetic frame
+        rows = np.asarray(members['ROW'])
+        found.append((len(tracklets), len(np.unique(rows[rows >= n]))))
+    result = timeit(run)
+    result['tracklets'], result['movers_recovered'] = found[-1]
+    return result
+
+
+def benchWcsFit(work, n, shape):
+    """Fit a frame's WCS from a header 50 arcsec off against n PS1 stars, then convert its
+       catalog to sky positions with the solution.
+    """
+    import astrometry
+    truth = synthetic.frameWCS(150.0, 20.0, shape)
+    x, y, mag, flux = synthetic.starField(n, shape, seed=n)
+    ra, dec = truth.all_pix2world(x, y, 0)
+    initial = astrometry.headerSolution(synthetic.frameWCS(150.012, 20.008, shape).to_header(), shape)
+    fits = []
+
+    def run():
+        solution = astrometry.fitSolution(x + 1, y + 1, mag, ra, dec, mag, initial)
+        astrometry.pixelsToSky(x + 1, y + 1, solution['crval'], solution['crpix'], solution['cd'])
+        fits.append(solution)
+    result = timeit(run)
+    result['nmatch'], result['rms'] = fits[-1]['nmatch'], fits[-1]['rms']
+    return result
+
+
+benchmarks = [('lbl_parse', benchLabels),
+              ('odf_mapper', benchOdfMapper),
+              ('preprocess', benchPreprocess),
+              ('extract', benchExtract),
+              ('star_matcher', benchStarMatcher),
+              ('catalog_read', benchCatalogRead),
+              ('linker', benchLinker),
+              ('wcs_fit', benchWcsFit)]
+
+
+def gitCommit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_root,
+                                      stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=repo_root,
+                                stderr=subprocess.DEVNULL)
+        return out + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def runAll(selected=None, quick=False, shape=synthetic.default_shape, work=None):
+    """Run the selected benchmarks in a scratch directory. Returns the results document."""
+    keep = work is not None
+    work = work or tempfile.mkdtemp(prefix='neat-bench-')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        os.makedirs(work, exist_ok=True)
+        # The pipeline resolves tricam/data, preprocessed/ and sexout/ relative to the cwd
+        os.chdir(work)
+        for name, function in benchmarks:
+            if selected and name not in selected:
+                continue
+            results[name] = {}
+            for n in sizes[name][1 if quick else 0]:
+                print("%s n=%d..." % (name, n))
+                sys.stdout.flush()
+                # Keep the pipeline's progress prints out of the output (and the timings)
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    results[name][str(n)] = function(work, n, shape)
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(work, ignore_errors=True)
+    return {'commit': gitCommit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'quick': quick,
+            'shape': list(shape),
+            'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+            'results': results}
+
+
+def _flatten(results, prefix=''):
+    """Map 'benchmark/size[/mode]' to its best time."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and 'best' in value:
+            flat[prefix + key] = value['best']
+        elif isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '/'))
+    return flat
+
+
+def compare(current, baseline):
+    """Print best times side by side with the ratio to a baseline run."""
+    now = _flatten(current['results'])
+    before = _flatten(baseline['results'])
+    print('%-36s %12s %12s %8s' % ('benchmark', baseline['commit'], current['commit'], 'ratio'))
+    for key in sorted(now):
+        if key in before:
+            print('%-36s %11.4fs %11.4fs %7.2fx' % (key, before[key], now[key], now[key] / before[key]))
+        else:
+            print('%-36s %12s %11.4fs' % (key, '-', now[key]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NEAT pipeline on synthetic data.")
+    parser.add_argument('--quick', action='store_true', help="run the small sizes only")
+    parser.add_argument('--only', action='append', choices=[b[0] for b in benchmarks],
+                        help="run only this benchmark, may be repeated")
+    parser.add_argument('--shape', type=int, nargs=2, default=list(synthetic.default_shape),
+                        metavar=('ROWS', 'COLS'), help="synthetic frame shape")
+    parser.add_argument('--work', help="keep the synthetic data in this directory")
+    parser.add_argument('--output', help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', metavar='RESULTS', help="baseline results file to compare with")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, repo_root)
+    document = runAll(args.only, args.quick, tuple(args.shape), args.work)
+    output = args.output or os.path.join(results_dir, document['commit'] + '.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=1, sort_keys=True)
+    print("Results written to " + output + ".")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(document, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
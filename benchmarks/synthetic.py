@@ -0,0 +1,209 @@
+from astropy.io import fits
+from astropy.table import Table, vstack
+from astropy.wcs import WCS
+import numpy as np
+import datetime
+import os
+
+# Shape, pixel scale and calibration levels of the synthetic frames. Real tricam frames are
+# 4096 x 4096; benchmarks default to smaller frames so a run takes minutes, not hours.
+default_shape = (1024, 1024)
+pixel_scale = 1.43  # arcsec per pixel
+exposure = 20.0
+dark_level = 300.0
+sky_level = 1500.0
+read_noise = 8.0
+night_date = datetime.datetime(2001, 2, 3, 3, 0, 0)
+
+
+def _label(path, fields):
+    lines = ['PDS_VERSION_ID = PDS3', 'RECORD_TYPE = FIXED_LENGTH']
+    lines += ['%s = %s' % (k, v) for k, v in fields]
+    lines.append('END')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _frameFields(start, target, ra=None, dec=None):
+    stop = start + datetime.timedelta(seconds=exposure)
+    fields = [('START_TIME', start.strftime('%Y-%m-%dT%H:%M:%S')),
+              ('STOP_TIME', stop.strftime('%Y-%m-%dT%H:%M:%S')),
+              ('EXPOSURE_DURATION', '%.1f <SECOND>' % exposure),
+              ('TARGET_NAME', '"' + target + '"'),
+              ('FILTER_NAME', '"NONE"'),
+              ('HORIZONTAL_PIXEL_FOV', '%.2f <ARCSEC>' % pixel_scale)]
+    if ra is not None:
+        fields += [('RIGHT_ASCENSION', '%.5f <DEGREE>' % ra), ('DECLINATION', '%.5f <DEGREE>' % dec)]
+    return fields
+
+
+def frameWCS(ra, dec, shape=default_shape):
+    """A north-up TAN WCS centred on (ra, dec) with the synthetic pixel scale."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [shape[1] / 2.0 + 0.5, shape[0] / 2.0 + 0.5]
+    wcs.wcs.cdelt = [-pixel_scale / 3600.0, pixel_scale / 3600.0]
+    return wcs
+
+
+def addStars(image, x, y, flux, fwhm=3.0):
+    """Add Gaussian stars to an image, each drawn in a small stamp around its position."""
+    sigma = fwhm / 2.3548
+    half = int(np.ceil(4 * sigma))
+    for xi, yi, fi in zip(x, y, flux):
+        cx, cy = int(round(xi)), int(round(yi))
+        x0, x1 = max(cx - half, 0), min(cx + half + 1, image.shape[1])
+        y0, y1 = max(cy - half, 0), min(cy + half + 1, image.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            continue
+        gx = np.exp(-0.5 * ((np.arange(x0, x1) - xi) / sigma) ** 2)
+        gy = np.exp(-0.5 * ((np.arange(y0, y1) - yi) / sigma) ** 2)
+        image[y0:y1, x0:x1] += fi / (2 * np.pi * sigma ** 2) * np.outer(gy, gx)
+    return image
+
+
+def starField(n, shape=default_shape, seed=0, mag_range=(14.0, 21.0), zeropoint=28.0):
+    """Random star positions (0-based pixels) and r magnitudes with a power-law number count,
+       and their fluxes in ADU for a given photometric zero point.
+    """
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(5, shape[1] - 5, n)
+    y = rng.uniform(5, shape[0] - 5, n)
+    u = rng.uniform(size=n)
+    lo, hi = 10 ** (0.6 * mag_range[0]), 10 ** (0.6 * mag_range[1])
+    mag = np.log10(lo + u * (hi - lo)) / 0.6
+    return x, y, mag, 10 ** (-0.4 * (mag - zeropoint))
+
+
+def _write(path, data, header=None):
+    fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16), header).writeto(path, overwrite=True)
+
+
+def makeNight(root, sample, n_lights=10, n_darks=5, n_flats=5, shape=default_shape, n_stars=500,
+              ra=150.0, dec=20.0, seed=0):
+    """Write a tricam-shaped night under root/tricam/data/<sample>: raw uint16 darks, flats and
+       lights (with injected stars and a WCS) plus their PDS3 labels, in the layout
+       FITS_Processor.findFITSFiles expects.
+
+       Returns the star field (x, y, mag, flux) injected into every light.
+    """
+    rng = np.random.RandomState(seed)
+    night = os.path.join(root, 'tricam', 'data', sample)
+    folders = {}
+    for kind in ('obsdata', 'darks', 'flats'):
+        folders[kind] = os.path.join(night, kind)
+        os.makedirs(folders[kind], exist_ok=True)
+
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    r2 = ((xx - shape[1] / 2.0) ** 2 + (yy - shape[0] / 2.0) ** 2) / (shape[0] ** 2 / 4.0)
+    vignetting = (1.0 - 0.3 * r2).astype(np.float32)
+    # A few dead pixels for the bad-pixel mask to find
+    dead = rng.randint(0, shape[0] * shape[1], 20)
+    vignetting.flat[dead] = 0.0
+
+    start = night_date
+    for i in range(n_darks):
+        name = 'd%04d' % i
+        _write(os.path.join(folders['darks'], name + '.fit'),
+               dark_level + rng.normal(0, read_noise, shape))
+        _label(os.path.join(folders['darks'], name + '.lbl'), _frameFields(start, 'DARK'))
+        start += datetime.timedelta(seconds=60)
+
+    for i in range(n_flats):
+        name = 'f%04d' % i
+        _write(os.path.join(folders['flats'], name + '.fit'),
+               dark_level + 20000.0 * vignetting + rng.normal(0, 100, shape))
+        _label(os.path.join(folders['flats'], name + '.lbl'), _frameFields(start, 'FLAT FIELD'))
+        start += datetime.timedelta(seconds=60)
+
+    stars = starField(n_stars, shape, seed)
+    wcs = frameWCS(ra, dec, shape)
+    header = wcs.to_header()
+    sky = addStars(np.full(shape, sky_level, dtype=np.float64), stars[0], stars[1], stars[3])
+    for i in range(n_lights):
+        name = 'l%04d' % i
+        data = dark_level + sky * vignetting + rng.normal(0, read_noise, shape)
+        _write(os.path.join(folders['obsdata'], name + '.fit'), data, header)
+        _label(os.path.join(folders['obsdata'], name + '.lbl'),
+               _frameFields(start, 'ASTEROID', ra, dec))
+        start += datetime.timedelta(seconds=120)
+    return stars
+
+
+def fakePS1(ra, dec, radius, n, seed=0):
+    """A PS1 mean-object table of n sources spread uniformly over a cone, with the columns the
+       pipeline queries.
+    """
+    rng = np.random.RandomState(seed)
+    r = radius * np.sqrt(rng.uniform(size=n))
+    theta = rng.uniform(0, 2 * np.pi, n)
+    dec_s = dec + r * np.sin(theta)
+    ra_s = ra + r * np.cos(theta) / np.cos(np.radians(dec))
+    rmag = rng.uniform(14, 22, n)
+    table = Table()
+    table['raMean'] = ra_s
+    table['decMean'] = dec_s
+    table['rMeanApMag'] = rmag
+    table['rMeanApMagErr'] = rng.uniform(0.005, 0.05, n)
+    table['gMeanApMag'] = rmag + rng.normal(0.5, 0.2, n)
+    table['gMeanApMagErr'] = rng.uniform(0.005, 0.05, n)
+    return table
+
+
+def fakeSECatalog(ps1, n, zeropoint=28.0, jitter=0.5 / 3600, seed=0):
+    """A SExtractor-like catalog detecting n of the PS1 sources (plus positional jitter in
+       degrees and photometric noise), with the columns PS1_Comparison reads.
+    """
+    rng = np.random.RandomState(seed)
+    idx = rng.choice(len(ps1), size=min(n, len(ps1)), replace=False)
+    table = Table()
+    table['NUMBER'] = np.arange(1, len(idx) + 1)
+    table['ALPHAWIN_J2000'] = np.asarray(ps1['raMean'])[idx] + rng.normal(0, jitter, len(idx))
+    table['DELTAWIN_J2000'] = np.asarray(ps1['decMean'])[idx] + rng.normal(0, jitter, len(idx))
+    table['MAG_AUTO'] = np.asarray(ps1['rMeanApMag'])[idx] - zeropoint + rng.normal(0, 0.03, len(idx))
+    table['MAGERR_AUTO'] = np.full(len(idx), 0.03)
+    return table
+
+
+def fakeNightDetections(n_frames=4, n_static=20000, n_movers=50, ra=150.0, dec=20.0, radius=0.5,
+                        visit=0.015, jitter=0.3 / 3600, rate_range=(0.05, 1.5), seed=0):
+    """Detections of a night of n_frames exposures of one field, visit days apart: n_static
+       fixed sources seen in every frame, plus n_movers injected movers on straight tracks at
+       rates in rate_range (deg/day), with positional jitter in degrees.
+
+       Returns (detections, movers): a table with the columns linker.linkDetections reads and
+       a MOVER column (-1 for static sources), and the true start position and rates of each
+       mover.
+    """
+    rng = np.random.RandomState(seed)
+    cos_dec = np.cos(np.radians(dec))
+    r = radius * np.sqrt(rng.uniform(size=n_static))
+    theta = rng.uniform(0, 2 * np.pi, n_static)
+    static_ra = ra + r * np.cos(theta) / cos_dec
+    static_dec = dec + r * np.sin(theta)
+
+    rate = rng.uniform(rate_range[0], rate_range[1], n_movers)
+    pa = rng.uniform(0, 2 * np.pi, n_movers)
+    movers = Table()
+    movers['RA'] = ra + rng.uniform(-0.5, 0.5, n_movers) * radius / cos_dec
+    movers['DEC'] = dec + rng.uniform(-0.5, 0.5, n_movers) * radius
+    movers['RA_RATE'] = rate * np.sin(pa)
+    movers['DEC_RATE'] = rate * np.cos(pa)
+
+    tables = []
+    for f in range(n_frames):
+        t = f * visit
+        table = Table()
+        table['ALPHAWIN_J2000'] = np.concatenate(
+            [static_ra, movers['RA'] + movers['RA_RATE'] * t / cos_dec])
+        table['DELTAWIN_J2000'] = np.concatenate([static_dec, movers['DEC'] + movers['DEC_RATE'] * t])
+        table['ALPHAWIN_J2000'] += rng.normal(0, jitter, len(table)) / cos_dec
+        table['DELTAWIN_J2000'] += rng.normal(0, jitter, len(table))
+        table['MAG_AUTO'] = rng.uniform(-12, -6, len(table))
+        table['ROW'] = np.arange(len(table), dtype=np.int32)
+        table['FRAME'] = np.full(len(table), f, dtype=np.int32)
+        table['MJD'] = np.full(len(table), 51943.125 + t)
+        table['MOVER'] = np.concatenate([np.full(n_static, -1), np.arange(n_movers)])
+        tables.append(table)
+    return vstack(tables), movers
@@ -0,0 +1,93 @@
+import os
+
+# Label and folder conventions of the NEAT volumes: the night sub-folders holding each kind of
+# frame, and the label values (as lblparser.index_labels reads them, without quotes) that identify
+# calibration frames and the lights they can be applied to. The GEODSS and both Tri-Cam volumes
+# were archived by the same NEAT software and share all of them; an instrument that differs
+# overrides its keys in its entry below.
+neat_conventions = {'lights': 'obsdata', 'darks': 'darks', 'flats': 'flats',
+                    'dark_target': 'DARK', 'flat_target': 'FLAT FIELD',
+                    'light_targets': ('ASTEROID',), 'filters': ('NONE',)}
+
+# Per-instrument conventions: where the unpacked data of each volume lives, plus the above.
+# Caches, outputs (preprocessed/<night>, sexout/<night>-*) and logs are keyed by night name
+# alone, so night names must be unique across volumes; checkUniqueNights enforces it.
+instruments = {
+    'geodss': dict(neat_conventions, volume='geodss/data'),
+    'tricam': dict(neat_conventions, volume='tricam/data'),
+    'tricam2': dict(neat_conventions, volume='tricam2/data'),
+}
+
+default_instrument = 'tricam'
+
+
+def nightPath(sample, instrument=default_instrument):
+    return instruments[instrument]['volume'] + '/' + sample
+
+
+def framePath(sample, kind, instrument=default_instrument):
+    """Folder holding the 'lights', 'darks' or 'flats' of a night."""
+    return nightPath(sample, instrument) + '/' + instruments[instrument][kind]
+
+
+def isCompliantLight(lbl, instrument=default_instrument):
+    """Whether a light label is one the instrument's darks and flats can calibrate."""
+    conventions = instruments[instrument]
+    return (lbl['TARGET_NAME'] in conventions['light_targets'] and
+            lbl['FILTER_NAME'] in conventions['filters'])
+
+
+def volumeNights(instrument):
+    """Nights downloaded for an instrument, sorted."""
+    volume = instruments[instrument]['volume']
+    if not os.path.isdir(volume):
+        return []
+    return sorted(entry.name for entry in os.scandir(volume) if entry.is_dir())
+
+
+def instrumentOf(sample, candidates=None):
+    """The instrument whose volume holds a night, or None."""
+    for instrument in candidates or sorted(instruments):
+        if os.path.isdir(nightPath(sample, instrument)):
+            return instrument
+    return None
+
+
+def findNights(volumes=None, samples=None):
+    """(instrument, night) pairs to process: the given nights, located in the given volumes,
+       or every downloaded night of those volumes. Nights of different volumes are interleaved
+       so a shared pool works on all of them from the start.
+    """
+    volumes = volumes or sorted(instruments)
+    if samples:
+        located = [(instrumentOf(s, volumes), s) for s in samples]
+        missing = [s for instrument, s in located if instrument is None]
+        if missing:
+            raise ValueError("nights not found in " + ', '.join(volumes) + ": " + ', '.join(missing))
+        checkUniqueNights([(v, s) for s in samples for v in volumes
+                           if os.path.isdir(nightPath(s, v))])
+        return located
+    return interleave(volumes, volumeNights)
+
+
+def checkUniqueNights(nights):
+    """Raise ValueError if a night name occurs in more than one volume of the (instrument,
+       night) pairs, since everything downstream is keyed by night name alone.
+    """
+    seen = dict()
+    for instrument, night in nights:
+        if seen.setdefault(night, instrument) != instrument:
+            raise ValueError("night " + night + " is in both the " + seen[night] + " and " +
+                             instrument + " volumes")
+
+
+def interleave(volumes, listNights):
+    """(instrument, night) pairs of several volumes taken in turn, with listNights(instrument)
+       giving the nights of one volume.
+    """
+    per_volume = [[(v, s) for s in listNights(v)] for v in volumes]
+    nights = []
+    for i in range(max([len(n) for n in per_volume] + [0])):
+        nights.extend(n[i] for n in per_volume if i < len(n))
+    checkUniqueNights(nights)
+    return nights
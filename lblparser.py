@@ -1,4 +1,66 @@
 from astropy.utils.data import download_file
+from astropy.table import Table
+import numpy as np
+import functools
+import metrics
+import glob
+import os
+import re
+
+# Number of parsed labels kept by the process-wide cache
+cache_size = 8192
+
+# Columns gathered by index_labels: (column, label keyword, type)
+index_columns = [
+    ('START_TIME', 'START_TIME', str),
+    ('STOP_TIME', 'STOP_TIME', str),
+    ('EXPOSURE_DURATION', 'EXPOSURE_DURATION', float),
+    ('TARGET_NAME', 'TARGET_NAME', str),
+    ('FILTER_NAME', 'FILTER_NAME', str),
+    ('RA', 'RIGHT_ASCENSION', float),
+    ('DEC', 'DECLINATION', float),
+    ('HOR_PIXEL_FOV', 'HORIZONTAL_PIXEL_FOV', float),
+    ('LINES', 'LINES', float),
+    ('LINE_SAMPLES', 'LINE_SAMPLES', float),
+]
+
+_quantity = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(?:<\s*([^>]*?)\s*>)?\s*$')
+
+
+def _parse_lines(lines):
+    """Turn the lines of a PDS3 label into a dictionary of raw string values.
+
+       Lines without '=' continue the value of the previous keyword, as does any line while a
+       quoted string is still open; parsing stops at END.
+    """
+    ret = dict()
+    key = None
+    for line in lines:
+        if key is not None and ret[key].count('"') % 2 == 1:
+            ret[key] = ret[key] + ' ' + line.strip()
+            continue
+        name, sep, value = line.partition('=')
+        if sep:
+            key = name.strip()
+            ret[key] = value.strip()
+            continue
+        text = line.strip()
+        if not text:
+            continue
+        if text == 'END':
+            break
+        if key is not None:
+            ret[key] = ret[key] + text
+    return ret
+
+
+@functools.lru_cache(maxsize=cache_size)
+@metrics.timed('label_parse')
+def _parse_file(path, mtime, size):
+    # mtime and size are part of the cache key so rewritten labels are parsed again
+    metrics.count('labels_parsed')
+    with open(path, 'r') as content:
+        return _parse_lines(content.read().splitlines())
 
 
 def lbl_parse(file, link=False):
@@ -9,55 +71,89 @@ def lbl_parse(file, link=False):
             link: True is file is a link, false if local file path
 
             returns: dictionary form of .lbl file
-    """
-
-    # Dictionary that turn each variable into the .lbl into a key-value pair
-    ret = dict()
 
-    # A list to contain key-value pairs so that they can be filtered
-    # before being put into the dictionary
-    l = []
+            Parsed labels are cached per process, keyed by path, mtime and size.
+    """
 
     # Download ldl and read content as a file if link
     # or use the path if local
     if link:
-        ldl = download_file(file, cache=True)
-        content = open(ldl, 'r')
+        file = download_file(file, cache=True)
 
-    else:
-        content = open(file, 'r')
+    st = os.stat(file)
+    # Copy so callers can modify the result without touching the cache
+    return dict(_parse_file(os.path.abspath(file), st.st_mtime_ns, st.st_size))
 
-    # Populate list of key-value pairs, incomplete lines, and eliminate blank
-    # lines
-    for line in content:
 
-        # Spit lines at '=' sign
-        keyVal = line.split('=')
+def lbl_quantity(value):
+    """
+            Splits a numeric label value with an optional PDS3 unit, e.g. '20.0 <SECOND>'
+
+            returns: (float, unit or None), or None if the value is not numeric
+    """
+    match = _quantity.match(value)
+    if match is None:
+        return None
+    return float(match.group(1)), match.group(2)
 
-        # Ignore blank lines; else add to list after stripping whitespace
-        if (len(keyVal) == 1 and keyVal[0].strip() == ''):
+
+def lbl_value(value):
+    """
+            Converts a raw label value to a Python value: quoted strings lose their quotes,
+            numbers (with or without a unit) become int or float, anything else is returned
+            unchanged
+    """
+    value = value.strip()
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    quantity = lbl_quantity(value)
+    if quantity is None:
+        return value
+    number = quantity[0]
+    if quantity[1] is None and re.match(r'^[-+]?\d+$', value):
+        return int(value)
+    return number
+
+
+def index_labels(directory, pattern='*.lbl'):
+    """
+            Parses every label of a directory (e.g. a night's obsdata, darks or flats) once
+
+            returns: astropy Table with one row per label, sorted by path, holding the
+                     label path and the index_columns with typed values (strings without
+                     quotes, NaN or '' when missing). Labels that cannot be read are left out.
+    """
+    paths = []
+    data = {name: [] for name, _, _ in index_columns}
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        try:
+            lbl = lbl_parse(path)
+        except (OSError, UnicodeDecodeError):
             continue
-        else:
-            for i in range(len(keyVal)):
-                keyVal[i] = keyVal[i].strip()
-
-        l.append(keyVal)
-
-    i = 0
-    while(True):
-        if len(l[i]) == 1:
-            # If length of list elem. is 1, check if it's the end
-            if l[i][0] == 'END':
-                l.remove(l[i])
-                break
-            # Else append it to the last value of the last sublist and delete
-            # it
-            l[i - 1][1] = l[i - 1][1] + l[i][0]
-            l.remove(l[i])
-        i += 1
-
-    # Put everything in a dictionary
-    for item in l:
-        ret[item[0]] = item[1]
+        paths.append(path)
+        for name, keyword, kind in index_columns:
+            value = lbl_value(lbl[keyword]) if keyword in lbl else None
+            if kind is float:
+                data[name].append(float(value) if isinstance(value, (int, float)) else float('nan'))
+            else:
+                data[name].append('' if value is None else str(value))
 
-    return ret
+    table = Table()
+    table['path'] = np.array(paths, dtype=str)
+    for name, _, kind in index_columns:
+        table[name] = np.array(data[name], dtype=kind)
+    return table
+
+
+def label_index(paths):
+    """
+            Indexes the directories holding the given labels with index_labels, each once
+
+            returns: dictionary mapping label path to its index row; labels that cannot be
+                     read are missing
+    """
+    rows = dict()
+    for directory in sorted(set(os.path.dirname(path) for path in paths)):
+        index = index_labels(directory)
+        rows.update(zip(index['path'], index))
+    return rows
@@ -0,0 +1,419 @@
+from astropy.io import fits
+from astropy.table import Table, vstack
+from astropy.time import Time
+from scipy.spatial import cKDTree
+import numpy as np
+import argparse
+import os
+
+from lblparser import label_index
+from secatalog import readCatalog, match_columns, position_columns
+from PS1_Comparison import (starMatcher, frameCone, catalogFrame, parseConeQuery, catalogLabels,
+                            referenceCache, _unitVectors)
+from astrometry import applySolutions
+import neat_catalog
+import metrics
+
+# Columns the linker needs from a frame catalog
+link_columns = match_columns + position_columns + ['FLAGS']
+
+# SExtractor flags that make a position unusable: saturated, truncated, memory and
+# extraction overflow
+bad_flags = 4 | 8 | 64 | 128
+
+# Defaults of the tracklet search. Rates are on-sky, in degrees per day.
+default_max_rate = 2.0
+default_min_rate = 0.02
+default_tolerance = 2.0      # arcsec, position error allowed around a linear track
+default_static_radius = 1.5  # arcsec
+default_reference_radius = 2.0  # arcsec, tighter than the photometric match so few movers are lost
+default_static_frames = 3    # a source seen this many times in place is static
+default_max_span = 0.125     # days spanned by one tracklet
+default_min_detections = 3
+
+
+# Columns of the TRACKLETS and DETECTIONS tables
+tracklet_columns = [('TRACKLET', np.int32), ('NDET', np.int16), ('MJD', float), ('RA', float),
+                    ('DEC', float), ('RA_RATE', float), ('DEC_RATE', float), ('RATE', float),
+                    ('PA', float), ('RMS', np.float32), ('MAG', np.float32)]
+member_columns = [('TRACKLET', np.int32), ('FRAME', np.int16), ('ROW', np.int32), ('MJD', float),
+                  ('RA', float), ('DEC', float), ('MAG', np.float32)]
+
+
+def trackletPath(night):
+    return 'sexout/' + night + '-tracklets.fits'
+
+
+def _chord(degrees):
+    """Chord length between unit vectors an angle of degrees apart."""
+    return 2 * np.sin(np.radians(degrees) / 2)
+
+
+def frameEpoch(lbl):
+    """MJD of the middle of a frame's exposure, from its label index row."""
+    exposure = float(lbl['EXPOSURE_DURATION'])
+    return Time(lbl['START_TIME'], format='isot', scale='utc').mjd + exposure / 2.0 / 86400.0
+
+
+def loadNight(night, catalog_path=neat_catalog.catalog_path):
+    """Read every extracted catalog of a night with the epoch of its frame.
+
+       Returns (detections, frames): detections is one table of all usable sources with the
+       FRAME (index into frames) and ROW (row in its catalog) of each, frames a table of the
+       catalog names, epochs and labels, sorted by epoch.
+    """
+    labels = catalogLabels(catalog_path, night)
+    index = label_index(labels.values())
+    frames = Table(names=['CATALOG', 'MJD', 'LABEL'], dtype=[object, float, object])
+    for catalog, label in labels.items():
+        if label not in index:
+            print("Cannot read label " + label + ", skipping " + catalog + ".")
+            continue
+        frames.add_row([catalog, frameEpoch(index[label]), label])
+    frames.sort('MJD')
+
+    tables = []
+    for i, catalog in enumerate(frames['CATALOG']):
+        with metrics.timed('catalog_read'):
+            table = readCatalog('sexout/' + catalog, link_columns)
+        table['ROW'] = np.arange(len(table), dtype=np.int32)
+        if 'FLAGS' in table.colnames:
+            table = table[(np.asarray(table['FLAGS']) & bad_flags) == 0]
+            table.remove_column('FLAGS')
+        table['FRAME'] = np.full(len(table), i, dtype=np.int32)
+        table['MJD'] = np.full(len(table), frames['MJD'][i])
+        tables.append(table)
+    if not tables:
+        return Table(names=link_columns[:6] + ['ROW', 'FRAME', 'MJD'],
+                     dtype=[float] * 6 + [np.int32, np.int32, float]), frames
+    detections = vstack(tables)
+    # Sky positions from the solved WCS of each frame, for every frame at once
+    frame_ids = np.array([catalogFrame(c)[1] for c in frames['CATALOG']])
+    applySolutions(detections, night, frame_ids[np.asarray(detections['FRAME'])])
+    metrics.count('link_detections', len(detections))
+    return detections, frames
+
+
+def staticSources(detections, radius=default_static_radius, min_frames=default_static_frames):
+    """Mask of detections that recur within radius arcsec at least min_frames times in the
+       night, i.e. fixed sources whatever the reference catalog holds.
+    """
+    vec = _unitVectors(detections['ALPHAWIN_J2000'], detections['DELTAWIN_J2000'])
+    static = np.zeros(len(detections), dtype=bool)
+    if len(detections) < min_frames:
+        return static
+    # The min_frames nearest neighbours (self included) all being within radius is enough
+    dist, _ = cKDTree(vec).query(vec, k=min_frames, distance_upper_bound=_chord(radius / 3600.0))
+    static[np.isfinite(dist).all(axis=1)] = True
+    return static
+
+
+def referenceSources(detections, frames, cache, radius=default_reference_radius, offline=False):
+    """Mask of detections matched by starMatcher to a PS1 source within radius arcsec."""
+    index = label_index(frames['LABEL'])
+    cones = [frameCone(catalog, label, index)
+             for catalog, label in zip(frames['CATALOG'], frames['LABEL'])]
+    if not offline:
+        cache.prefetch(cones)
+    matched = np.zeros(len(detections), dtype=bool)
+    frame = np.asarray(detections['FRAME'])
+    for i, (ra, dec, cone_radius) in enumerate(cones):
+        rows = np.flatnonzero(frame == i)
+        if len(rows) == 0:
+            continue
+        with metrics.timed('ps1_cone'):
+            ps1 = parseConeQuery(cache.cone(ra, dec, cone_radius, offline))
+        if len(ps1) == 0:
+            continue
+        _, se_idx, _ = starMatcher(ps1, detections[rows], radius / 3600.0)
+        matched[rows[se_idx]] = True
+    return matched
+
+
+def _frameFootprints(vec, starts, ends):
+    """Centre unit vector and radius (chord) of the detections of each frame."""
+    centres = np.zeros((len(starts), 3))
+    radii = np.zeros(len(starts))
+    for f, (lo, hi) in enumerate(zip(starts, ends)):
+        if hi > lo:
+            centre = vec[lo:hi].mean(axis=0)
+            centres[f] = centre / np.linalg.norm(centre)
+            radii[f] = np.sqrt(((vec[lo:hi] - centres[f]) ** 2).sum(axis=1)).max()
+    return centres, radii
+
+
+def findTracklets(mjd, vec, frame, n_frames, max_rate=default_max_rate, min_rate=default_min_rate,
+                  tolerance=default_tolerance, max_span=default_max_span,
+                  min_detections=default_min_detections):
+    """Link detections into tracklets of uniform motion.
+
+       mjd, vec, frame: epoch, unit vector and frame index (0 .. n_frames - 1, in epoch order)
+       of each detection, sorted by frame.
+
+       Every pair of detections in two frames dt apart (0 < dt <= max_span) that moved between
+       min_rate and max_rate * dt seeds a track; only frame pairs whose footprints are within
+       reach are tried, and the pairs come from a KD-tree of each frame, never from all N^2
+       combinations. Each seed is extrapolated to the later frames of the span and extended by
+       the nearest detection within tolerance arcsec (scaled by the extrapolation lever arm).
+       Seeds reaching min_detections become candidates; overlapping candidates are resolved
+       greedily, longest and then best-fitting first, so a detection belongs to one tracklet.
+
+       Returns a list of arrays of detection indices, one per tracklet, in epoch order.
+    """
+    starts = np.searchsorted(frame, np.arange(n_frames))
+    ends = np.searchsorted(frame, np.arange(n_frames), side='right')
+    epochs = np.array([mjd[lo] if hi > lo else np.nan for lo, hi in zip(starts, ends)])
+    trees = [cKDTree(vec[lo:hi]) if hi > lo else None for lo, hi in zip(starts, ends)]
+    centres, radii = _frameFootprints(vec, starts, ends)
+    tol_chord = _chord(tolerance / 3600.0)
+
+    def reachable(i, j, dt):
+        gap = np.sqrt(((centres[i] - centres[j]) ** 2).sum())
+        return gap <= radii[i] + radii[j] + _chord(max_rate * dt) + tol_chord
+
+    candidates = []
+    for i in range(n_frames):
+        if trees[i] is None:
+            continue
+        for j in range(i + 1, n_frames):
+            dt = epochs[j] - epochs[i]
+            if trees[j] is None or not dt > 0:
+                continue
+            if dt > max_span:
+                break
+            if not reachable(i, j, dt):
+                continue
+            hits = trees[j].query_ball_point(vec[starts[i]:ends[i]], _chord(max_rate * dt))
+            lengths = np.fromiter((len(h) for h in hits), dtype=np.intp, count=len(hits))
+            if lengths.sum() == 0:
+                continue
+            a = starts[i] + np.repeat(np.arange(len(hits)), lengths)
+            b = starts[j] + np.concatenate([h for h in hits if h]).astype(np.intp)
+            moved = np.sqrt(((vec[b] - vec[a]) ** 2).sum(axis=1))
+            keep = moved >= _chord(min_rate * dt)
+            a, b = a[keep], b[keep]
+            if len(a) == 0:
+                continue
+            metrics.count('link_seeds', len(a))
+
+            members = [a, b]
+            found = np.full(len(a), 2)
+            for k in range(j + 1, n_frames):
+                lever = epochs[k] - epochs[i]
+                if lever > max_span:
+                    break
+                if trees[k] is None or not reachable(i, k, lever):
+                    continue
+                scale = lever / dt
+                predicted = vec[a] + (vec[b] - vec[a]) * scale
+                predicted /= np.linalg.norm(predicted, axis=1)[:, None]
+                dist, nearest = trees[k].query(predicted, distance_upper_bound=tol_chord * scale)
+                hit = np.isfinite(dist)
+                column = np.full(len(a), -1, dtype=np.intp)
+                column[hit] = starts[k] + nearest[hit]
+                members.append(column)
+                found += hit
+            good = np.flatnonzero(found >= min_detections)
+            if len(good) == 0:
+                continue
+            grid = np.column_stack(members)[good]
+            candidates.extend(row[row >= 0] for row in grid)
+
+    if not candidates:
+        return []
+    rms = trackletFit(mjd, vec, candidates)['rms']
+    order = sorted(range(len(candidates)), key=lambda c: (-len(candidates[c]), rms[c]))
+    claimed = np.zeros(len(mjd), dtype=bool)
+    tracklets = []
+    for c in order:
+        if rms[c] > tolerance or claimed[candidates[c]].any():
+            continue
+        claimed[candidates[c]] = True
+        tracklets.append(candidates[c])
+    return tracklets
+
+
+def trackletFit(mjd, vec, tracklets):
+    """Least-squares linear motion of each tracklet on the tangent plane at its first detection.
+
+       Returns a dictionary of arrays, one entry per tracklet: mjd (first epoch), ra, dec
+       (fitted position at that epoch), ra_rate (on-sky, cos(dec) included), dec_rate (deg/day)
+       and rms (arcsec residual about the fit).
+    """
+    lengths = np.array([len(t) for t in tracklets])
+    owner = np.repeat(np.arange(len(tracklets)), lengths)
+    index = np.concatenate(tracklets)
+    first = np.array([t[0] for t in tracklets])
+
+    # Gnomonic projection of every member about its tracklet's first detection
+    ref = vec[first][owner]
+    east = np.column_stack([-ref[:, 1], ref[:, 0], np.zeros(len(ref))])
+    east /= np.maximum(np.linalg.norm(east, axis=1), 1e-12)[:, None]
+    north = np.cross(ref, east)
+    v = vec[index]
+    depth = (v * ref).sum(axis=1)
+    x = np.degrees((v * east).sum(axis=1) / depth)
+    y = np.degrees((v * north).sum(axis=1) / depth)
+    t = mjd[index] - mjd[first][owner]
+
+    n = lengths.astype(float)
+
+    def total(values):
+        return np.bincount(owner, values, minlength=len(tracklets))
+
+    st, stt = total(t), total(t * t)
+    det = n * stt - st ** 2
+    fit = {}
+    for name, coord in (('x', x), ('y', y)):
+        sc, stc = total(coord), total(t * coord)
+        slope = (n * stc - st * sc) / det
+        fit[name] = ((sc - slope * st) / n, slope)
+    residual = ((x - fit['x'][0][owner] - fit['x'][1][owner] * t) ** 2 +
+                (y - fit['y'][0][owner] - fit['y'][1][owner] * t) ** 2)
+    rms = np.sqrt(total(residual) / n) * 3600.0
+
+    # Back from the tangent plane to the sky for the fitted starting position
+    ref0 = vec[first]
+    east0 = east[np.cumsum(lengths) - lengths]
+    north0 = np.cross(ref0, east0)
+    p = (ref0 + east0 * np.radians(fit['x'][0])[:, None] + north0 * np.radians(fit['y'][0])[:, None])
+    p /= np.linalg.norm(p, axis=1)[:, None]
+    return {'mjd': mjd[first],
+            'ra': np.degrees(np.arctan2(p[:, 1], p[:, 0])) % 360.0,
+            'dec': np.degrees(np.arcsin(np.clip(p[:, 2], -1.0, 1.0))),
+            'ra_rate': fit['x'][1], 'dec_rate': fit['y'][1], 'rms': rms}
+
+
+def linkDetections(detections, max_rate=default_max_rate, min_rate=default_min_rate,
+                   tolerance=default_tolerance, max_span=default_max_span,
+                   min_detections=default_min_detections, n_frames=None):
+    """Find the tracklets among a night's transient detections (FRAME, MJD, ALPHAWIN_J2000,
+       DELTAWIN_J2000 columns). Returns (tracklets, members) tables as written by writeTracklets.
+    """
+    detections = detections[np.argsort(np.asarray(detections['FRAME']), kind='stable')]
+    frame = np.asarray(detections['FRAME'])
+    mjd = np.asarray(detections['MJD'], dtype=float)
+    vec = _unitVectors(detections['ALPHAWIN_J2000'], detections['DELTAWIN_J2000'])
+    if n_frames is None:
+        n_frames = int(frame.max()) + 1 if len(frame) else 0
+    with metrics.timed('link'):
+        found = findTracklets(mjd, vec, frame, n_frames, max_rate, min_rate, tolerance, max_span,
+                              min_detections)
+    metrics.count('link_tracklets', len(found))
+    return trackletTables(detections, mjd, vec, found)
+
+
+def trackletTables(detections, mjd, vec, found):
+    """One row per tracklet, and one per member detection keyed by TRACKLET."""
+    tracklets = Table()
+    members = Table()
+    if not found:
+        for name, dtype in tracklet_columns:
+            tracklets[name] = np.zeros(0, dtype=dtype)
+        for name, dtype in member_columns:
+            members[name] = np.zeros(0, dtype=dtype)
+        return tracklets, members
+
+    fit = trackletFit(mjd, vec, found)
+    index = np.concatenate(found)
+    owner = np.repeat(np.arange(len(found)), [len(t) for t in found])
+    mag = np.asarray(detections['MAG_AUTO'], dtype=float) if 'MAG_AUTO' in detections.colnames \
+        else np.full(len(detections), np.nan)
+    tracklets['TRACKLET'] = np.arange(len(found), dtype=np.int32)
+    tracklets['NDET'] = np.array([len(t) for t in found], dtype=np.int16)
+    tracklets['MJD'] = fit['mjd']
+    tracklets['RA'] = fit['ra']
+    tracklets['DEC'] = fit['dec']
+    tracklets['RA_RATE'] = fit['ra_rate']
+    tracklets['DEC_RATE'] = fit['dec_rate']
+    tracklets['RATE'] = np.hypot(fit['ra_rate'], fit['dec_rate'])
+    tracklets['PA'] = np.degrees(np.arctan2(fit['ra_rate'], fit['dec_rate'])) % 360.0
+    tracklets['RMS'] = fit['rms'].astype(np.float32)
+    tracklets['MAG'] = (np.bincount(owner, mag[index]) / tracklets['NDET']).astype(np.float32)
+    members['TRACKLET'] = owner.astype(np.int32)
+    members['FRAME'] = np.asarray(detections['FRAME'])[index].astype(np.int16)
+    members['ROW'] = np.asarray(detections['ROW'])[index].astype(np.int32) \
+        if 'ROW' in detections.colnames else index.astype(np.int32)
+    members['MJD'] = mjd[index]
+    members['RA'] = np.asarray(detections['ALPHAWIN_J2000'], dtype=float)[index]
+    members['DEC'] = np.asarray(detections['DELTAWIN_J2000'], dtype=float)[index]
+    members['MAG'] = mag[index].astype(np.float32)
+    return tracklets, members
+
+
+def writeTracklets(tracklets, members, frames, path):
+    """Write the TRACKLETS, DETECTIONS and FRAMES tables of a night to one FITS file."""
+    frame_table = Table()
+    frame_table['FRAME'] = np.arange(len(frames), dtype=np.int16)
+    frame_table['CATALOG'] = np.array([str(c) for c in frames['CATALOG']])
+    frame_table['MJD'] = np.asarray(frames['MJD'], dtype=float)
+    hdus = [fits.PrimaryHDU()]
+    for name, table in (('TRACKLETS', tracklets), ('DETECTIONS', members), ('FRAMES', frame_table)):
+        hdu = fits.table_to_hdu(table)
+        hdu.name = name
+        hdus.append(hdu)
+    tmp_path = path + '.part'
+    fits.HDUList(hdus).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, path)
+
+
+def linkNight(night, catalog_path=neat_catalog.catalog_path, cache=None, offline=False,
+              output=None, **search):
+    """Load a night's catalogs, drop static and PS1-matched sources and write its tracklets.
+       cache: PS1 tile cache to match against (None: only sources static within the night are
+       removed). Returns the tracklets table.
+    """
+    detections, frames = loadNight(night, catalog_path)
+    if len(frames) == 0:
+        print("No extracted catalogs for night " + night + ".")
+        return None
+    static = staticSources(detections)
+    if cache is not None:
+        with metrics.timed('match'):
+            static |= referenceSources(detections, frames, cache, offline=offline)
+    transients = detections[~static]
+    print(night + ": " + str(len(detections)) + " detections in " + str(len(frames)) +
+          " frames, " + str(len(transients)) + " not static.")
+    tracklets, members = linkDetections(transients, n_frames=len(frames), **search)
+    output = output or trackletPath(night)
+    writeTracklets(tracklets, members, frames, output)
+    print(night + ": " + str(len(tracklets)) + " tracklets written to " + output + ".")
+    return tracklets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Link the moving sources of extracted NEAT nights into tracklets.")
+    parser.add_argument('nights', nargs='*',
+                        help="nights to link (default: every night with extracted catalogs)")
+    parser.add_argument('--catalog', default=neat_catalog.catalog_path,
+                        help="metadata catalog to look up frame labels in, if it exists")
+    parser.add_argument('--max-rate', type=float, default=default_max_rate,
+                        help="fastest motion searched for (deg/day)")
+    parser.add_argument('--min-rate', type=float, default=default_min_rate,
+                        help="slowest motion searched for (deg/day)")
+    parser.add_argument('--tolerance', type=float, default=default_tolerance,
+                        help="position error allowed about a linear track (arcsec)")
+    parser.add_argument('--max-span', type=float, default=default_max_span,
+                        help="longest time spanned by one tracklet (days)")
+    parser.add_argument('--min-detections', type=int, default=default_min_detections,
+                        help="detections needed to report a tracklet")
+    parser.add_argument('--no-ps1', action='store_true',
+                        help="do not remove sources matched to PS1, only those static in the night")
+    parser.add_argument('--offline', action='store_true',
+                        help="use only PS1 tiles already in the cache")
+    metrics.addArguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args)
+
+    nights = args.nights or sorted(set(c.partition('-')[0] for c in catalogLabels(args.catalog)))
+    cache = None if args.no_ps1 else referenceCache()
+    for night in nights:
+        linkNight(night, args.catalog, cache, args.offline, max_rate=args.max_rate,
+                  min_rate=args.min_rate, tolerance=args.tolerance, max_span=args.max_span,
+                  min_detections=args.min_detections)
+    metrics.report(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+processed_volume = 'preprocessed'
+manifest_path = processed_volume + '/manifest.jsonl'
+# A manifest is compacted when loaded with more than this many lines per current entry
+compact_ratio = 2
+# ... and at least this many superseded lines
+compact_min_superseded = 1000
+
+# Serialises appends and compaction between the manifests of one process (e.g. pipeline stages)
+_write_lock = threading.Lock()
+
+
+def fileSignature(paths):
+    """Hash the names, sizes and modification times of a set of files.
+       Changes whenever a file is added, removed or rewritten.
+    """
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(('%s\0%d\0%d\n' % (os.path.basename(path), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """Append-only JSON-lines record of what each pipeline stage did with each input file.
+
+       Every entry holds the stage, the input path with its mtime and size at the time it was
+       handled, the stage status ('done', 'skipped' or 'failed'), the output path and any extra
+       fields such as the calibration frames used. The latest entry per (stage, input) wins, so
+       a re-run only needs to handle inputs that are new, changed or previously failed, and a
+       crash loses at most the entry being written.
+    """
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.entries = dict()
+        self.load()
+
+    def load(self):
+        """Read the current entries, compacting the file first if it is mostly superseded lines."""
+        lines = self._read()
+        superseded = lines - len(self.entries)
+        if superseded >= compact_min_superseded and lines > compact_ratio * len(self.entries):
+            self.compact()
+
+    def _read(self):
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return 0
+        lines = 0
+        with open(self.path, 'r') as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Truncated last line from an interrupted run
+                    continue
+                self.entries[(entry['stage'], entry['input'])] = entry
+        return lines
+
+    def get(self, stage, input_path):
+        return self.entries.get((stage, input_path))
+
+    def isCurrent(self, stage, input_path, **expect):
+        """True if the input was already handled by the stage and nothing it depends on changed.
+           Failed entries are never current. Keyword arguments are extra fields that must match,
+           e.g. calib=<signature of the calibration frames>.
+        """
+        entry = self.get(stage, input_path)
+        if entry is None or entry['status'] == 'failed':
+            return False
+        try:
+            st = os.stat(input_path)
+        except OSError:
+            return False
+        if entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+            return False
+        if entry.get('output') and not os.path.exists(entry['output']):
+            return False
+        for key, value in expect.items():
+            if entry.get(key) != value:
+                return False
+        return True
+
+    def record(self, stage, input_path, status, output=None, **fields):
+        """Append an entry for an input and make it the current one."""
+        st = os.stat(input_path)
+        entry = {'stage': stage,
+                 'input': input_path,
+                 'mtime': st.st_mtime_ns,
+                 'size': st.st_size,
+                 'status': status,
+                 'output': output,
+                 'time': time.time()}
+        entry.update(fields)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with _write_lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[(stage, input_path)] = entry
+        return entry
+
+    def refresh(self, stage, input_path):
+        """Re-record a stage's entry after its input was rewritten in a way that does not affect
+           that stage's output (e.g. header keywords added), so a current entry stays current.
+           Check isCurrent before rewriting the input; failed entries are left alone.
+        """
+        entry = self.get(stage, input_path)
+        if entry is None or entry['status'] == 'failed':
+            return None
+        fields = {k: v for k, v in entry.items()
+                  if k not in ('stage', 'input', 'mtime', 'size', 'status', 'output', 'time')}
+        return self.record(stage, input_path, entry['status'], entry.get('output'), **fields)
+
+    def compact(self):
+        """Rewrite the manifest keeping only the latest entry per (stage, input). The file is
+           re-read first, so entries appended by other manifests of this process are kept.
+        """
+        with _write_lock:
+            self._read()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
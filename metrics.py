@@ -0,0 +1,244 @@
+import contextlib
+import threading
+import cProfile
+import json
+import time
+import sys
+import os
+
+# Upper bounds (seconds) of the per-file latency histogram buckets; the last one catches the rest
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+                   float('inf')]
+
+# Stages to profile (comma separated) and where to write their profiles. Kept in the environment
+# so worker processes started after enableProfiling profile the same stages.
+profile_env = 'NEAT_PROFILE'
+profile_dir_env = 'NEAT_PROFILE_DIR'
+default_profile_dir = 'profiles'
+
+prometheus_prefix = 'neat_'
+
+
+class Registry(object):
+    """Process-wide counters, stage timers and latency histograms.
+
+       counters: name -> total (bytes, frames, sources, ...)
+       stages: name -> {'count', 'seconds', 'max', 'buckets'}, one observation per timed call
+
+       A snapshot is a plain dictionary, so worker processes can send theirs back to the driver
+       to be merged. Safe to update from several threads. A forked worker starts empty instead of
+       reporting a copy of what its parent had recorded.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.stages = dict()
+
+    def _own(self):
+        # The lock may have been held by another thread of the parent at fork time
+        if self.pid != os.getpid():
+            self._reset()
+
+    def count(self, name, value=1):
+        self._own()
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        self._own()
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0,
+                                              'buckets': [0] * len(latency_buckets)}
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            for i, bound in enumerate(latency_buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+                    break
+
+    def snapshot(self):
+        self._own()
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'stages': {k: dict(v, buckets=list(v['buckets'])) for k, v in self.stages.items()}}
+
+    def merge(self, snapshot):
+        """Add another registry's snapshot (e.g. from a worker process) to this one."""
+        self._own()
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, other in snapshot['stages'].items():
+                entry = self.stages.get(stage)
+                if entry is None:
+                    self.stages[stage] = dict(other, buckets=list(other['buckets']))
+                    continue
+                entry['count'] += other['count']
+                entry['seconds'] += other['seconds']
+                entry['max'] = max(entry['max'], other['max'])
+                entry['buckets'] = [a + b for a, b in zip(entry['buckets'], other['buckets'])]
+
+    def drain(self):
+        """Return the snapshot and reset, so each observation is reported once."""
+        self._own()
+        with self.lock:
+            snapshot = {'counters': self.counters, 'stages': self.stages}
+            self.counters = dict()
+            self.stages = dict()
+        return snapshot
+
+
+registry = Registry()
+
+count = registry.count
+observe = registry.observe
+merge = registry.merge
+
+
+_profiles = dict()
+# Only one cProfile profiler can run at a time in a process
+_profile_lock = threading.Lock()
+
+
+def enableProfiling(stages, directory=default_profile_dir):
+    """Profile the given stages with cProfile, here and in worker processes started later.
+       Each process writes <directory>/<stage>.<pid>.prof; pstats.Stats can load several at once.
+    """
+    os.environ[profile_env] = ','.join(stages)
+    os.environ[profile_dir_env] = directory
+
+
+def _profiled(stage):
+    return stage in os.environ.get(profile_env, '').split(',')
+
+
+def dumpProfiles():
+    """Write the cumulative profile of every profiled stage of this process."""
+    directory = os.environ.get(profile_dir_env, default_profile_dir)
+    for stage, profile in list(_profiles.items()):
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(directory, '%s.%d.prof' % (stage, os.getpid())))
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Time a block as one observation of stage, profiling it if the stage is selected.
+       While one block is being profiled, nested or concurrent ones are only timed.
+    """
+    profile = None
+    if _profiled(stage) and _profile_lock.acquire(blocking=False):
+        profile = _profiles.setdefault(stage, cProfile.Profile())
+        profile.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+        if profile is not None:
+            profile.disable()
+            _profile_lock.release()
+
+
+def collect(function, *args, **kw):
+    """Run function in a worker and return (its result, the metrics it recorded), for
+       pool.submit(metrics.collect, task, ...) so the driver can merge worker metrics.
+    """
+    result = function(*args, **kw)
+    if _profiles:
+        dumpProfiles()
+    return result, registry.drain()
+
+
+def _labels(**labels):
+    return '{' + ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items())) + '}'
+
+
+def prometheusText(snapshot, job):
+    """Render a snapshot in the Prometheus text exposition format."""
+    lines = []
+    job_label = {'job': job}
+    for name, value in sorted(snapshot['counters'].items()):
+        metric = prometheus_prefix + name + '_total'
+        lines.append('# TYPE ' + metric + ' counter')
+        lines.append(metric + _labels(**job_label) + ' ' + repr(value))
+    metric = prometheus_prefix + 'stage_seconds'
+    if snapshot['stages']:
+        lines.append('# TYPE ' + metric + ' histogram')
+    for stage, entry in sorted(snapshot['stages'].items()):
+        cumulative = 0
+        for bound, n in zip(latency_buckets, entry['buckets']):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(metric + '_bucket' + _labels(le=le, stage=stage, **job_label) + ' ' +
+                         str(cumulative))
+        lines.append(metric + '_sum' + _labels(stage=stage, **job_label) + ' ' + repr(entry['seconds']))
+        lines.append(metric + '_count' + _labels(stage=stage, **job_label) + ' ' + str(entry['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path, job=None, snapshot=None):
+    """Write the process metrics to path: a Prometheus textfile if it ends in .prom (replaced
+       atomically, for node_exporter's textfile collector), otherwise one JSON line appended
+       per run. Also writes the profiles of this process.
+    """
+    job = job or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'neat'
+    snapshot = snapshot or registry.snapshot()
+    if _profiles:
+        dumpProfiles()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.prom'):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(prometheusText(snapshot, job))
+        os.replace(tmp_path, path)
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps({'time': time.time(), 'job': job, 'pid': os.getpid(),
+                            'counters': snapshot['counters'], 'stages': snapshot['stages']}) + '\n')
+
+
+def summary(snapshot=None):
+    """One line per stage with call count, total, mean and max seconds, for the end of a run."""
+    snapshot = snapshot or registry.snapshot()
+    lines = []
+    for stage, entry in sorted(snapshot['stages'].items()):
+        lines.append('%-16s %6d calls %9.2fs total %8.3fs mean %8.3fs max' %
+                     (stage, entry['count'], entry['seconds'],
+                      entry['seconds'] / max(entry['count'], 1), entry['max']))
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('%-16s %s' % (name, value))
+    return '\n'.join(lines)
+
+
+def addArguments(parser):
+    """The --metrics and --profile options shared by the pipeline scripts."""
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write stage timings and counters to PATH (Prometheus textfile if it "
+                             "ends in .prom, JSON lines otherwise)")
+    parser.add_argument('--profile', action='append', default=[], metavar='STAGE',
+                        help="profile a stage with cProfile into " + default_profile_dir +
+                             "/, may be repeated")
+
+
+def configure(args):
+    if args.profile:
+        enableProfiling(args.profile)
+
+
+def report(args):
+    """Print the run's stage summary and write the metrics and profiles requested by args."""
+    text = summary()
+    if text:
+        print(text)
+    if args.metrics:
+        write(args.metrics)
+    elif _profiles:
+        dumpProfiles()
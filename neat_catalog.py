@@ -0,0 +1,245 @@
+from lblparser import lbl_parse, lbl_value
+import argparse
+import sqlite3
+import os
+import sys
+
+catalog_path = 'neat.sqlite'
+
+data_volumes = ['geodss/data', 'tricam/data', 'tricam2/data']
+
+# Night sub-folders and the frame kind they hold, named as in FITS_Processor.findFITSFiles
+frame_folders = {'obsdata': 'lights', 'darks': 'darks', 'flats': 'flats'}
+
+schema = """
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    label TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    night TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    start_time TEXT,
+    stop_time TEXT,
+    exposure REAL,
+    target TEXT,
+    filter TEXT,
+    ra REAL,
+    dec REAL,
+    hor_pixel_fov REAL,
+    label_mtime INTEGER,
+    label_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS frames_night ON frames (volume, night, kind);
+CREATE INDEX IF NOT EXISTS frames_start ON frames (start_time);
+CREATE INDEX IF NOT EXISTS frames_target ON frames (target, exposure);
+CREATE TABLE IF NOT EXISTS calibration (
+    frame_id INTEGER PRIMARY KEY REFERENCES frames (id) ON DELETE CASCADE,
+    dark TEXT,
+    flat TEXT
+);
+CREATE TABLE IF NOT EXISTS products (
+    frame_id INTEGER NOT NULL REFERENCES frames (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (frame_id, stage)
+);
+CREATE INDEX IF NOT EXISTS products_path ON products (path);
+"""
+
+
+def connect(path=catalog_path):
+    """Open (creating if needed) the metadata catalog."""
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.executescript(schema)
+    return conn
+
+
+def _number(lbl, keyword):
+    value = lbl_value(lbl[keyword]) if keyword in lbl else None
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def _text(lbl, keyword):
+    return str(lbl_value(lbl[keyword])) if keyword in lbl else None
+
+
+def _frameRow(label, volume, night, kind, st):
+    lbl = lbl_parse(label)
+    return (label[:-3] + 'fit', label, volume, night, kind,
+            _text(lbl, 'START_TIME'), _text(lbl, 'STOP_TIME'), _number(lbl, 'EXPOSURE_DURATION'),
+            _text(lbl, 'TARGET_NAME'), _text(lbl, 'FILTER_NAME'),
+            _number(lbl, 'RIGHT_ASCENSION'), _number(lbl, 'DECLINATION'),
+            _number(lbl, 'HORIZONTAL_PIXEL_FOV'), st.st_mtime_ns, st.st_size)
+
+
+def _scanDir(path):
+    try:
+        return list(os.scandir(path))
+    except OSError:
+        return []
+
+
+def scan(conn, volumes=data_volumes, nights=None):
+    """Walk the data volumes once and bring the frames table up to date.
+
+       A frame is a label with its unpacked .fit next to it. Only labels that are new or whose
+       mtime/size changed are parsed; frames whose label disappeared are removed. A known frame
+       whose data alone is gone (released by NEAT_Pipeline once calibrated) is kept with its
+       products. nights: only walk these nights.
+       Returns (added or updated, removed) counts.
+    """
+    known = dict()
+    for row in conn.execute('SELECT label, label_mtime, label_size FROM frames'):
+        known[row['label']] = (row['label_mtime'], row['label_size'])
+
+    seen = set()
+    rows = []
+    for volume in volumes:
+        for night in _scanDir(volume):
+            if not night.is_dir() or (nights is not None and night.name not in nights):
+                continue
+            for folder, kind in frame_folders.items():
+                entries = _scanDir(os.path.join(night.path, folder))
+                names = set(e.name for e in entries)
+                for entry in entries:
+                    if not entry.name.endswith('.lbl'):
+                        continue
+                    # Only frames whose data has been downloaded and unpacked
+                    if entry.name[:-3] + 'fit' not in names:
+                        if entry.path in known:
+                            seen.add(entry.path)
+                        continue
+                    seen.add(entry.path)
+                    st = entry.stat()
+                    if known.get(entry.path) == (st.st_mtime_ns, st.st_size):
+                        continue
+                    rows.append(_frameRow(entry.path, volume.split('/')[0], night.name, kind, st))
+
+    removed = [label for label in known if label not in seen and
+               any(label.startswith(v + '/') for v in volumes) and
+               (nights is None or label.split('/')[2] in nights)]
+    with conn:
+        conn.executemany("""
+            INSERT INTO frames (path, label, volume, night, kind, start_time, stop_time, exposure,
+                                target, filter, ra, dec, hor_pixel_fov, label_mtime, label_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                label = excluded.label, volume = excluded.volume, night = excluded.night,
+                kind = excluded.kind, start_time = excluded.start_time,
+                stop_time = excluded.stop_time, exposure = excluded.exposure,
+                target = excluded.target, filter = excluded.filter, ra = excluded.ra,
+                dec = excluded.dec, hor_pixel_fov = excluded.hor_pixel_fov,
+                label_mtime = excluded.label_mtime, label_size = excluded.label_size""", rows)
+        conn.executemany('DELETE FROM frames WHERE label = ?', [(label,) for label in removed])
+    return len(rows), len(removed)
+
+
+def queryFrames(conn, volume=None, night=None, kind=None, target=None, exposure=None,
+                month=None, date=None):
+    """Select frames by any combination of volume, night, kind ('lights', 'darks', 'flats'),
+       target name (without quotes), exposure duration in seconds, month ('YYYY-MM') or
+       date ('YYYY-MM-DD') of START_TIME. Rows are ordered by path.
+    """
+    clauses = []
+    params = []
+    for column, value in (('volume', volume), ('night', night), ('kind', kind),
+                          ('target', target), ('exposure', exposure)):
+        if value is not None:
+            clauses.append(column + ' = ?')
+            params.append(value)
+    for prefix in (month, date):
+        if prefix is not None:
+            clauses.append('start_time >= ? AND start_time < ?')
+            params.extend([prefix, prefix + '\uffff'])
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    return conn.execute('SELECT * FROM frames' + where + ' ORDER BY path', params).fetchall()
+
+
+def nights(conn, volume=None):
+    """Distinct nights, optionally of one volume ('geodss', 'tricam' or 'tricam2')."""
+    if volume is None:
+        rows = conn.execute('SELECT DISTINCT night FROM frames ORDER BY night')
+    else:
+        rows = conn.execute('SELECT DISTINCT night FROM frames WHERE volume = ? ORDER BY night',
+                            (volume,))
+    return [row['night'] for row in rows]
+
+
+def fitsFiles(conn, night, volume=None):
+    """The same dictionary FITS_Processor.findFITSFiles builds, read from the catalog."""
+    files = dict()
+    for kind in frame_folders.values():
+        frames = queryFrames(conn, volume=volume, night=night, kind=kind)
+        files[kind] = [f['path'] for f in frames]
+        files[kind + '_lbl'] = [f['label'] for f in frames]
+    return files
+
+
+def frame(conn, path):
+    """The frame row of a raw .fit path, or None."""
+    return conn.execute('SELECT * FROM frames WHERE path = ?', (path,)).fetchone()
+
+
+def setCalibration(conn, frame_path, dark, flat):
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO calibration (frame_id, dark, flat)
+                        SELECT id, ?, ? FROM frames WHERE path = ?""", (dark, flat, frame_path))
+
+
+def addProduct(conn, frame_path, stage, path):
+    """Register a derived product (e.g. stage 'calibrate' or 'extract') of a raw frame."""
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO products (frame_id, stage, path)
+                        SELECT id, ?, ? FROM frames WHERE path = ?""", (stage, path, frame_path))
+
+
+def frameOfProduct(conn, path):
+    """The frame row a derived product was made from, or None."""
+    return conn.execute("""SELECT frames.* FROM products JOIN frames ON frames.id = products.frame_id
+                           WHERE products.path = ?""", (path,)).fetchone()
+
+
+def products(conn, stage, night=None):
+    """(product path, frame row) pairs of one stage, optionally for a single night."""
+    sql = """SELECT products.path AS product, frames.* FROM products
+             JOIN frames ON frames.id = products.frame_id WHERE products.stage = ?"""
+    params = [stage]
+    if night is not None:
+        sql += ' AND frames.night = ?'
+        params.append(night)
+    return conn.execute(sql + ' ORDER BY products.path', params).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the NEAT frame metadata catalog.")
+    parser.add_argument('--catalog', default=catalog_path, help="SQLite catalog file")
+    sub = parser.add_subparsers(dest='command')
+    scan_parser = sub.add_parser('scan', help="index the labels of the data volumes")
+    scan_parser.add_argument('volumes', nargs='*', default=data_volumes)
+    query_parser = sub.add_parser('query', help="list matching frames")
+    for option in ('volume', 'night', 'kind', 'target', 'month', 'date'):
+        query_parser.add_argument('--' + option)
+    query_parser.add_argument('--exposure', type=float)
+    args = parser.parse_args(argv)
+
+    conn = connect(args.catalog)
+    if args.command == 'scan':
+        updated, removed = scan(conn, args.volumes)
+        total = conn.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+        print(str(updated) + " frames indexed, " + str(removed) + " removed, " + str(total) + " in catalog.")
+    elif args.command == 'query':
+        for row in queryFrames(conn, args.volume, args.night, args.kind, args.target,
+                               args.exposure, args.month, args.date):
+            print(row['path'] + " " + str(row['start_time']) + " " + str(row['exposure']) + "s " +
+                  str(row['target']))
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
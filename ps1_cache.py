@@ -0,0 +1,159 @@
+from astropy_healpix import HEALPix
+from astropy.coordinates import ICRS
+from astropy.table import Table
+from astropy import units as u
+import numpy as np
+import metrics
+import hashlib
+import json
+import os
+
+ps1_cache_dir = 'ps1cache'
+# nside 256 tiles are ~0.23 deg across, so a whole tile fits in one MAST cone (<= 0.5 deg)
+default_nside = 256
+# Extra fetch radius around a tile, as a fraction of its circumscribed radius
+tile_margin = 0.05
+
+
+def datasetKey(**query):
+    """Short stable name for a PS1 query (table, release, columns, constraints).
+       Tiles are only shared between identical queries.
+    """
+    text = json.dumps(query, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def _angularDistance(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees (haversine)."""
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2)]
+    a = (np.sin((dec2 - dec1) / 2) ** 2 +
+         np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def _concatenate(arrays):
+    """Concatenate structured tile arrays, promoting fields whose type differs between tiles
+       (e.g. a magnitude column parsed as integers in a tile where it is all -999).
+    """
+    names = arrays[0].dtype.names
+    dtype = [(name, np.result_type(*[a.dtype[name] for a in arrays])) for name in names]
+    out = np.empty(sum(len(a) for a in arrays), dtype=dtype)
+    start = 0
+    for a in arrays:
+        for name in names:
+            out[name][start:start + len(a)] = a[name]
+        start += len(a)
+    return out
+
+
+class PS1TileCache(object):
+    """On-disk PS1 reference catalog stored as HEALPix tiles.
+
+       Each tile holds every source of one nested HEALPix pixel as a structured .npy array under
+       <cache_dir>/<dataset>/nside<N>/<pixel>.npy. A cone query reads only the tiles covering the
+       cone and fetches just the missing ones, so overlapping pointings are served from disk.
+
+       fetch: callable(ra, dec, radius) returning an astropy Table with raMean/decMean columns;
+              it is called once per missing tile with a cone circumscribing the tile
+       fetch_many: optional callable taking a list of such cones and returning their tables in
+              order, used to fetch several missing tiles in one concurrent batch; the exception
+              of a cone that failed takes the place of its table
+    """
+
+    def __init__(self, fetch, dataset, cache_dir=ps1_cache_dir, nside=default_nside, fetch_many=None):
+        self.fetch = fetch
+        self.fetch_many = fetch_many
+        self.nside = nside
+        self.healpix = HEALPix(nside=nside, order='nested', frame=ICRS())
+        self.directory = os.path.join(cache_dir, dataset, 'nside' + str(nside))
+
+    def tilePath(self, pixel):
+        return os.path.join(self.directory, str(int(pixel)) + '.npy')
+
+    def tilesFor(self, ra, dec, radius):
+        """HEALPix pixels overlapping a cone (degrees)."""
+        return self.healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+
+    def missingTiles(self, pixels):
+        return [p for p in pixels if not os.path.exists(self.tilePath(p))]
+
+    def tileCone(self, pixel):
+        """Center and radius (degrees) of a cone enclosing a tile."""
+        lon, lat = self.healpix.healpix_to_lonlat([pixel])
+        blon, blat = self.healpix.boundaries_lonlat([pixel], step=4)
+        ra, dec = lon.to_value(u.deg)[0], lat.to_value(u.deg)[0]
+        radius = _angularDistance(ra, dec, blon.to_value(u.deg), blat.to_value(u.deg)).max()
+        return ra, dec, radius * (1 + tile_margin)
+
+    def storeTile(self, pixel, table):
+        """Keep the rows of a fetched table that fall in the tile and write them to disk."""
+        metrics.count('ps1_tiles_fetched')
+        if len(table):
+            inside = self.healpix.lonlat_to_healpix(np.asarray(table['raMean'], dtype=float) * u.deg,
+                                                    np.asarray(table['decMean'], dtype=float) * u.deg)
+            table = table[inside == pixel]
+        array = table.as_array()
+        if isinstance(array, np.ma.MaskedArray):
+            array = array.filled()
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.tilePath(pixel) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, self.tilePath(pixel))
+
+    def fetchTile(self, pixel):
+        ra, dec, radius = self.tileCone(pixel)
+        self.storeTile(pixel, self.fetch(ra, dec, radius))
+
+    def fetchTiles(self, pixels):
+        """Fetch several tiles, in a single batch when fetch_many is available. Every tile that
+           could be fetched is stored before an IOError reports those that failed.
+        """
+        pixels = list(pixels)
+        if self.fetch_many is None or len(pixels) < 2:
+            for pixel in pixels:
+                self.fetchTile(pixel)
+            return
+        tables = self.fetch_many([self.tileCone(p) for p in pixels])
+        failed = []
+        for pixel, table in zip(pixels, tables):
+            if isinstance(table, Exception):
+                failed.append(table)
+                continue
+            self.storeTile(pixel, table)
+        if failed:
+            raise IOError(str(len(failed)) + " of " + str(len(pixels)) +
+                          " PS1 tiles could not be fetched: " + str(failed[0])) from failed[0]
+
+    def prefetch(self, cones):
+        """Make sure every tile covering a list of (ra, dec, radius) cones is cached, fetching
+           the missing ones together. Returns the number of tiles fetched.
+        """
+        pixels = set()
+        for ra, dec, radius in cones:
+            pixels.update(int(p) for p in self.tilesFor(ra, dec, radius))
+        missing = self.missingTiles(sorted(pixels))
+        self.fetchTiles(missing)
+        return len(missing)
+
+    def loadTile(self, pixel):
+        return np.load(self.tilePath(pixel), mmap_mode='r')
+
+    def cone(self, ra, dec, radius, offline=False):
+        """All cached sources within radius degrees of (ra, dec), as an astropy Table.
+           Missing tiles are fetched first unless offline, in which case they raise.
+        """
+        pixels = self.tilesFor(ra, dec, radius)
+        missing = self.missingTiles(pixels)
+        if missing and offline:
+            raise IOError(str(len(missing)) + " PS1 tiles not cached for cone at " +
+                          str(ra) + ", " + str(dec))
+        self.fetchTiles(missing)
+
+        arrays = [self.loadTile(p) for p in pixels]
+        arrays = [a for a in arrays if len(a)]
+        if not arrays:
+            return Table(self.loadTile(pixels[0])[:0]) if len(pixels) else Table()
+        rows = _concatenate(arrays)
+        inside = _angularDistance(ra, dec, rows['raMean'], rows['decMean']) <= radius
+        return Table(rows[inside])
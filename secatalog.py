@@ -0,0 +1,79 @@
+from astropy.io import ascii, fits
+from astropy.table import Table
+import numpy as np
+import os
+
+# Source catalog formats: SExtractor CATALOG_TYPE and file suffix
+catalog_types = {'fits': ('FITS_1.0', '.fits'),
+                 'ascii': ('ASCII_HEAD', '.txt')}
+default_catalog_type = 'fits'
+
+# Columns the photometric comparison needs from a frame catalog
+match_columns = ['ALPHAWIN_J2000', 'DELTAWIN_J2000', 'MAG_AUTO', 'MAGERR_AUTO']
+
+# Pixel positions, to recompute sky positions from a solved WCS
+position_columns = ['XWIN_IMAGE', 'YWIN_IMAGE']
+
+
+def isBinary(path):
+    return path.endswith(catalog_types['fits'][1])
+
+
+def _objectsHDU(hdul):
+    """The table of sources: LDAC_OBJECTS in a FITS_LDAC catalog, else the first BINTABLE."""
+    if 'LDAC_OBJECTS' in hdul:
+        return hdul['LDAC_OBJECTS']
+    for hdu in hdul:
+        if isinstance(hdu, fits.BinTableHDU):
+            return hdu
+    raise ValueError("no table of sources in " + hdul.filename())
+
+
+def readCatalog(path, columns=None):
+    """Load a source catalog written by sex or sep_backend as an astropy Table.
+
+       Binary (FITS_1.0 or FITS_LDAC) catalogs are memory-mapped and only the requested columns
+       are copied out, so a frame's catalog loads without parsing text. ASCII_HEAD catalogs are
+       still read with astropy.io.ascii. columns: names to load (default: all); names missing
+       from the catalog are skipped.
+    """
+    if not isBinary(path):
+        table = ascii.read(path)
+        return table if columns is None else table[[c for c in columns if c in table.colnames]]
+    with fits.open(path, memmap=True) as hdul:
+        hdu = _objectsHDU(hdul)
+        names = hdu.columns.names
+        table = Table()
+        for name in (names if columns is None else columns):
+            if name in names and name not in table.colnames:
+                table[name] = np.array(hdu.data.field(name))
+        return table
+
+
+def countRows(path):
+    """Number of sources in a catalog, from the table header for binary catalogs."""
+    if isBinary(path):
+        with fits.open(path, memmap=True) as hdul:
+            return _objectsHDU(hdul).header['NAXIS2']
+    with open(path, 'r') as f:
+        return sum(1 for line in f if not line.startswith('#'))
+
+
+def writeCatalog(table, path, descriptions=None, formats=None):
+    """Write a source table as a FITS BINTABLE or, for a .txt path, in SExtractor's ASCII_HEAD
+       layout, so it reads back like a sex catalog. descriptions and formats give each column's
+       ASCII header description and printf format.
+    """
+    tmp_path = path + '.part'
+    if isBinary(path):
+        fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(table)]).writeto(tmp_path, overwrite=True)
+    else:
+        descriptions = descriptions or {}
+        formats = formats or {}
+        with open(tmp_path, 'w') as f:
+            for i, name in enumerate(table.colnames):
+                f.write('#%4d %-22s %s\n' % (i + 1, name, descriptions.get(name, '')))
+            fmt = ' '.join(formats.get(name, '%s') for name in table.colnames)
+            for row in zip(*[table[name] for name in table.colnames]):
+                f.write(fmt % row + '\n')
+    os.replace(tmp_path, path)
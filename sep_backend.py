@@ -0,0 +1,160 @@
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+import numpy as np
+import sep
+from FITS_Calibration import imageHDU, weightMask
+import secatalog
+import time
+import os
+
+# Mirrors the settings of sexconf/wisesex_params.txt and the overrides FITS_Sextraction passes to sex
+detect_thresh = 1.5
+detect_minarea = 10
+filter_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sexconf', 'default.conv')
+deblend_nthresh = 32
+deblend_mincont = 0.0001
+back_size = 130
+back_filtersize = 7
+phot_aperture = 12.0
+phot_autoparams = (2.0, 4.0)
+mag_zeropoint = 20.4
+gain = 1.9
+pixstack = 300000
+
+# Catalog columns: the sexconf/sex_outcols.txt columns used downstream, with their sex descriptions
+catalog_columns = [
+    ('NUMBER', 'Running object number', '%d'),
+    ('FLAGS', 'Extraction flags', '%d'),
+    ('ALPHAWIN_J2000', 'Windowed right ascension (J2000) [deg]', '%.7f'),
+    ('DELTAWIN_J2000', 'Windowed declination (J2000) [deg]', '%.7f'),
+    ('XWIN_IMAGE', 'Windowed position estimate along x [pixel]', '%.4f'),
+    ('YWIN_IMAGE', 'Windowed position estimate along y [pixel]', '%.4f'),
+    ('MAG_AUTO', 'Kron-like elliptical aperture magnitude [mag]', '%.4f'),
+    ('MAGERR_AUTO', 'RMS error for AUTO magnitude [mag]', '%.4f'),
+    ('MAG_APER', 'Fixed aperture magnitude vector [mag]', '%.4f'),
+    ('MAGERR_APER', 'RMS error vector for fixed aperture mag. [mag]', '%.4f'),
+    ('FLUX_AUTO', 'Flux within a Kron-like elliptical aperture [count]', '%.6g'),
+    ('FLUXERR_AUTO', 'RMS error for AUTO flux [count]', '%.6g'),
+    ('FLUX_APER', 'Flux vector within fixed circular aperture(s) [count]', '%.6g'),
+    ('FLUXERR_APER', 'RMS error vector for aperture flux(es) [count]', '%.6g'),
+]
+
+
+def loadFilter(path=filter_name):
+    """Read a SExtractor .conv filter file into a kernel array."""
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('CONV'):
+                continue
+            rows.append([float(x) for x in line.split()])
+    return np.array(rows)
+
+
+def _magnitude(flux, fluxerr):
+    """SExtractor convention: 99 for non-positive fluxes."""
+    good = flux > 0
+    mag = np.full(flux.shape, 99.0)
+    magerr = np.full(flux.shape, 99.0)
+    mag[good] = mag_zeropoint - 2.5 * np.log10(flux[good])
+    magerr[good] = 1.0857 * fluxerr[good] / flux[good]
+    return mag, magerr
+
+
+def extract(data, wcs=None, mask=None, deblend_nthresh=deblend_nthresh,
+            deblend_mincont=deblend_mincont, back_size=back_size):
+    """Extract sources from a calibrated image array in-process.
+
+       data: 2D image, e.g. the array returned by FITS_Processor.preprocessSampleData
+       wcs: astropy WCS of the image, used for ALPHAWIN_J2000/DELTAWIN_J2000
+       mask: boolean array of pixels to ignore; non-finite pixels are always ignored
+
+       Returns an astropy Table with the columns of catalog_columns.
+    """
+    data = np.array(data, dtype=np.float64, order='C')
+    bad = ~np.isfinite(data)
+    if mask is not None:
+        bad |= np.asarray(mask, dtype=bool)
+    data[bad] = 0.0
+
+    sep.set_extract_pixstack(pixstack)
+    bkg = sep.Background(data, mask=bad, bw=back_size, bh=back_size,
+                         fw=back_filtersize, fh=back_filtersize)
+    bkg.subfrom(data)
+    rms = bkg.globalrms
+
+    objects = sep.extract(data, detect_thresh, err=rms, mask=bad, minarea=detect_minarea,
+                          filter_kernel=loadFilter(), deblend_nthresh=deblend_nthresh,
+                          deblend_cont=deblend_mincont)
+    x, y = objects['x'], objects['y']
+    a, b, theta = objects['a'], objects['b'], objects['theta']
+
+    # MAG_AUTO: Kron aperture scaled by PHOT_AUTOPARAMS, with a minimum radius
+    kron_fact, min_radius = phot_autoparams
+    kronrad, kflag = sep.kron_radius(data, x, y, a, b, theta, 6.0, mask=bad)
+    kronrad = np.maximum(kron_fact * kronrad, min_radius)
+    flux_auto, fluxerr_auto, aflag = sep.sum_ellipse(data, x, y, a, b, theta, kronrad,
+                                                     err=rms, gain=gain, mask=bad, subpix=1)
+
+    flux_aper, fluxerr_aper, pflag = sep.sum_circle(data, x, y, phot_aperture / 2.0,
+                                                    err=rms, gain=gain, mask=bad, subpix=5)
+
+    # Windowed centroids as in SExtractor's XWIN/YWIN
+    half_light, rflag = sep.flux_radius(data, x, y, 6.0 * a, 0.5, normflux=flux_auto,
+                                        mask=bad, subpix=5)
+    xwin, ywin, wflag = sep.winpos(data, x, y, 2.0 / 2.35 * half_light, mask=bad)
+
+    mag_auto, magerr_auto = _magnitude(flux_auto, fluxerr_auto)
+    mag_aper, magerr_aper = _magnitude(flux_aper, fluxerr_aper)
+
+    if wcs is not None and wcs.has_celestial:
+        ra, dec = wcs.celestial.all_pix2world(xwin, ywin, 0)
+    else:
+        ra = np.full(len(objects), np.nan)
+        dec = np.full(len(objects), np.nan)
+
+    table = Table()
+    table['NUMBER'] = np.arange(1, len(objects) + 1)
+    table['FLAGS'] = objects['flag'] | kflag | aflag | pflag | wflag
+    table['ALPHAWIN_J2000'] = ra
+    table['DELTAWIN_J2000'] = dec
+    # SExtractor image coordinates are 1-based
+    table['XWIN_IMAGE'] = xwin + 1
+    table['YWIN_IMAGE'] = ywin + 1
+    table['MAG_AUTO'] = mag_auto
+    table['MAGERR_AUTO'] = magerr_auto
+    table['MAG_APER'] = mag_aper
+    table['MAGERR_APER'] = magerr_aper
+    table['FLUX_AUTO'] = flux_auto
+    table['FLUXERR_AUTO'] = fluxerr_auto
+    table['FLUX_APER'] = flux_aper
+    table['FLUXERR_APER'] = fluxerr_aper
+    return table
+
+
+def writeCatalog(table, path):
+    """Write a catalog as a FITS BINTABLE, or for a .txt path in SExtractor's ASCII_HEAD layout,
+       so it reads back like a sex catalog of the same type.
+    """
+    secatalog.writeCatalog(table[[c[0] for c in catalog_columns]], path,
+                           descriptions={c[0]: c[1] for c in catalog_columns},
+                           formats={c[0]: c[2] for c in catalog_columns})
+
+
+def runSep(image, catalog, checkimage=None, weight=None):
+    """Extract one processed FITS image to a catalog, with the same return shape as
+       FITS_Sextraction.runSextractor. Pixels with zero weight in the weight map are masked.
+       No check image is produced.
+    """
+    start = time.time()
+    try:
+        with fits.open(image) as hdul:
+            hdu = imageHDU(hdul)
+            mask = weightMask(weight) if weight is not None else None
+            table = extract(hdu.data, WCS(hdu.header), mask)
+        writeCatalog(table, catalog)
+    except Exception as e:
+        return 1, time.time() - start, '%s: %s' % (type(e).__name__, e)
+    return 0, time.time() - start, ''
@@ -0,0 +1,26 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+# The pipeline modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def http_server():
+    """Start a local HTTP server for a handler class; returns its base URL. Stopped after the test."""
+    servers = []
+
+    def start(handler):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%d' % server.server_port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
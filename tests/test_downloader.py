@@ -0,0 +1,190 @@
+import functools
+import hashlib
+import http.server
+import os
+
+from astropy.io import fits
+import numpy as np
+
+import NEAT_Downloader
+
+
+class PDSHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves a mock PDS tree: directory indexes carry an ETag and answer If-None-Match with
+       304, and files honour single Range requests, sent whole when an If-Range date does not
+       match. Every response is logged.
+    """
+
+    def __init__(self, *args, log=None, **kw):
+        self.log = log
+        self.etag = None
+        super().__init__(*args, **kw)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response(self, code, message=None):
+        self.log.append((self.command, self.path, code, self.headers.get('Range')))
+        super().send_response(code, message)
+
+    def end_headers(self):
+        if self.etag is not None:
+            self.send_header('ETag', self.etag)
+        super().end_headers()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.endswith('/'):
+            # Changes when an entry is added or removed, or a file in this directory is rewritten
+            stamp = ''
+            for entry in sorted(os.listdir(path)):
+                full = os.path.join(path, entry)
+                stamp += '%s %d\n' % (entry, os.stat(full).st_mtime_ns if os.path.isfile(full) else 0)
+            self.etag = '"%s"' % hashlib.sha1(stamp.encode()).hexdigest()
+            if self.headers.get('If-None-Match') == self.etag:
+                self.send_response(304)
+                self.end_headers()
+                return None
+            return super().send_head()
+        byte_range = self.headers.get('Range')
+        if byte_range is None or not os.path.isfile(path):
+            return super().send_head()
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != self.date_time_string(int(os.path.getmtime(path))):
+            return super().send_head()
+        start = int(byte_range.split('=')[1].rstrip('-'))
+        size = os.path.getsize(path)
+        if start >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.end_headers()
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return f
+
+
+def makeVolume(root):
+    """A two-night tricam volume under root/pds3/neat/tricam/data/."""
+    volume = root / 'pds3' / 'neat' / 'tricam' / 'data'
+    for night, frames in (('p20020121', 3), ('p20020122', 2)):
+        obsdata = volume / night / 'obsdata'
+        obsdata.mkdir(parents=True)
+        for i in range(frames):
+            (obsdata / ('frame%d.fit.fz' % i)).write_bytes(os.urandom(1000 + i))
+            (obsdata / ('frame%d.lbl' % i)).write_text('OBJECT = IMAGE\nEND\n')
+    return volume
+
+
+def serveVolume(http_server, root):
+    log = []
+    url = http_server(functools.partial(PDSHandler, directory=str(root), log=log))
+    return url + '/pds3/neat/tricam/data/', log
+
+
+def test_crawl_revalidates_cached_listings(tmp_path, http_server):
+    volume = makeVolume(tmp_path / 'srv')
+    url, log = serveVolume(http_server, tmp_path / 'srv')
+    cache = str(tmp_path / 'listings')
+
+    files = NEAT_Downloader.crawl(url, workers=4, cache_dir=cache)
+    assert len(files) == 10
+    assert all(f.startswith(url) for f in files)
+    assert all(code == 200 for _, _, code, _ in log)
+    nights = NEAT_Downloader.pullVolumeData(url, cache_dir=cache)
+    assert [NEAT_Downloader.getRecordID(n) for n in nights] == ['p20020121', 'p20020122']
+
+    # Unchanged directories are revalidated, not re-listed
+    del log[:]
+    assert NEAT_Downloader.crawl(url, workers=4, cache_dir=cache) == files
+    assert len(log) == 5 and all(code == 304 for _, _, code, _ in log)
+
+    # Only the changed directory is listed again
+    (volume / 'p20020122' / 'obsdata' / 'frame2.lbl').write_text('OBJECT = IMAGE\nEND\n')
+    del log[:]
+    assert len(NEAT_Downloader.crawl(url, workers=4, cache_dir=cache)) == 11
+    assert [path for _, path, code, _ in log if code == 200] == ['/pds3/neat/tricam/data/p20020122/obsdata/']
+
+
+def test_download_resumes_partial_file(tmp_path, http_server, monkeypatch):
+    makeVolume(tmp_path / 'srv')
+    url, log = serveVolume(http_server, tmp_path / 'srv')
+    monkeypatch.chdir(tmp_path)
+    file_url = url + 'p20020121/obsdata/frame1.fit.fz'
+    content = (tmp_path / 'srv' / 'pds3' / 'neat' / 'tricam' / 'data' / 'p20020121' / 'obsdata' /
+               'frame1.fit.fz').read_bytes()
+    dest = NEAT_Downloader.localPath(file_url)
+    assert dest == os.path.join('tricam', 'data', 'p20020121', 'obsdata', 'frame1.fit.fz')
+
+    os.makedirs(os.path.dirname(dest))
+    with open(dest + '.part', 'wb') as f:
+        f.write(content[:400])
+    session = NEAT_Downloader.makeSession(2)
+    assert NEAT_Downloader.downloadFile(session, file_url) == ('done', len(content) - 400)
+    assert open(dest, 'rb').read() == content
+    assert not os.path.exists(dest + '.part')
+    assert log[-1][2:] == (206, 'bytes=400-')
+
+    # A complete copy is only checked against the server's size
+    del log[:]
+    assert NEAT_Downloader.downloadFile(session, file_url) == ('skipped', 0)
+    assert [command for command, _, _, _ in log] == ['HEAD']
+
+
+def test_unpack_restores_fpacked_primary_image(tmp_path):
+    data = np.arange(120, dtype=np.int16).reshape(10, 12)
+    header = fits.Header()
+    header['OBSERVER'] = 'NEAT'
+    path = str(tmp_path / 'frame.fit.fz')
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header)]).writeto(path)
+    # As fpack does for a primary image
+    with fits.open(path, mode='update', disable_image_compression=True) as hdul:
+        hdul[1].header['ZSIMPLE'] = True
+
+    assert NEAT_Downloader.unpackFile(path) == path[:-3]
+    with fits.open(path[:-3]) as hdul:
+        assert len(hdul) == 1
+        assert (hdul[0].data == data).all()
+        assert hdul[0].header['OBSERVER'] == 'NEAT'
+
+
+def test_download_restarts_when_partial_file_is_stale(tmp_path, http_server, monkeypatch):
+    makeVolume(tmp_path / 'srv')
+    url, log = serveVolume(http_server, tmp_path / 'srv')
+    monkeypatch.chdir(tmp_path)
+    file_url = url + 'p20020121/obsdata/frame2.fit.fz'
+    content = (tmp_path / 'srv' / 'pds3' / 'neat' / 'tricam' / 'data' / 'p20020121' / 'obsdata' /
+               'frame2.fit.fz').read_bytes()
+    dest = NEAT_Downloader.localPath(file_url)
+    session = NEAT_Downloader.makeSession(2)
+    os.makedirs(os.path.dirname(dest))
+
+    # Started against an older server copy: the If-Range date no longer matches
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'x' * 400)
+    with open(dest + '.part.validator', 'w') as f:
+        f.write('Thu, 01 Jan 1970 00:00:00 GMT')
+    assert NEAT_Downloader.downloadFile(session, file_url) == ('done', len(content))
+    assert open(dest, 'rb').read() == content
+    assert log[-1][2] == 200
+    assert not os.path.exists(dest + '.part.validator')
+
+    # Longer than the server copy: not promoted, downloaded again
+    os.remove(dest)
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'x' * (len(content) + 10))
+    assert NEAT_Downloader.downloadFile(session, file_url) == ('done', len(content))
+    assert open(dest, 'rb').read() == content
+    assert [code for _, _, code, _ in log[-2:]] == [416, 200]
+
+    # A local copy the server cannot size is kept
+    del log[:]
+    missing = url + 'p20020121/obsdata/gone.fit.fz'
+    with open(NEAT_Downloader.localPath(missing), 'wb') as f:
+        f.write(content)
+    assert NEAT_Downloader.downloadFile(session, missing) == ('skipped', 0)
+    assert open(NEAT_Downloader.localPath(missing), 'rb').read() == content
@@ -0,0 +1,66 @@
+from astropy.table import Table
+import numpy as np
+
+from benchmarks import synthetic
+import linker
+from ps1_cache import _angularDistance
+
+night = 'p20010203'
+
+
+class StarCache(object):
+    """Stands in for the PS1 tile cache: every cone is answered from a fixed star list."""
+
+    def __init__(self, ra, dec):
+        self.stars = Table({'raMean': ra, 'decMean': dec, 'gMeanApMag': np.full(len(ra), 18.5),
+                            'rMeanApMag': np.full(len(ra), 18.0)})
+        self.radii = []
+
+    def prefetch(self, cones):
+        return 0
+
+    def cone(self, ra, dec, radius, offline=False):
+        self.radii.append(radius)
+        inside = _angularDistance(ra, dec, self.stars['raMean'], self.stars['decMean']) <= radius
+        return self.stars[inside]
+
+
+def nightFrames(tmp_path, n_frames):
+    """Catalog names and labels of 1024 x 1024 frames pointed at the synthetic night's field."""
+    frames = Table(names=['CATALOG', 'LABEL'], dtype=[object, object])
+    for f in range(n_frames):
+        label = str(tmp_path / ('f%d.lbl' % f))
+        with open(label, 'w') as out:
+            out.write('RIGHT_ASCENSION = 150.0 <DEGREE>\nDECLINATION = 20.0 <DEGREE>\n'
+                      'HORIZONTAL_PIXEL_FOV = 1.43 <ARCSEC>\nLINES = 1024\nLINE_SAMPLES = 1024\n'
+                      'END\n')
+        frames.add_row([night + '-f%d-sex-cat.fits' % f, label])
+    return frames
+
+
+def test_reference_stars_are_masked_and_movers_linked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    n_static, n_movers, n_frames = 1000, 30, 4
+    detections, movers = synthetic.fakeNightDetections(n_frames=n_frames, n_static=n_static,
+                                                       n_movers=n_movers, radius=0.2, seed=3)
+    # PS1 holds the static field 1 arcsec north of where the night saw it: within the 2 arcsec
+    # reference radius, but not within one a footprint radius in degrees would give
+    static = np.asarray(detections['MOVER']) < 0
+    ra = np.asarray(detections['ALPHAWIN_J2000'])[static].reshape(n_frames, n_static).mean(axis=0)
+    dec = np.asarray(detections['DELTAWIN_J2000'])[static].reshape(n_frames, n_static).mean(axis=0)
+    cache = StarCache(ra, dec + 1.0 / 3600)
+
+    matched = linker.referenceSources(detections, nightFrames(tmp_path, n_frames), cache)
+    # Each frame's whole footprint is queried
+    assert min(cache.radii) > 0.2
+    assert matched[static].mean() > 0.99
+    # Only movers passing within 2 arcsec of a star
+    assert matched[~static].mean() < 0.05
+
+    tracklets, members = linker.linkDetections(detections[~matched], n_frames=n_frames)
+    rows = np.asarray(members['ROW'])
+    assert (rows >= n_static).all()
+    owners = [set(rows[np.asarray(members['TRACKLET']) == t] - n_static)
+              for t in tracklets['TRACKLET']]
+    assert all(len(owner) == 1 for owner in owners)
+    assert len(set().union(*owners)) >= 0.9 * n_movers
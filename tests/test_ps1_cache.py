@@ -0,0 +1,174 @@
+import functools
+import http.server
+import json
+import threading
+import urllib.parse
+
+import numpy as np
+import pytest
+
+import PS1_Comparison
+from ps1_cache import _angularDistance
+
+columns = ['raMean', 'decMean', 'rMeanApMag']
+
+
+def starField(n=3000, ra=150.0, dec=20.0, radius=0.6, seed=1):
+    rng = np.random.default_rng(seed)
+    return {'raMean': ra + rng.uniform(-radius, radius, n) / np.cos(np.radians(dec)),
+            'decMean': dec + rng.uniform(-radius, radius, n),
+            'rMeanApMag': rng.uniform(15, 22, n)}
+
+
+class MASTHandler(http.server.BaseHTTPRequestHandler):
+    """Stub of the MAST PS1 catalog API: table metadata and CSV cone searches over a fixed star
+       field. The first `throttle` cone searches are answered with 503 to exercise retries, and
+       cones centred east of `reject_ra` always fail.
+    """
+
+    def __init__(self, *args, stars=None, log=None, throttle=0, reject_ra=None, **kw):
+        self.stars = stars
+        self.log = log
+        self.throttle = throttle
+        self.reject_ra = reject_ra
+        super().__init__(*args, **kw)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.endswith('/dr1/mean/metadata'):
+            self.log.append(('metadata', None))
+            body = json.dumps([{'name': c, 'type': 'float', 'description': ''} for c in columns])
+            return self.reply(200, body.encode(), 'application/json')
+        with self.log.lock:
+            throttled = sum(1 for kind, _ in self.log if kind == 'cone') < self.throttle
+            self.log.append(('cone', query))
+        if throttled:
+            return self.reply(503, b'busy')
+        ra, dec, radius = float(query['ra']), float(query['dec']), float(query['radius'])
+        if self.reject_ra is not None and ra > self.reject_ra:
+            return self.reply(500, b'error')
+        inside = _angularDistance(ra, dec, self.stars['raMean'], self.stars['decMean']) <= radius
+        names = query['columns'].strip('[]').split(',')
+        lines = [','.join(names)]
+        lines += [','.join(repr(float(self.stars[c][i])) for c in names) for i in np.flatnonzero(inside)]
+        self.reply(200, ('\n'.join(lines) + '\n').encode(), 'text/csv')
+
+
+class RequestLog(list):
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def mast(http_server):
+    """Start a stub MAST server; returns (start(throttle, reject_ra) -> (baseurl, log), star field)."""
+    stars = starField()
+
+    def start(throttle=0, reject_ra=None):
+        log = RequestLog()
+        url = http_server(functools.partial(MASTHandler, stars=stars, log=log, throttle=throttle,
+                                            reject_ra=reject_ra))
+        return url + '/api/v0.1/panstarrs', log
+
+    return start, stars
+
+
+def tileCache(baseurl, cache_dir):
+    client = PS1_Comparison.PS1Client(max_workers=4, retries=3, backoff=0)
+    return PS1_Comparison.ps1tilecache(columns=columns, baseurl=baseurl, client=client,
+                                       cache_dir=str(cache_dir), nside=128)
+
+
+def cones(log):
+    return [query for kind, query in log if kind == 'cone']
+
+
+def test_tiles_are_fetched_once_then_served_offline(mast, tmp_path):
+    start, stars = mast
+    baseurl, log = start(throttle=2)
+    cache = tileCache(baseurl, tmp_path)
+    cone = (150.1, 19.9, 0.15)
+
+    # One concurrent batch for every tile of the cone, throttled requests retried
+    fetched = cache.prefetch([cone])
+    assert fetched == len(cache.tilesFor(*cone)) > 1
+    assert len(cones(log)) == fetched + 2
+    assert [kind for kind, _ in log].count('metadata') == 1
+
+    result = cache.cone(*cone, offline=True)
+    inside = _angularDistance(cone[0], cone[1], stars['raMean'], stars['decMean']) <= cone[2]
+    assert sorted(np.asarray(result['raMean'])) == sorted(stars['raMean'][inside])
+    assert len(cones(log)) == fetched + 2
+
+    # A new client over the same directory needs no MAST queries at all
+    del log[:]
+    again = tileCache(baseurl, tmp_path).cone(*cone)
+    assert len(again) == len(result) and not log
+
+
+def test_only_missing_tiles_are_fetched(mast, tmp_path):
+    start, _ = mast
+    baseurl, log = start()
+    cache = tileCache(baseurl, tmp_path)
+    with pytest.raises(IOError):
+        cache.cone(150.0, 20.0, 0.1, offline=True)
+    assert not log
+
+    # Overlapping cones only fetch the tiles not cached yet
+    cache.cone(150.0, 20.0, 0.1)
+    first = len(cones(log))
+    missing = cache.missingTiles(cache.tilesFor(150.3, 20.0, 0.1))
+    assert 0 < len(missing) < first
+    cache.cone(150.3, 20.0, 0.1)
+    assert len(cones(log)) == first + len(missing)
+
+
+def test_failed_cones_keep_the_fetched_tiles(mast, tmp_path):
+    start, _ = mast
+    cone = (150.1, 19.9, 0.15)
+    probe = tileCache(None, tmp_path / 'probe')
+    pixels = probe.tilesFor(*cone)
+    # Fail the easternmost tile only
+    baseurl, log = start(reject_ra=max(probe.tileCone(p)[0] for p in pixels) - 1e-6)
+    cache = tileCache(baseurl, tmp_path / 'cache')
+
+    with pytest.raises(IOError):
+        cache.prefetch([cone])
+    missing = cache.missingTiles(pixels)
+    assert 0 < len(missing) < len(pixels)
+
+    # Once MAST answers again only the failed tiles are fetched
+    baseurl, log = start()
+    cache = tileCache(baseurl, tmp_path / 'cache')
+    assert cache.prefetch([cone]) == len(missing)
+    assert len(cones(log)) == len(missing)
+
+
+def test_cone_batches_in_an_event_loop(mast):
+    start, stars = mast
+    baseurl, _ = start(reject_ra=150.2)
+    client = PS1_Comparison.PS1Client(max_workers=4, retries=0, backoff=0)
+    results = PS1_Comparison.ps1cone_many([(150.0, 20.0, 0.05), (150.3, 20.0, 0.05)], client=client,
+                                          columns=columns, baseurl=baseurl, return_exceptions=True)
+    assert results[0].splitlines()[0] == ','.join(columns)
+    assert isinstance(results[1], Exception)
+
+
+def test_direct_cones_are_clamped_to_the_service_limit(mast):
+    start, _ = mast
+    baseurl, log = start()
+    client = PS1_Comparison.PS1Client(max_workers=1, retries=0, backoff=0)
+    PS1_Comparison.ps1cone(150.0, 20.0, 0.8, client=client, columns=columns, baseurl=baseurl)
+    assert float(cones(log)[0]['radius']) == PS1_Comparison.ps1cone_max_radius
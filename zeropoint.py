@@ -0,0 +1,92 @@
+from astropy.table import Table
+import numpy as np
+import os
+
+zeropoint_table = 'sexout/zeropoints.fits'
+
+# Magnitude error added in quadrature so a few very precise stars cannot dominate the fit
+error_floor = 0.01
+
+
+def _robustSigma(x):
+    """Standard deviation estimated from the median absolute deviation."""
+    return 1.4826 * np.median(np.abs(x - np.median(x)))
+
+
+def solveZeropoint(ref_mag, inst_mag, ref_err=None, inst_err=None, color=None,
+                   sigma=3.0, maxiters=5, min_stars=3):
+    """Fit ref_mag - inst_mag = zp (+ color_term * color) over matched stars.
+
+       ref_mag, inst_mag: matched reference (PS1) and instrumental (MAG_AUTO) magnitudes
+       ref_err, inst_err: their errors, used as inverse-variance weights
+       color: optional colour index per star (e.g. g - r) to fit a colour term
+       sigma, maxiters: outliers beyond sigma robust standard deviations are clipped and the fit
+                        repeated until nothing changes or maxiters is reached
+
+       Returns a dictionary with zp, zp_err, color_term, color_term_err, rms, nstars (used)
+       and nclipped. Values are NaN when fewer than min_stars usable stars remain.
+    """
+    ref_mag = np.asarray(ref_mag, dtype=float)
+    inst_mag = np.asarray(inst_mag, dtype=float)
+    variance = np.full(ref_mag.shape, error_floor ** 2)
+    if ref_err is not None:
+        variance = variance + np.asarray(ref_err, dtype=float) ** 2
+    if inst_err is not None:
+        variance = variance + np.asarray(inst_err, dtype=float) ** 2
+
+    columns = [np.ones(ref_mag.shape)]
+    if color is not None:
+        columns.append(np.asarray(color, dtype=float))
+    design = np.column_stack(columns)
+    delta = ref_mag - inst_mag
+
+    usable = np.isfinite(delta) & np.isfinite(variance) & np.isfinite(design).all(axis=1)
+    keep = usable.copy()
+    result = {'zp': np.nan, 'zp_err': np.nan, 'color_term': np.nan, 'color_term_err': np.nan,
+              'rms': np.nan, 'nstars': int(keep.sum()), 'nclipped': 0}
+
+    for iteration in range(maxiters + 1):
+        if keep.sum() < min_stars:
+            result['nstars'] = int(keep.sum())
+            return result
+        w = 1.0 / variance[keep]
+        a = design[keep] * np.sqrt(w)[:, None]
+        b = delta[keep] * np.sqrt(w)
+        coeffs, _, _, _ = np.linalg.lstsq(a, b, rcond=None)
+        residual = delta - design.dot(coeffs)
+        scatter = _robustSigma(residual[keep])
+        clipped = usable & (np.abs(residual) <= sigma * scatter) if scatter > 0 else keep
+        if np.array_equal(clipped, keep) or iteration == maxiters:
+            break
+        keep = clipped
+
+    w = 1.0 / variance[keep]
+    covariance = np.linalg.pinv((design[keep] * w[:, None]).T.dot(design[keep]))
+    rms = np.sqrt(np.average(residual[keep] ** 2, weights=w))
+    # Scale the formal errors up when the scatter exceeds what the errors predict
+    dof = max(keep.sum() - design.shape[1], 1)
+    chi2 = np.sum(residual[keep] ** 2 * w) / dof
+    errors = np.sqrt(np.diag(covariance) * max(chi2, 1.0))
+
+    result.update(zp=coeffs[0], zp_err=errors[0], rms=rms,
+                  nstars=int(keep.sum()), nclipped=int(usable.sum() - keep.sum()))
+    if color is not None:
+        result.update(color_term=coeffs[1], color_term_err=errors[1])
+    return result
+
+
+def writeZeropoints(rows, path=zeropoint_table):
+    """Write per-frame zero points (a list of dictionaries) as a FITS binary table, one row per
+       frame, keyed by night and frame for joining.
+    """
+    names = ['night', 'frame', 'catalog', 'zp', 'zp_err', 'color_term', 'color_term_err',
+             'rms', 'nstars', 'nclipped']
+    table = Table(rows=[[row[n] for n in names] for row in rows], names=names) if rows else \
+        Table(names=names, dtype=['U32', 'U64', 'U128'] + ['f8'] * 5 + ['i4'] * 2)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table.write(path, overwrite=True)
+    return table
+
+
+def loadZeropoints(path=zeropoint_table):
+    return Table.read(path)